@@ -0,0 +1,381 @@
+'''
+Benchmarks of the hot paths of pytest-dataplugin: creating, extracting and
+verifying archives and the local transfer backends.
+
+Synthetic data directories are generated once per run, every operation then
+runs in a fresh python process so it's peak RSS is it's own. Results are
+reported in MB/s, files/s and peak RSS per operation, codec and dataset and
+can be saved as a baseline which later runs are compared against.
+
+    python benchmarks/bench_dataplugin.py
+    python benchmarks/bench_dataplugin.py --scale 0.1 --codec gzip --codec zstd
+    python benchmarks/bench_dataplugin.py --save baseline.json
+    python benchmarks/bench_dataplugin.py --compare baseline.json
+
+The comparison exits with a non zero status when the throughput of an
+operation dropped by more than --threshold since the baseline. Operations
+shorter than --min-seconds are too noisy to compare, raise --scale until the
+interesting ones take longer than that.
+'''
+from __future__ import print_function
+import os
+import io
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import platform
+import tempfile
+import subprocess
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+
+import dataplugin  # noqa: E402
+
+
+MB = 1024.0 * 1024.0
+WORDS = (
+    'alpha bravo charlie delta echo foxtrot golf hotel india juliett kilo '
+    'lima mike november oscar papa quebec romeo sierra tango uniform victor '
+    'whiskey xray yankee zulu'
+).split()
+
+
+def text(rng, size):
+    '''
+    Compressible text of about size bytes
+    '''
+    out = []
+    total = 0
+    while total < size:
+        line = u' '.join(rng.choice(WORDS) for _ in range(12)) + u'\n'
+        out.append(line)
+        total += len(line)
+    return u''.join(out).encode('ascii')[:size]
+
+
+def write(path, data):
+    with io.open(path, 'wb') as fp:
+        fp.write(data)
+
+
+def make_tiny(root, scale, rng):
+    '''
+    Many tiny text files spread over a few hundred directories
+    '''
+    count = max(10, int(50000 * scale))
+    for n in range(count):
+        dirname = os.path.join(root, 'd{:03d}'.format(n // 500))
+        if not os.path.exists(dirname):
+            os.makedirs(dirname)
+        write(
+            os.path.join(dirname, 'f{:05d}.txt'.format(n)),
+            text(rng, rng.randint(64, 2048)),
+        )
+
+
+def make_huge(root, scale, rng):
+    '''
+    A few huge, compressible files
+    '''
+    size = max(64 * 1024, int(256 * MB * scale))
+    block = text(rng, 1024 * 1024)
+    for n in range(2):
+        with io.open(os.path.join(root, 'huge{}.txt'.format(n)), 'wb') as fp:
+            written = 0
+            while written < size:
+                chunk = block[:size - written]
+                fp.write(chunk)
+                written += len(chunk)
+
+
+def make_deep(root, scale, rng):
+    '''
+    A single deeply nested tree with a few files on every level
+    '''
+    depth = min(300, max(5, int(300 * scale)))
+    path = root
+    for level in range(depth):
+        path = os.path.join(path, 'd{}'.format(level % 10))
+        os.makedirs(path)
+        for n in range(3):
+            write(os.path.join(path, 'f{}.txt'.format(n)), text(rng, 512))
+
+
+def make_binary(root, scale, rng):
+    '''
+    Incompressible binary files
+    '''
+    count = max(2, int(64 * scale))
+    for n in range(count):
+        write(os.path.join(root, 'b{:03d}.bin'.format(n)), os.urandom(1024 * 1024))
+
+
+DATASETS = {
+    'tiny': make_tiny,
+    'huge': make_huge,
+    'deep': make_deep,
+    'binary': make_binary,
+}
+
+
+def dataset_size(root):
+    files = 0
+    size = 0
+    for _, path in dataplugin.walk_files(root):
+        files += 1
+        size += os.path.getsize(path)
+    return files, size
+
+
+def peak_rss():
+    '''
+    Peak resident set size of this process in MB, None when unknown
+    '''
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        return rss / MB
+    return rss / 1024.0
+
+
+def run_operation(op, codec, data, archive, out):
+    '''
+    Run one operation, this is the body of a worker process
+    '''
+    if op == 'create':
+        dataplugin.create_archive(archive, data, codec=codec)
+    elif op == 'extract':
+        dataplugin.extract_archive(archive, out, codec=codec)
+    elif op == 'verify':
+        dataplugin.shasum(archive)
+    elif op == 'upload':
+        dataplugin.local_uploader(out, archive)
+    elif op == 'download':
+        dataplugin.local_downloader(archive, out)
+    else:
+        raise ValueError('Unknown operation {}'.format(op))
+
+
+def worker(args):
+    start_cpu = sum(os.times()[:2])
+    start = time.time()
+    run_operation(args.op, args.op_codec, args.data, args.archive, args.out)
+    result = {
+        'seconds': time.time() - start,
+        'cpu': sum(os.times()[:2]) - start_cpu,
+        'rss': peak_rss(),
+    }
+    sys.stdout.write(json.dumps(result) + '\n')
+
+
+def spawn(op, codec, data, archive, out):
+    cmd = [
+        sys.executable, os.path.abspath(__file__), '--worker', op,
+        '--op-codec', codec, '--data', data, '--archive', archive,
+        '--out', out,
+    ]
+    with io.open(os.devnull, 'wb') as devnull:
+        output = subprocess.check_output(cmd, stderr=devnull)
+    return json.loads(output.decode('utf-8').strip().splitlines()[-1])
+
+
+def measure(op, codec, data, archive, out, repeat):
+    '''
+    Run an operation repeat times, keeping the fastest run and the largest
+    peak RSS.
+    '''
+    best = None
+    for _ in range(repeat):
+        if os.path.isdir(out):
+            shutil.rmtree(out)
+        elif os.path.exists(out):
+            os.remove(out)
+        result = spawn(op, codec, data, archive, out)
+        if best is None:
+            best = result
+            continue
+        # peak_rss is None on platforms without the resource module
+        rss = [r for r in (result['rss'], best['rss']) if r is not None]
+        if result['seconds'] < best['seconds']:
+            best = result
+        best['rss'] = max(rss) if rss else None
+    return best
+
+
+def bench(workdir, datasets, codecs, scale, repeat, seed):
+    results = {}
+    rng = random.Random(seed)
+    for name in datasets:
+        data = os.path.join(workdir, name, 'data')
+        os.makedirs(data)
+        DATASETS[name](data, scale, rng)
+        files, size = dataset_size(data)
+        for n, codec in enumerate(codecs):
+            ext = dataplugin.CODECS[codec].extensions[0]
+            archive = os.path.join(workdir, name, 'archive' + ext)
+            out = os.path.join(workdir, name, 'out')
+            ops = ['create', 'extract']
+            if n == 0:
+                # Hashing and transfers do not depend on the codec
+                ops += ['verify', 'upload', 'download']
+            for op in ops:
+                if op == 'upload':
+                    target = os.path.join(workdir, name, 'remote' + ext)
+                    result = measure(op, codec, data, archive, target, repeat)
+                elif op == 'download':
+                    source = os.path.join(workdir, name, 'remote' + ext)
+                    target = os.path.join(workdir, name, 'download' + ext)
+                    result = measure(op, codec, data, source, target, repeat)
+                else:
+                    result = measure(op, codec, data, archive, out, repeat)
+                if op in ('create', 'extract'):
+                    nbytes, nfiles = size, files
+                else:
+                    nbytes, nfiles = os.path.getsize(archive), 1
+                seconds = max(result['seconds'], 1e-6)
+                key = '{}/{}/{}'.format(
+                    op, codec if op in ('create', 'extract') else '-', name
+                )
+                results[key] = {
+                    'seconds': round(seconds, 4),
+                    'cpu': round(result['cpu'], 4),
+                    'bytes': nbytes,
+                    'files': nfiles,
+                    'archive_bytes': os.path.getsize(archive),
+                    'mb_per_second': round(nbytes / MB / seconds, 2),
+                    'files_per_second': round(nfiles / seconds, 1),
+                    'peak_rss_mb': result['rss'] and round(result['rss'], 1),
+                }
+    return results
+
+
+def print_results(results, baseline=None):
+    header = '{:<30} {:>9} {:>10} {:>11} {:>9}'.format(
+        'operation/codec/dataset', 'seconds', 'MB/s', 'files/s', 'RSS MB'
+    )
+    if baseline:
+        header += ' {:>8}'.format('change')
+    print(header)
+    for key in sorted(results):
+        result = results[key]
+        rss = result['peak_rss_mb']
+        line = '{:<30} {:>9.3f} {:>10.1f} {:>11.1f} {:>9}'.format(
+            key, result['seconds'], result['mb_per_second'],
+            result['files_per_second'], '-' if rss is None else rss,
+        )
+        if baseline and key in baseline:
+            line += ' {:>+7.1f}%'.format(change(result, baseline[key]) * 100)
+        print(line)
+
+
+def change(result, base):
+    if not base['mb_per_second']:
+        return 0.0
+    return result['mb_per_second'] / base['mb_per_second'] - 1
+
+
+def regressions(results, baseline, threshold, min_seconds=0.0):
+    '''
+    The operations whose throughput dropped by more than threshold. Runs
+    shorter than min_seconds are too noisy to compare and are ignored.
+    '''
+    return sorted(
+        key for key in results if key in baseline and
+        min(results[key]['seconds'], baseline[key]['seconds']) >= min_seconds and
+        change(results[key], baseline[key]) < -threshold
+    )
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument(
+        '--dataset', action='append', choices=sorted(DATASETS),
+        help='Dataset to run, may be given more than once (default: all)',
+    )
+    parser.add_argument(
+        '--codec', action='append', choices=sorted(dataplugin.CODECS),
+        help='Codec to run, may be given more than once (default: all available)',
+    )
+    parser.add_argument(
+        '--scale', type=float, default=1.0,
+        help='Multiply the size of every dataset',
+    )
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--workdir', help='Keep the generated data here')
+    parser.add_argument('--save', help='Write the results to this json file')
+    parser.add_argument(
+        '--compare', help='Compare the results with this json baseline',
+    )
+    parser.add_argument(
+        '--threshold', type=float, default=0.2,
+        help='Allowed drop in throughput before a regression is reported',
+    )
+    parser.add_argument(
+        '--min-seconds', type=float, default=0.1,
+        help='Operations faster than this are not compared',
+    )
+    parser.add_argument('--worker', dest='op', help=argparse.SUPPRESS)
+    parser.add_argument('--op-codec', help=argparse.SUPPRESS)
+    parser.add_argument('--data', help=argparse.SUPPRESS)
+    parser.add_argument('--archive', help=argparse.SUPPRESS)
+    parser.add_argument('--out', help=argparse.SUPPRESS)
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.op:
+        worker(args)
+        return 0
+    datasets = args.dataset or sorted(DATASETS)
+    codecs = args.codec or [
+        name for name in sorted(dataplugin.CODECS)
+        if dataplugin.CODECS[name].available
+    ]
+    workdir = args.workdir or tempfile.mkdtemp(prefix='dataplugin-bench-')
+    try:
+        results = bench(
+            workdir, datasets, codecs, args.scale, args.repeat, args.seed
+        )
+    finally:
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+    baseline = None
+    if args.compare:
+        with io.open(args.compare, 'r') as fp:
+            baseline = json.load(fp)['results']
+    print_results(results, baseline)
+    if args.save:
+        with io.open(args.save, 'w') as fp:
+            fp.write(u'{}\n'.format(json.dumps({
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'scale': args.scale,
+                'results': results,
+            }, sort_keys=True, indent=1, separators=(',', ': '))))
+    if baseline:
+        slower = regressions(
+            results, baseline, args.threshold, args.min_seconds
+        )
+        for key in slower:
+            print('Regression: {} is {:.1f}% slower than the baseline'.format(
+                key, -change(results[key], baseline[key]) * 100
+            ))
+        if slower:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
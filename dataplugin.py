@@ -14,23 +14,55 @@ directory is out of date after.
 import sys
 import io
 import os
+import mmap
+import base64
+import socket
+import errno
 import gzip
-import shutil
+import zlib
+import struct
 import hashlib
 import tarfile
+import collections
+import contextlib
+import threading
+import multiprocessing
+from multiprocessing.pool import ThreadPool
 from functools import partial
 import re
+import json
+import time
+import random
+import shutil
+import posixpath
+from stat import S_ISREG
 import py
 import pytest
 
 try:
-    from urllib.parse import urlparse
+    from urllib.parse import urlparse, urljoin, unquote
 except ImportError:
-    from urlparse import urlparse
+    from urlparse import urlparse, urljoin
+    from urllib import unquote
 try:
     from urllib2 import build_opener
 except ImportError:
     from urllib.request import build_opener
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+try:
+    import http.client as httplib
+except ImportError:
+    import httplib
 try:
     import smb.SMBHandler
 except ImportError:
@@ -43,6 +75,31 @@ except ImportError:
     HAS_BOTO = False
 else:
     HAS_BOTO = True
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+try:
+    import blake3
+except ImportError:
+    blake3 = None
+try:
+    import lz4.frame
+except ImportError:
+    HAS_LZ4 = False
+else:
+    HAS_LZ4 = True
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
 
 # pytest handler order:
@@ -59,6 +116,9 @@ else:
 
 
 SIGNATURE_RE = '^.*dataplugin-signature.*=.*$'
+DEFAULT_HASH_CACHE_SIZE = 200000
+DEFAULT_SHARED_CACHE_SIZE = 10 * 1024 * 1024 * 1024
+SHARED_CACHE_ENV = 'PYTEST_DATAPLUGIN_CACHE'
 NOOP = '_dataplugin_NOOP'
 STATE = {
     'action': NOOP,
@@ -72,19 +132,73 @@ STATE = {
     'inifile': None,
     'return_code': 0,
     'tests_disabled': False,
+    'compress_workers': 1,
+    'block_size': None,
+    'compress_level': None,
+    'codec': None,
+    'layout': 'archive',
+    'store': '.dataplugin-store',
+    'seekable': False,
+    'seek_interval': 4 * 1024 * 1024,
+    'shard_by': 'directory',
+    'shard_size': 256 * 1024 * 1024,
+    'shards': None,
+    'report': None,
+    'progress': False,
+    'prefetch': False,
+    'dedupe': False,
+    'extract_links': 'hardlink',
+    'incremental': False,
+    'cache_dir': None,
+    'rescan': False,
+    'hash_cache_size': DEFAULT_HASH_CACHE_SIZE,
+    'hash_cache': None,
+    'hash_workers': None,
+    'fail_fast': False,
+    'hash': 'sha1',
+    'extract_workers': 1,
+    's3_endpoint_url': None,
+    's3_part_size': 8 * 1024 * 1024,
+    's3_multipart_threshold': 8 * 1024 * 1024,
+    's3_max_concurrency': 10,
+    'transfer_concurrency': 8,
+    'transfer_limits': {},
+    'transfer_retries': 3,
+    'transfer_backoff': 0.5,
+    'http_max_connections': 4,
+    'shared_cache': None,
+    'shared_cache_size': DEFAULT_SHARED_CACHE_SIZE,
 }
 ACTIONS = (
     'create',
     'extract',
     'upload',
     'download',
+    'download-extract',
+    'fetch',
     'verify',
+    'verify-directory',
 )
 
 
 DEFAULT_INFO = tarfile.TarInfo()
+DEFAULT_BLOCK_SIZE = 128 * 1024
+COPY_BUFSIZE = 1024 * 1024
+MMAP_THRESHOLD = 1024 * 1024
+MMAP_CHUNK = 8 * 1024 * 1024
+EXTRACT_BUFFER_LIMIT = 4 * 1024 * 1024
+RESUME_PART_SIZE = 8 * 1024 * 1024
+DEFAULT_SEEK_INTERVAL = 4 * 1024 * 1024
+DEFAULT_SHARD_SIZE = 256 * 1024 * 1024
+HTTP_TIMEOUT = 60
+HTTP_MAX_REDIRECTS = 5
+HTTP_REDIRECTS = (301, 302, 303, 307, 308)
+EXTRACT_INFLIGHT_LIMIT = 64 * 1024 * 1024
+EXTRACT_LINKS = ('hardlink', 'copy')
+LAYOUTS = ('archive', 'chunks', 'shards')
+SHARD_METHODS = ('directory', 'size')
 _writer_mode = 'w'
-_reader_mode = 'r:gz'
+_reader_mode = 'r|'
 collect_ignore = []
 tw = py.io.TerminalWriter(sys.stderr)
 
@@ -101,299 +215,4004 @@ class SignatureNotFound(DataPluginException):
     '''
 
 
-def shasum(filename):
+class BlobVerificationFailed(DataPluginException):
     '''
-    Return the sha1 checksum of the file at location 'filename'
+    Raised when a blob in the chunk store does not match it's digest
     '''
-    import hashlib
-    hsh = hashlib.sha1()
-    with io.open(filename, 'rb') as fp:
-        while True:
-            chunk = fp.read(1024 * 100)
-            if not chunk:
-                break
-            hsh.update(chunk)
-    return hsh.hexdigest()
 
 
-def checkignore(path):
-    'Check if a file is ignored by .gitignore'
-    import subprocess
-    return 0 == subprocess.call(['git', 'check-ignore', path])
+class CodecNotAvailable(DataPluginException):
+    '''
+    Raised when an archive codec is unknown or it's module is not installed
+    '''
 
 
-def verify_data_archive(filename, signature):
+class HashNotAvailable(DataPluginException):
     '''
-    True when the sha1 of the file meats that of the signature arg.
+    Raised when a hash algorithm is unknown or it's module is not installed
     '''
-    return shasum(filename) == signature
 
 
-class ConsistantArchiveReader(object):
+class DownloadVerificationFailed(DataPluginException):
     '''
-    Read the archive and extract it's contents to a directory without setting
-    any times or permissions.
+    Raised when a downloaded file does not match the configured signature
     '''
 
-    def __init__(self, archivefile, _mode=_reader_mode):
-        self.archivefile = archivefile
-        self.tar = tarfile.open(self.archivefile, mode=_reader_mode)
-
-    def extract_to_directory(self, root):
-        # tar = tarfile.TarFile(self.archivefile, fileobj=self.gz)
-        for fileinfo in self.tar:
-            filedir = os.path.dirname(fileinfo.name)
-            if filedir:
-                filedir = os.path.join(root, filedir)
-            else:
-                filedir = root
-            if not os.path.exists(filedir):
-                os.makedirs(filedir)
-            extractpath = os.path.join(filedir, os.path.basename(fileinfo.name.decode('utf-8')))
-            self.tar.makefile(fileinfo, extractpath)
 
-    def close(self):
-        self.tar.close()
+class TransferError(DataPluginException):
+    '''
+    Raised when a transfer fails in a way that may succeed when retried
+    '''
 
-    def sha1(self, filename=None):
-        filename = filename or self.archivefile
-        hsh = hashlib.sha1()
-        with io.open(filename, 'rb') as fp:
-            while True:
-                chunk = fp.read(1024 * 100)
-                if not chunk:
-                    break
-                hsh.update(chunk)
-        return hsh.hexdigest()
 
+PHASES_ORDER = ('walk', 'read', 'compress', 'hash', 'transfer', 'extract')
 
-class ConsistantArchiveWriter(object):
+
+def _clock():
     '''
-    Create an gziped tar archive that will have a consistant hash as long as
-    the contents do file contents do not change. This is accomplished doing the
-    following.
+    A tuple of wall time and the cpu time of the current thread, or of the
+    process when per thread cpu time is not available.
+    '''
+    if hasattr(time, 'thread_time'):
+        return time.time(), time.thread_time()
+    return time.time(), sum(os.times()[:2])
 
-      - Sort all file and directory names in a consistant manner before adding
-        them to the archive
-      - Store a consistant user id, user name, group id, group name, and
-        modified time on each file.
-      - Use the same timstamp as the modified time of the archived files for
-        the gzip file header.
+
+class PhaseStats(object):
+    '''
+    The bytes and files handled and the wall and cpu time spent in each phase
+    of an action. Phases nest, time spent in an inner phase is not counted
+    towards the outer one. Times of phases running on several threads are
+    summed over the threads.
     '''
 
-    def __init__(self, archivefile, default_info=DEFAULT_INFO, _mode=_writer_mode):
-        self.archivefile = archivefile
-        self.tar = tarfile.open('.' + archivefile, _writer_mode)
-        self.default_info = default_info
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.phases = {}
 
-    def add_directory(self, root, _thisdir=None):
-        if not _thisdir:
-            _thisdir = root
-        for dirname, dirs, files in os.walk(_thisdir):
-            for filename in sorted(files):
-                with open(os.path.join(dirname, filename), 'rb') as fp:
-                    info = self.sanitize_info(self.tar.gettarinfo(fileobj=fp))
-                    # TODO: Why would we expect one or other not to have
-                    # leading slash, fix this upstream.
-                    newname = info.name.lstrip('/').split(root.lstrip('/'), 1)[-1].lstrip('/')
-                    info.name = newname
-                    self.tar.addfile(info, fp)
-            for d in sorted(dirs):
-                self.add_directory(root, os.path.join(dirname, d))
-            break
+    def reset(self):
+        with self.lock:
+            self.phases = {}
 
-    def sanitize_info(self, info):
-        for attr in ('mtime', 'uid', 'gid', 'uname', 'gname', ):
-            newval = getattr(self.default_info, attr)
-            setattr(info, attr, newval)
-        return info
+    def _record(self, name):
+        record = self.phases.get(name)
+        if record is None:
+            record = {'bytes': 0, 'files': 0, 'wall': 0.0, 'cpu': 0.0}
+            self.phases[name] = record
+        return record
 
-    def close(self):
-        self.tar.close()
-        self._compress()
-        hsh = hashlib.sha1()
-        with open(self.archivefile, 'rb') as fp:
-            while True:
-                chunk = fp.read(1024 * 100)
-                if not chunk:
-                    break
-                hsh.update(chunk)
-        os.remove('.'+self.archivefile)
-        return hsh.hexdigest()
+    def _charge(self, name, start, now, nbytes=0, files=0):
+        with self.lock:
+            record = self._record(name)
+            record['wall'] += now[0] - start[0]
+            record['cpu'] += now[1] - start[1]
+            record['bytes'] += nbytes
+            record['files'] += files
 
-    def _compress(self):
-        with open('.' + self.archivefile, 'rb') as f_in, \
-                gzip.GzipFile(self.archivefile, 'wb', mtime=self.default_info.mtime) as f_out:
-            shutil.copyfileobj(f_in, f_out)
+    def enter(self, name):
+        '''
+        Start phase name on this thread, pausing the phase it is nested in.
+        '''
+        stack = getattr(self.local, 'stack', None)
+        if stack is None:
+            stack = self.local.stack = []
+        now = _clock()
+        if stack:
+            self._charge(stack[-1][0], stack[-1][1], now)
+        stack.append([name, now])
 
+    def exit(self, nbytes=0, files=0):
+        '''
+        End the phase entered last on this thread, counting nbytes and files
+        towards it.
+        '''
+        stack = self.local.stack
+        now = _clock()
+        name, start = stack.pop()
+        self._charge(name, start, now, nbytes, files)
+        if stack:
+            stack[-1][1] = now
 
-def create_archive(output_name, archive_directory):
-    '''
-    Create an archive and return it's signature
-    '''
-    archiver = ConsistantArchiveWriter(output_name)
-    archiver.add_directory(archive_directory)
-    sha1 = archiver.close()
-    return sha1
+    @contextlib.contextmanager
+    def phase(self, name):
+        self.enter(name)
+        try:
+            yield
+        finally:
+            self.exit()
+
+    def add(self, name, nbytes=0, files=0):
+        with self.lock:
+            record = self._record(name)
+            record['bytes'] += nbytes
+            record['files'] += files
+
+    def timed(self, name, iterable):
+        '''
+        Yield the items of iterable, the time spent producing them is counted
+        towards phase name.
+        '''
+        iterator = iter(iterable)
+        while True:
+            with self.phase(name):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+
+    def report(self):
+        '''
+        A dict of the phases with their throughput
+        '''
+        report = {}
+        with self.lock:
+            for name, record in self.phases.items():
+                record = dict(record)
+                wall = record['wall']
+                record['mb_per_second'] = (
+                    record['bytes'] / 1024.0 / 1024.0 / wall if wall else 0.0
+                )
+                record['files_per_second'] = record['files'] / wall if wall else 0.0
+                report[name] = record
+        return report
+
+    def lines(self):
+        report = self.report()
+        names = [name for name in PHASES_ORDER if name in report]
+        names += sorted(name for name in report if name not in PHASES_ORDER)
+        yield '{:<10} {:>9} {:>11} {:>9} {:>9} {:>9}'.format(
+            'phase', 'files', 'MB', 'wall s', 'cpu s', 'MB/s'
+        )
+        for name in names:
+            record = report[name]
+            yield '{:<10} {:>9} {:>11.1f} {:>9.2f} {:>9.2f} {:>9.1f}'.format(
+                name, record['files'], record['bytes'] / 1024.0 / 1024.0,
+                record['wall'], record['cpu'], record['mb_per_second'],
+            )
 
 
-def extract_archive(input_name, output_directory):
+PHASES = PhaseStats()
+
+
+class PhaseReader(object):
     '''
-    Extract the archive
+    File like object counting the bytes read, and the time spent reading them,
+    towards a phase.
     '''
-    archiver = ConsistantArchiveReader(input_name)
-    sha1 = archiver.sha1()
-    archiver.extract_to_directory(output_directory)
-    archiver.close()
-    return sha1
 
+    def __init__(self, fileobj, phase, stats=PHASES):
+        self.fileobj = fileobj
+        self.phase = phase
+        self.stats = stats
 
-def find_signature(path, signature_re):
-    with io.open(path, 'r') as fp:
-        for line in fp:
-            if signature_re.search(line):
-                found = True
-                break
-        else:
-            return False
-    return True
+    def read(self, size=-1):
+        self.stats.enter(self.phase)
+        data = b''
+        try:
+            data = self.fileobj.read(size)
+        finally:
+            self.stats.exit(len(data))
+        return data
 
 
-def update_signature(newsig, origpath, signature_re):
+class PhaseWriter(object):
     '''
-    Update the archive signature in the doc string of this file.
+    File like object counting the bytes written, and the time spent writing
+    them, towards a phase.
     '''
-    basename = os.path.basename(origpath)
-    dirname = os.path.dirname(origpath)
-    tmppath = os.path.join(dirname, '.' + basename)
-    found = False
-    with open(origpath) as fp:
-        with open(tmppath, 'w') as nfp:
-            for line in fp:
-                if signature_re.search(line):
-                    line = 'dataplugin-signature = {}\n'.format(newsig)
-                    found = True
-                nfp.write(line)
-    if not found:
-        raise SignatureNotFound("Signature not found in config")
-    os.rename(tmppath, origpath)
 
+    def __init__(self, fileobj, phase, stats=PHASES):
+        self.fileobj = fileobj
+        self.phase = phase
+        self.stats = stats
 
-def pytest_addoption(parser):
-    parser.addoption(
-        "--dataplugin-create",
-        action='store_true',
-        default=False,
-        help='Create an archive based on the contents of the data direcory',
-    )
-    parser.addoption(
-        "--dataplugin-extract",
-        action='store_true',
-        default=False,
-        help='Extract the archive to the data directory',
-    )
-    parser.addoption(
-        "--dataplugin-upload",
-        action='store_true',
-        default=False,
-        help=(
-            'Upload the archive to shared storage, this will also update the '
-            'signature in the local config file'
-        )
-    )
-    parser.addoption(
-        "--dataplugin-download",
-        action='store_true',
-        default=False,
-        help='Download the newest archive from shared storage',
-    )
-    parser.addoption(
-        "--dataplugin-verify",
-        action='store_true',
-        default=False,
-        help=(
-            'Verify the signature of the archive against the contents of '
-            'the data directory'
-        ),
-    )
+    def write(self, data):
+        self.stats.enter(self.phase)
+        try:
+            self.fileobj.write(data)
+        finally:
+            self.stats.exit(len(data))
 
+    def __getattr__(self, name):
+        return getattr(self.fileobj, name)
 
-def pytest_cmdline_preparse(config, args):
-    # TODO: Update opts to show config and environment defaults
-    # print(config.inifile)
-    pass
 
+PROGRESS_INTERVAL = 0.5
+PROGRESS_LOG_INTERVAL = 10
 
-def pytest_configure(config):
-    STATE['directory'] = config.inicfg.get(
-        'dataplugin-directory', os.path.join(str(config.rootdir), 'data')
-    )
-    STATE['signature'] = config.inicfg.get('dataplugin-signature')
-    STATE['location'] = config.inicfg.get('dataplugin-location', STATE['location'])
-    STATE['filename'] = os.path.basename(STATE['location'])
-    STATE['inifile'] = config.inifile
-    STATE['signature_re'] = re.compile(SIGNATURE_RE)
-    for action in ACTIONS:
-        if getattr(config.option, 'dataplugin_{}'.format(action), False):
+
+def format_size(nbytes):
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if nbytes < 1024.0:
             break
+        nbytes /= 1024.0
     else:
-        action = NOOP
-    STATE['action'] = action
-    if STATE['action'] == NOOP:
-        return
-    urlprs = urlparse(STATE['location'])
+        unit = 'TB'
+    return '{:.1f} {}'.format(nbytes, unit)
 
 
-def pytest_sessionstart(session):
-    if STATE['action'] == NOOP:
-        return
+def format_duration(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return '{}:{:02d}:{:02d}'.format(hours, minutes, seconds)
 
 
-def pytest_collectstart(collector):
-    if STATE['action'] == NOOP:
-        return
-    tw.line("dataplugin {} invoked, skipping collection.".format(STATE['action']), bold=True)
+class Progress(object):
+    '''
+    Progress of a long operation, the bytes done, throughput and time left are
+    rewritten in place on the terminal at most once every interval seconds.
+    Nothing is written for operations finishing within the first interval.
+    Only one progress is shown at a time, others running meanwhile stay
+    silent. Writers which can not rewrite a line, like a log file, get a new
+    line every time.
+    '''
 
+    _active = None
+    _active_lock = threading.Lock()
 
-@pytest.hookimpl(tryfirst=True)
-def pytest_collectreport(report):
-    if STATE['action'] == NOOP:
-        return
-    return True
+    def __init__(self, label, total=None, interval=PROGRESS_INTERVAL,
+                 writer=None):
+        self.label = label
+        self.total = total
+        self.interval = interval
+        self.writer = writer or tw
+        self.done = 0
+        self.start = self.last = time.time()
+        self.shown = False
+        self.lock = threading.Lock()
 
+    def update(self, nbytes):
+        with self.lock:
+            self.done += nbytes
+            self._tick()
 
-def pytest_ignore_collect(path, config):
-    if STATE['action'] == NOOP:
-        return
-    config.option.verbose = -1
-    return True
+    def set(self, done):
+        with self.lock:
+            self.done = done
+            self._tick()
 
+    def _tick(self):
+        now = time.time()
+        if now - self.last < self.interval:
+            return
+        self.last = now
+        with Progress._active_lock:
+            if Progress._active not in (None, self):
+                return
+            Progress._active = self
+        self.shown = True
+        self._show(self.text(now))
 
-@pytest.hookimpl(tryfirst=True)
-def pytest_collection_modifyitems(session, config, items):
-    if STATE['action'] == NOOP:
-        return
-    return True
+    def _show(self, text):
+        if getattr(self.writer, 'hasmarkup', True):
+            self.writer.reline(text)
+        else:
+            self.writer.line(text)
 
+    def text(self, now=None):
+        elapsed = max((now or time.time()) - self.start, 1e-6)
+        rate = self.done / elapsed
+        if self.total:
+            parts = ['{} of {}'.format(
+                format_size(self.done), format_size(self.total)
+            )]
+        else:
+            parts = [format_size(self.done)]
+        parts.append('{}/s'.format(format_size(rate)))
+        if self.total and rate:
+            parts.append('ETA {}'.format(
+                format_duration(max(self.total - self.done, 0) / rate)
+            ))
+        return '{}: {}'.format(self.label, ', '.join(parts))
 
-def iterchunks(fp, size):
-    for chunk in iter(partial(fp.read, size), b''):
-        yield chunk
+    def close(self):
+        with self.lock:
+            if self.shown:
+                self._show(self.text())
+                if getattr(self.writer, 'hasmarkup', True):
+                    self.writer.line()
+                self.shown = False
+        with Progress._active_lock:
+            if Progress._active is self:
+                Progress._active = None
 
+    def __enter__(self):
+        return self
 
-def pytest_runtestloop(session):
-    if STATE['action'] == NOOP:
-        return
-    STATE['return_code'] = 1
-    if STATE['action'] == 'create':
-        abspath = os.path.abspath(STATE['directory'])
-        if os.path.exists(abspath):
-            tw.line(
-                "Creating archive {} from directory {}".format(
-                    STATE['filename'], abspath
-                ), bold=True
+    def __exit__(self, *args):
+        self.close()
+
+
+class NullProgress(object):
+    '''
+    A Progress which is never shown
+    '''
+
+    def update(self, nbytes):
+        pass
+
+    def set(self, done):
+        pass
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+
+NULL_PROGRESS = NullProgress()
+
+
+def start_progress(label, total=None):
+    '''
+    A Progress for label when progress is shown, which is when stderr is a
+    terminal unless configured otherwise. Progress written to a log is
+    updated less often.
+    '''
+    if not STATE['progress']:
+        return NULL_PROGRESS
+    if tw.hasmarkup:
+        return Progress(label, total)
+    return Progress(label, total, PROGRESS_LOG_INTERVAL)
+
+
+HASH_ALGORITHMS = ('sha1', 'sha256', 'blake2b', 'blake3')
+DEFAULT_HASH = 'sha1'
+
+
+def new_hash(algorithm=DEFAULT_HASH):
+    '''
+    Return a new hash object for algorithm, one of HASH_ALGORITHMS
+    '''
+    if algorithm == 'blake3':
+        if blake3 is None:
+            raise HashNotAvailable("The blake3 module is not installed")
+        return blake3.blake3()
+    if algorithm not in HASH_ALGORITHMS or not hasattr(hashlib, algorithm):
+        raise HashNotAvailable("Unknown hash algorithm {}".format(algorithm))
+    return getattr(hashlib, algorithm)()
+
+
+def format_signature(algorithm, hexdigest):
+    '''
+    Signatures are prefixed with the name of the hash algorithm, except sha1
+    signatures which are left bare so older signatures stay valid.
+    '''
+    if algorithm == DEFAULT_HASH:
+        return hexdigest
+    return '{}:{}'.format(algorithm, hexdigest)
+
+
+def parse_signature(signature):
+    '''
+    Split a signature into a tuple of (algorithm, hexdigest)
+    '''
+    if ':' in signature:
+        algorithm, hexdigest = signature.split(':', 1)
+        if algorithm not in HASH_ALGORITHMS:
+            raise HashNotAvailable(
+                "Unknown hash algorithm {} in signature {}".format(
+                    algorithm, signature
+                )
             )
-            sha1 = create_archive('.' + STATE['filename'], abspath)
+        return algorithm, hexdigest
+    return DEFAULT_HASH, signature
+
+
+def hash_algorithm(algorithm, hash_cache=None):
+    '''
+    The hash algorithm to use along with hash_cache, the cache's algorithm
+    unless one is given, which must then be the same.
+    '''
+    if hash_cache is None:
+        return algorithm or DEFAULT_HASH
+    if algorithm is not None and algorithm != hash_cache.algorithm:
+        raise DataPluginException(
+            "Hash algorithm {} does not match the hash cache's {}".format(
+                algorithm, hash_cache.algorithm
+            )
+        )
+    return hash_cache.algorithm
+
+
+def _advise_sequential(fd):
+    if hasattr(os, 'posix_fadvise'):
+        try:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        except OSError:
+            pass
+
+
+def shasum(filename, algorithm=DEFAULT_HASH):
+    '''
+    Return the checksum of the file at location 'filename', sha1 unless
+    another algorithm is given. Large files are memory mapped and hashed
+    through memoryview slices, so no intermediate bytes are allocated.
+    '''
+    with PHASES.phase('hash'):
+        digest = _shasum(filename, algorithm)
+    PHASES.add('hash', os.path.getsize(filename), 1)
+    return digest
+
+
+def _shasum(filename, algorithm):
+    hsh = new_hash(algorithm)
+    with io.open(filename, 'rb') as fp:
+        size = os.fstat(fp.fileno()).st_size
+        label = 'Hashing {}'.format(os.path.basename(filename))
+        with start_progress(label, size) as progress:
+            if size < MMAP_THRESHOLD:
+                for chunk in iterchunks(fp, COPY_BUFSIZE, progress):
+                    hsh.update(chunk)
+                return hsh.hexdigest()
+            _advise_sequential(fp.fileno())
+            mm = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                if hasattr(mm, 'madvise'):
+                    mm.madvise(mmap.MADV_SEQUENTIAL)
+                view = memoryview(mm)
+                try:
+                    for offset in range(0, len(mm), MMAP_CHUNK):
+                        hsh.update(view[offset:offset + MMAP_CHUNK])
+                        progress.set(min(offset + MMAP_CHUNK, size))
+                finally:
+                    if hasattr(view, 'release'):
+                        view.release()
+            finally:
+                mm.close()
+    return hsh.hexdigest()
+
+
+def _copy_file_range(src, dst, offset):
+    while True:
+        count = os.copy_file_range(src, dst, MMAP_CHUNK)
+        if count == 0:
+            return offset
+        offset += count
+
+
+def _sendfile(src, dst, offset):
+    while True:
+        count = os.sendfile(dst, src, offset, MMAP_CHUNK)
+        if count == 0:
+            return offset
+        offset += count
+
+
+def _copy_buffered(src, dst, offset):
+    buf = bytearray(COPY_BUFSIZE)
+    view = memoryview(buf)
+    with io.open(src, 'rb', closefd=False) as fsrc:
+        with io.open(dst, 'wb', closefd=False) as fdst:
+            fsrc.seek(offset)
+            fdst.seek(offset)
+            while True:
+                count = fsrc.readinto(buf)
+                if not count:
+                    break
+                fdst.write(view[:count])
+                offset += count
+    return offset
+
+
+_COPY_FALLBACK_ERRNOS = tuple(
+    getattr(errno, name) for name in
+    ('EXDEV', 'ENOSYS', 'EINVAL', 'EOPNOTSUPP', 'ENOTSUP', 'EBADF')
+    if hasattr(errno, name)
+)
+
+
+def _copy_methods():
+    methods = []
+    if hasattr(os, 'copy_file_range'):
+        methods.append(_copy_file_range)
+    if hasattr(os, 'sendfile') and sys.platform.startswith('linux'):
+        methods.append(_sendfile)
+    methods.append(_copy_buffered)
+    return methods
+
+
+def copy_file(src, dst):
+    '''
+    Copy the file at src to dst without passing the data through python
+    when possible. copy_file_range is tried first, then sendfile, falling back
+    to reads into a reusable buffer. Returns the number of bytes copied.
+    '''
+    with io.open(src, 'rb') as fsrc:
+        with io.open(dst, 'wb') as fdst:
+            infd, outfd = fsrc.fileno(), fdst.fileno()
+            _advise_sequential(infd)
+            offset = 0
+            for method in _copy_methods():
+                try:
+                    return method(infd, outfd, offset)
+                except OSError as exc:
+                    if exc.errno not in _COPY_FALLBACK_ERRNOS:
+                        raise
+                # The failed method may have copied some data, resume from
+                # where the file positions are now.
+                offset = os.lseek(outfd, 0, os.SEEK_CUR)
+                os.lseek(infd, offset, os.SEEK_SET)
+
+
+def file_signature(filename, algorithm=DEFAULT_HASH):
+    '''
+    Return the signature of the file at location 'filename'
+    '''
+    return format_signature(algorithm, shasum(filename, algorithm))
+
+
+def hash_files(paths, algorithm=DEFAULT_HASH, workers=None, hash_cache=None):
+    '''
+    Return the digests of paths, in order, hashing the files concurrently on
+    a pool of threads. Hashing releases the GIL so the threads run in
+    parallel. Digests found in hash_cache are not computed again.
+    '''
+    digests = [None] * len(paths)
+    todo = []
+    for i, path in enumerate(paths):
+        if hash_cache is not None:
+            digests[i] = hash_cache.lookup(path)
+        if digests[i] is None:
+            todo.append(i)
+    if not todo:
+        return digests
+    pool = ThreadPool(workers or multiprocessing.cpu_count())
+    try:
+        results = pool.imap(
+            partial(shasum, algorithm=algorithm), [paths[i] for i in todo]
+        )
+        for i, digest in zip(todo, results):
+            digests[i] = digest
+            if hash_cache is not None:
+                hash_cache.record(paths[i], digest)
+    finally:
+        pool.close()
+        pool.join()
+    return digests
+
+
+def checkignore(path):
+    'Check if a file is ignored by .gitignore'
+    import subprocess
+    return 0 == subprocess.call(['git', 'check-ignore', path])
+
+
+def verify_data_archive(filename, signature, hash_cache=None):
+    '''
+    True when the hash of the file meats that of the signature arg. The
+    signature's algorithm is used, regardless of the configured one.
+    '''
+    algorithm, hexdigest = parse_signature(signature or '')
+    if hash_cache is not None and hash_cache.algorithm == algorithm:
+        return hash_cache.digest(filename) == hexdigest
+    return shasum(filename, algorithm) == hexdigest
+
+
+class ConsistantArchiveReader(object):
+    '''
+    Read the archive and extract it's contents to a directory without setting
+    any times or permissions. signature is the archive's recorded signature,
+    when it is not known the archive is hashed before trusting it's index.
+    '''
+
+    def __init__(self, archivefile, _mode=_reader_mode, codec=None,
+                 fileobj=None, signature=None):
+        self.archivefile = archivefile
+        self.known_signature = signature
+        self.codec = get_codec(codec, archivefile)
+        self.owns_fp = fileobj is None
+        if fileobj is None:
+            fileobj = io.open(self.archivefile, 'rb')
+        self.fp = fileobj
+        self.fileobj = self.codec.reader(self.fp)
+        self.tar = tarfile.open(fileobj=self.fileobj, mode=_mode)
+        self.members = None
+        self.seek_points = []
+
+    def extract_to_directory(self, root, hash_cache=None, manifest=None,
+                             stats=None, workers=1, links='hardlink'):
+        '''
+        Extract every member of the archive to root. When hash_cache, a
+        HashCache, is given the extract is incremental, files which are
+        already identical on disk are not rewritten and files which are not in
+        the archive are removed. Digests from manifest, a previous manifest of
+        this archive, let unchanged files be skipped without reading them.
+        Returns the manifest of the archive when extracting incrementally.
+
+        When workers is more than one the archive is decompressed on this
+        thread while files are written by a pool of workers threads. The
+        directory tree is created up front when a manifest is given.
+
+        Hardlink members are extracted as hardlinks of the file they link to,
+        or as copies of it when links is 'copy' or the file system has no
+        hardlinks.
+        '''
+        if links not in EXTRACT_LINKS:
+            raise DataPluginException("Unknown link mode {}".format(links))
+        with PHASES.phase('extract'):
+            return self._extract(root, hash_cache, manifest, stats, workers, links)
+
+    def _members(self):
+        total = os.path.getsize(self.archivefile) if self.owns_fp else None
+        label = 'Extracting {}'.format(os.path.basename(self.archivefile))
+        with start_progress(label, total) as progress:
+            for fileinfo in self.tar:
+                PHASES.add('extract', fileinfo.size, 1)
+                if self.owns_fp:
+                    progress.set(self.fp.tell())
+                else:
+                    progress.update(fileinfo.size)
+                yield fileinfo
+
+    def _extract(self, root, hash_cache, manifest, stats, workers, links):
+        if hash_cache is not None:
+            return self._extract_incremental(
+                root, hash_cache, manifest, stats, links
+            )
+        # Files left by an earlier extract may be hardlinks of each other,
+        # they are replaced rather than written in place.
+        unshare = os.path.isdir(root) and bool(os.listdir(root))
+        dirs = DirectoryMaker(root)
+        if manifest:
+            dirs.make_all(entry.path for entry in manifest)
+        if workers > 1:
+            return self._extract_parallel(root, dirs, workers, links, unshare)
+        for fileinfo in self._members():
+            dirs.make(posixpath.dirname(fileinfo.name))
+            if fileinfo.islnk():
+                link_member(root, fileinfo.name, fileinfo.linkname, links)
+                continue
+            extractpath = member_path(root, fileinfo.name)
+            if unshare:
+                _unshare(extractpath)
+            self.tar.makefile(fileinfo, extractpath)
+
+    def _extract_parallel(self, root, dirs, workers, links, unshare):
+        pool = ThreadPool(workers)
+        pending = collections.deque()
+        inflight = 0
+        try:
+            for fileinfo in self._members():
+                dirs.make(posixpath.dirname(fileinfo.name))
+                if fileinfo.islnk():
+                    # The file it links to may still be being written
+                    while pending:
+                        pending.popleft()[0].get()
+                    inflight = 0
+                    link_member(root, fileinfo.name, fileinfo.linkname, links)
+                    continue
+                extractpath = member_path(root, fileinfo.name)
+                if not fileinfo.isreg() or fileinfo.size > EXTRACT_BUFFER_LIMIT:
+                    # Large files are streamed straight to disk rather than
+                    # held in memory for a worker.
+                    if unshare:
+                        _unshare(extractpath)
+                    self.tar.makefile(fileinfo, extractpath)
+                    continue
+                data = self.tar.extractfile(fileinfo).read()
+                while pending and inflight + len(data) > EXTRACT_INFLIGHT_LIMIT:
+                    result, size = pending.popleft()
+                    result.get()
+                    inflight -= size
+                pending.append((
+                    pool.apply_async(_write_file, (extractpath, data, unshare)),
+                    len(data),
+                ))
+                inflight += len(data)
+            while pending:
+                pending.popleft()[0].get()
+        finally:
+            pool.close()
+            pool.join()
+
+    def _extract_incremental(self, root, hash_cache, manifest, stats, links):
+        stats = stats if stats is not None else ExtractStats()
+        expected = dict((entry.path, entry.digest) for entry in manifest or ())
+        entries = []
+        found = {}
+        for fileinfo in self._members():
+            if fileinfo.islnk() and fileinfo.linkname in found:
+                target = found[fileinfo.linkname]
+                extract_link(root, fileinfo.name, target, links, hash_cache, stats)
+                entries.append(target._replace(path=fileinfo.name))
+                continue
+            if not fileinfo.isreg():
+                continue
+            digest = extract_member(
+                root, fileinfo.name, fileinfo.size, expected.get(fileinfo.name),
+                lambda: self.tar.extractfile(fileinfo), hash_cache, stats,
+            )
+            entry = ManifestEntry(fileinfo.name, fileinfo.size, digest)
+            found[fileinfo.name] = entry
+            entries.append(entry)
+        remove_extra_files(
+            root, set(e.path for e in entries), hash_cache, stats
+        )
+        return entries
+
+    def close(self):
+        self.tar.close()
+        self.fileobj.close()
+        if self.owns_fp:
+            self.fp.close()
+
+    def signature(self, algorithm=DEFAULT_HASH):
+        return file_signature(self.archivefile, algorithm)
+
+    def open_member(self, name):
+        '''
+        Return a file like object of the member name. With an index written
+        next to the archive, reading starts at the nearest seek point instead
+        of the start of the archive. Without one the archive is read once to
+        find the offsets of it's members.
+        '''
+        if self.members is None:
+            index = self._index()
+            if index is not None:
+                entries = index_members(index)
+                self.seek_points = index['seek_points']
+            else:
+                entries = archive_members(self.archivefile, self.codec)
+                self.seek_points = []
+            self.members = dict((entry.path, entry) for entry in entries)
+        entry = self.members.get(name)
+        if entry is None:
+            raise DataPluginException(
+                "{} is not in the archive {}".format(name, self.archivefile)
+            )
+        return MemberReader(
+            self.archivefile, entry.offset, entry.size, self.codec,
+            self.seek_points,
+        )
+
+    def _index(self):
+        '''
+        The index next to the archive, when it was written for this version
+        of the archive.
+        '''
+        index = read_archive_index(self.archivefile, self.known_signature)
+        if index is None or self.known_signature:
+            return index
+        signature = index.get('signature', '')
+        try:
+            algorithm = parse_signature(signature)[0]
+        except HashNotAvailable:
+            return None
+        if self.signature(algorithm) != signature:
+            return None
+        return index
+
+    def sha1(self, filename=None):
+        filename = filename or self.archivefile
+        hsh = hashlib.sha1()
+        with io.open(filename, 'rb') as fp:
+            while True:
+                chunk = fp.read(1024 * 100)
+                if not chunk:
+                    break
+                hsh.update(chunk)
+        return hsh.hexdigest()
+
+
+class HashingReader(object):
+    '''
+    File like object that hashes everything read from the underlying file
+    object.
+    '''
+
+    def __init__(self, fileobj, hsh=None):
+        self.fileobj = fileobj
+        self.hsh = hsh or hashlib.sha1()
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        self.hsh.update(data)
+        return data
+
+    def hexdigest(self):
+        return self.hsh.hexdigest()
+
+
+class HashingWriter(object):
+    '''
+    File like object that hashes everything written to it before passing the
+    data on to the underlying file object.
+    '''
+
+    def __init__(self, fileobj, hsh=None):
+        self.fileobj = fileobj
+        self.hsh = hsh or hashlib.sha1()
+        self.offset = 0
+
+    def write(self, data):
+        self.hsh.update(data)
+        self.fileobj.write(data)
+        self.offset += len(data)
+
+    def tell(self):
+        return self.offset
+
+    def flush(self):
+        self.fileobj.flush()
+
+    def close(self):
+        self.fileobj.close()
+
+    def hexdigest(self):
+        return self.hsh.hexdigest()
+
+
+class RawInflateReader(object):
+    '''
+    File like object inflating a raw deflate stream, used to read a gzip
+    file from a seek point rather than from it's header.
+    '''
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+        self.buf = b''
+
+    def read(self, size=-1):
+        while (size < 0 or len(self.buf) < size) and not self.decompressor.eof:
+            chunk = self.fileobj.read(COPY_BUFSIZE)
+            if not chunk:
+                break
+            self.buf += self.decompressor.decompress(chunk)
+        if size < 0:
+            size = len(self.buf)
+        data, self.buf = self.buf[:size], self.buf[size:]
+        return data
+
+    def close(self):
+        pass
+
+
+def _deflate_block(data, level, last):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    if last:
+        return compressor.compress(data) + compressor.flush(zlib.Z_FINISH)
+    return compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH)
+
+
+class ParallelGzipWriter(object):
+    '''
+    Write a gzip file using a pool of threads, in the same way pigz does with
+    it's --independent option. Input is split into fixed size blocks which are
+    deflated independently and concatenated into a single gzip member. Each
+    block ends on a byte boundary (sync flush) so the concatenation is a valid
+    deflate stream.
+
+    Blocks do not depend on each other, so for any workers > 1 the output
+    only depends on the block size and compression level. With one worker
+    GzipCodec uses gzip.GzipFile instead, whose output differs.
+    '''
+
+    def __init__(self, filename, fileobj, mtime=0, workers=None,
+                 block_size=DEFAULT_BLOCK_SIZE, compresslevel=9):
+        self.fileobj = fileobj
+        self.workers = workers or multiprocessing.cpu_count()
+        self.block_size = block_size
+        self.compresslevel = compresslevel
+        self.pool = ThreadPool(self.workers)
+        self.pending = collections.deque()
+        self.buf = bytearray()
+        self.crc = 0
+        self.size = 0
+        self.closed = False
+        self.written = 0
+        self.points = []
+        self._write_header(filename, mtime)
+
+    def _write_header(self, filename, mtime):
+        # Matches the header written by gzip.GzipFile
+        fname = os.path.basename(filename)
+        if fname.endswith('.gz'):
+            fname = fname[:-3]
+        fname = fname.encode('latin-1')
+        if self.compresslevel == 9:
+            xfl = b'\002'
+        elif self.compresslevel == 1:
+            xfl = b'\004'
+        else:
+            xfl = b'\000'
+        flags = b'\010' if fname else b'\000'
+        self.fileobj.write(b'\037\213\010' + flags)
+        self.fileobj.write(struct.pack('<L', int(mtime)))
+        self.fileobj.write(xfl + b'\377')
+        if fname:
+            self.fileobj.write(fname + b'\000')
+
+    def write(self, data):
+        if isinstance(data, memoryview):
+            data = data.tobytes()
+        self.crc = zlib.crc32(data, self.crc)
+        self.size += len(data)
+        self.buf.extend(data)
+        while len(self.buf) > self.block_size:
+            block = bytes(self.buf[:self.block_size])
+            del self.buf[:self.block_size]
+            self._submit(block, False)
+        return len(data)
+
+    def _write_block(self, data):
+        # Blocks are deflated independently, each one is a seek point
+        self.points.append([self.written * self.block_size, self.fileobj.tell()])
+        self.fileobj.write(data)
+        self.written += 1
+
+    def _submit(self, block, last):
+        while len(self.pending) >= self.workers * 2:
+            self._write_block(self.pending.popleft().get())
+        self.pending.append(
+            self.pool.apply_async(
+                _deflate_block, (block, self.compresslevel, last)
+            )
+        )
+
+    def tell(self):
+        return self.size
+
+    def flush(self):
+        pass
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            self._submit(bytes(self.buf), True)
+            del self.buf[:]
+            while self.pending:
+                self._write_block(self.pending.popleft().get())
+        finally:
+            self.pool.close()
+            self.pool.join()
+        self.fileobj.write(struct.pack('<L', self.crc & 0xffffffff))
+        self.fileobj.write(struct.pack('<L', self.size & 0xffffffff))
+
+
+class CompressorWriter(object):
+    '''
+    Adapt a compressor object, one with compress and flush methods like
+    zlib's, to the file like interface tarfile writes to.
+    '''
+
+    def __init__(self, fileobj, compressor, header=b'', factory=None):
+        self.fileobj = fileobj
+        self.compressor = compressor
+        self.factory = factory
+        self.size = 0
+        self.closed = False
+        if header:
+            self.fileobj.write(header)
+
+    def write(self, data):
+        self.size += len(data)
+        out = self.compressor.compress(data)
+        if out:
+            self.fileobj.write(out)
+        return len(data)
+
+    def tell(self):
+        return self.size
+
+    def flush(self):
+        pass
+
+    def new_frame(self):
+        '''
+        End the current frame and start a new one with a compressor from
+        factory, the new frame can be decompressed on it's own.
+        '''
+        self.fileobj.write(self.compressor.flush())
+        self.compressor = self.factory()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.fileobj.write(self.compressor.flush())
+
+
+class ArchiveCodec(object):
+    '''
+    Base class of the archive codecs. A codec wraps the tar stream in a
+    compressing file object for writing and a decompressing one for reading.
+    Codecs must produce the same bytes every time they are given the same
+    input and options so the archive's signature is stable.
+    '''
+    name = None
+    extensions = ()
+    default_level = None
+
+    @property
+    def available(self):
+        return True
+
+    def check(self):
+        if not self.available:
+            raise CodecNotAvailable(
+                "The {} codec's module is not installed".format(self.name)
+            )
+
+    def writer(self, filename, fileobj, mtime=0, workers=1, block_size=None,
+               level=None):
+        raise NotImplementedError
+
+    def reader(self, fileobj):
+        raise NotImplementedError
+
+    def seek_point(self, writer):
+        '''
+        Make the output of writer, from here on, readable without what came
+        before it. Returns False when the codec does not support seek points.
+        '''
+        return False
+
+    def open_at(self, fileobj, offset):
+        '''
+        Return a reader of the uncompressed stream starting at the seek point
+        at offset in the compressed file.
+        '''
+        raise NotImplementedError
+
+
+class TarCodec(ArchiveCodec):
+    '''
+    Plain uncompressed tar
+    '''
+    name = 'tar'
+    extensions = ('.tar',)
+
+    def writer(self, filename, fileobj, mtime=0, workers=1, block_size=None,
+               level=None):
+        return fileobj
+
+    def reader(self, fileobj):
+        return fileobj
+
+
+class GzipCodec(ArchiveCodec):
+    '''
+    Gzip, compressed in parallel by a ParallelGzipWriter when more than one
+    worker is requested.
+    '''
+    name = 'gzip'
+    extensions = ('.tar.gz', '.tgz', '.gz')
+    default_level = 9
+
+    def writer(self, filename, fileobj, mtime=0, workers=1, block_size=None,
+               level=None):
+        level = self.default_level if level is None else level
+        if workers > 1:
+            return ParallelGzipWriter(
+                filename, fileobj, mtime=mtime, workers=workers,
+                block_size=block_size or DEFAULT_BLOCK_SIZE,
+                compresslevel=level,
+            )
+        return gzip.GzipFile(
+            filename, 'wb', compresslevel=level, fileobj=fileobj, mtime=mtime
+        )
+
+    def reader(self, fileobj):
+        return gzip.GzipFile(fileobj=fileobj, mode='rb')
+
+    def seek_point(self, writer):
+        if isinstance(writer, ParallelGzipWriter):
+            # Every block is already a seek point
+            return False
+        writer.flush(zlib.Z_FULL_FLUSH)
+        return True
+
+    def open_at(self, fileobj, offset):
+        fileobj.seek(offset)
+        return RawInflateReader(fileobj)
+
+
+class XzCodec(ArchiveCodec):
+    '''
+    Xz, slow to compress but produces the smallest archives.
+    '''
+    name = 'xz'
+    extensions = ('.tar.xz', '.txz', '.xz')
+    default_level = 6
+
+    @property
+    def available(self):
+        return lzma is not None
+
+    def writer(self, filename, fileobj, mtime=0, workers=1, block_size=None,
+               level=None):
+        self.check()
+        return lzma.LZMAFile(
+            fileobj, 'wb', format=lzma.FORMAT_XZ, check=lzma.CHECK_CRC64,
+            preset=self.default_level if level is None else level,
+        )
+
+    def reader(self, fileobj):
+        self.check()
+        return lzma.LZMAFile(fileobj, 'rb')
+
+
+class ZstdCodec(ArchiveCodec):
+    '''
+    Zstandard, compressed with long distance matching and a 128 MiB window.
+    Zstandard's multi threaded output is the same for any workers > 1. A
+    single worker also runs in threaded mode, with one thread, so it's
+    signature matches theirs.
+    '''
+    name = 'zstd'
+    extensions = ('.tar.zst', '.tzst', '.zst')
+    default_level = 3
+    window_log = 27
+
+    @property
+    def available(self):
+        return zstandard is not None
+
+    def writer(self, filename, fileobj, mtime=0, workers=1, block_size=None,
+               level=None):
+        self.check()
+        params = zstandard.ZstdCompressionParameters.from_level(
+            self.default_level if level is None else level,
+            window_log=self.window_log,
+            enable_ldm=True,
+            threads=max(workers, 1),
+            write_checksum=True,
+        )
+        cctx = zstandard.ZstdCompressor(compression_params=params)
+        return CompressorWriter(
+            fileobj, cctx.compressobj(), factory=cctx.compressobj
+        )
+
+    def reader(self, fileobj):
+        self.check()
+        dctx = zstandard.ZstdDecompressor(max_window_size=2 ** self.window_log)
+        return dctx.stream_reader(fileobj)
+
+    def seek_point(self, writer):
+        writer.new_frame()
+        return True
+
+    def open_at(self, fileobj, offset):
+        self.check()
+        fileobj.seek(offset)
+        dctx = zstandard.ZstdDecompressor(max_window_size=2 ** self.window_log)
+        return dctx.stream_reader(fileobj, read_across_frames=True)
+
+
+class Lz4Codec(ArchiveCodec):
+    '''
+    LZ4 frames, the fastest to extract.
+    '''
+    name = 'lz4'
+    extensions = ('.tar.lz4', '.lz4')
+    default_level = 0
+
+    @property
+    def available(self):
+        return HAS_LZ4
+
+    def writer(self, filename, fileobj, mtime=0, workers=1, block_size=None,
+               level=None):
+        self.check()
+        compressor = lz4.frame.LZ4FrameCompressor(
+            compression_level=self.default_level if level is None else level,
+            content_checksum=True,
+        )
+        return CompressorWriter(fileobj, compressor, compressor.begin())
+
+    def reader(self, fileobj):
+        self.check()
+        return lz4.frame.LZ4FrameFile(fileobj, 'rb')
+
+
+CODECS = {
+    'tar': TarCodec(),
+    'gzip': GzipCodec(),
+    'xz': XzCodec(),
+    'zstd': ZstdCodec(),
+    'lz4': Lz4Codec(),
+}
+DEFAULT_CODEC = 'gzip'
+
+
+def codec_for_location(location):
+    '''
+    Return the codec matching the extension of location, gzip is used when
+    the extension is not recognized.
+    '''
+    path = urlparse(location).path or location
+    matches = [
+        (len(ext), codec) for codec in CODECS.values()
+        for ext in codec.extensions if path.endswith(ext)
+    ]
+    if not matches:
+        return CODECS[DEFAULT_CODEC]
+    return sorted(matches, key=lambda x: x[0])[-1][1]
+
+
+def get_codec(name=None, location=None):
+    '''
+    Look up a codec by name, falling back to the extension of location.
+    '''
+    if isinstance(name, ArchiveCodec):
+        return name
+    if name:
+        try:
+            return CODECS[name]
+        except KeyError:
+            raise CodecNotAvailable("Unknown codec {}".format(name))
+    return codec_for_location(location or '')
+
+
+class ConsistantArchiveWriter(object):
+    '''
+    Create an gziped tar archive that will have a consistant hash as long as
+    the contents do file contents do not change. This is accomplished doing the
+    following.
+
+      - Sort all file and directory names in a consistant manner before adding
+        them to the archive
+      - Store a consistant user id, user name, group id, group name, and
+        modified time on each file.
+      - Use the same timstamp as the modified time of the archived files for
+        the gzip file header.
+
+    The archive is written in a single pass, tar blocks are streamed through
+    the codec's encoder and a hashing sink on their way to disk. The codec is
+    picked from the archive's extension unless one is given. When
+    compress_workers is greater than one gzip archives are compressed in
+    parallel by a ParallelGzipWriter, note that the resulting archive (and
+    it's signature) is different from the one created by a single worker.
+
+    When seekable is True a seek point is made before the first member after
+    every seek_interval bytes of tar stream, for the codecs which support
+    them, and the offset of every member is kept for the archive's index.
+    This changes the archive's bytes too.
+
+    The archive is written to a temporary file which replaces archivefile on
+    close, a file already at archivefile may be a hardlink of another one,
+    such as an archive in the shared cache, and is never written in place.
+
+    Files which are hardlinks of a file already in the archive are stored as
+    hardlink members of it. When dedupe is True so are files whose contents
+    are identical to a file already in the archive, only files with the size
+    of an earlier file are hashed to find them.
+    '''
+
+    def __init__(self, archivefile, default_info=DEFAULT_INFO, _mode=_writer_mode,
+                 compress_workers=1, block_size=None, codec=None,
+                 compress_level=None, hash_cache=None, algorithm=DEFAULT_HASH,
+                 seekable=False, seek_interval=DEFAULT_SEEK_INTERVAL,
+                 dedupe=False):
+        self.archivefile = archivefile
+        self.default_info = default_info
+        self.hash_cache = hash_cache
+        self.algorithm = algorithm
+        self.seekable = seekable
+        self.seek_interval = seek_interval
+        self.dedupe = dedupe
+        self.points = []
+        self.entries = []
+        # Member names by the name tarfile gave the file, to point hardlinks
+        # at the renamed member.
+        self.names = {}
+        # The members written so far, by name and by size for dedupe.
+        self.members = {}
+        self.sizes = collections.defaultdict(list)
+        self.codec = get_codec(codec, archivefile)
+        self.codec.check()
+        self.tmppath = archivefile + '.tmp'
+        self.sink = HashingWriter(
+            io.open(self.tmppath, 'wb'), new_hash(algorithm)
+        )
+        self.gz = self.codec.writer(
+            archivefile, self.sink, mtime=default_info.mtime,
+            workers=compress_workers, block_size=block_size,
+            level=compress_level,
+        )
+        self.tar = tarfile.open(
+            fileobj=PhaseWriter(self.gz, 'compress'), mode=_mode
+        )
+
+    def add_directory(self, root, prefetch=False):
+        '''
+        Add every file below root, in the order of scan_files. With prefetch
+        files are opened, and small files read, on a background thread ahead
+        of the writer so waiting on the disk overlaps with compression. This
+        pays off on cold caches and network file systems, files already in
+        the page cache are added faster without it.
+        '''
+        files = scan_files(root)
+        if not prefetch:
+            for relpath, path, entry in files:
+                with open(path, 'rb') as fp:
+                    self._add(fp, relpath)
+            return
+        prefetcher = FilePrefetcher(files)
+        try:
+            for relpath, fp, data in prefetcher:
+                with fp:
+                    self._add(fp, relpath, data)
+        finally:
+            prefetcher.close()
+
+    def _add(self, fp, newname, data=None):
+        '''
+        Add the open file fp as newname, data is it's contents when they were
+        already read.
+        '''
+        info = self.sanitize_info(self.tar.gettarinfo(fileobj=fp))
+        self.names[info.name] = newname
+        info.name = newname
+        PHASES.add('read', files=1)
+        if data is None:
+            src = PhaseReader(fp, 'read')
+        else:
+            src = io.BytesIO(data)
+        if self.seekable:
+            self.seek_point()
+        target = None
+        if info.islnk():
+            target = self.members.get(self.names.get(info.linkname))
+        elif self.dedupe and info.isreg() and info.size:
+            target = self.duplicate_of(fp.name, info.size, data)
+        if target is not None:
+            info.type = tarfile.LNKTYPE
+            info.linkname = target.path
+            info.size = 0
+            self.tar.addfile(info)
+            entry = MemberEntry(newname, target.size, target.digest, target.offset)
+            if self.hash_cache is not None and target.digest is not None:
+                self.hash_cache.record(fp.name, target.digest)
+        elif info.islnk():
+            # The file it links to was not archived as a regular member
+            info.linkname = self.names.get(info.linkname, info.linkname)
+            self.tar.addfile(info)
+            return
+        elif not info.isreg() or (
+                self.hash_cache is None and not self.seekable and
+                not self.dedupe):
+            self.tar.addfile(info, src)
+            return
+        else:
+            reader = HashingReader(src, new_hash(self.algorithm))
+            self.tar.addfile(info, reader)
+            digest = reader.hexdigest()
+            if self.hash_cache is not None:
+                self.hash_cache.record(fp.name, digest)
+            # The member's data ends on the tar offset, padded to a block
+            blocks = (info.size + tarfile.BLOCKSIZE - 1) // tarfile.BLOCKSIZE
+            entry = MemberEntry(
+                newname, info.size, digest,
+                self.tar.offset - blocks * tarfile.BLOCKSIZE,
+            )
+            self.members[newname] = entry
+            if self.dedupe:
+                self.sizes[info.size].append(entry)
+        self.entries.append(entry)
+
+    def duplicate_of(self, path, size, data=None):
+        '''
+        The member whose contents are identical to the file at path, or None.
+        '''
+        candidates = self.sizes.get(size)
+        if not candidates:
+            return None
+        if data is not None:
+            digest = new_hash(self.algorithm)
+            digest.update(data)
+            digest = digest.hexdigest()
+        elif self.hash_cache is not None:
+            digest = self.hash_cache.digest(path)
+        else:
+            digest = shasum(path, self.algorithm)
+        for entry in candidates:
+            if entry.digest == digest:
+                return entry
+        return None
+
+    def seek_point(self):
+        last = self.points[-1][0] if self.points else 0
+        if self.tar.offset - last < self.seek_interval:
+            return
+        if self.codec.seek_point(self.gz):
+            self.points.append([self.tar.offset, self.sink.tell()])
+
+    def index(self, signature):
+        '''
+        The index of the archive, the offsets of it's regular members in the
+        tar stream and the seek points of the compressed stream.
+        '''
+        points = self.points
+        if isinstance(self.gz, ParallelGzipWriter):
+            points = []
+            for point in self.gz.points:
+                last = points[-1][0] if points else 0
+                if point[0] - last >= self.seek_interval:
+                    points.append(point)
+        return {
+            'signature': signature,
+            'size': self.sink.tell(),
+            'codec': self.codec.name,
+            'members': [list(entry) for entry in self.entries],
+            'seek_points': points,
+        }
+
+    def sanitize_info(self, info):
+        for attr in ('mtime', 'uid', 'gid', 'uname', 'gname', ):
+            newval = getattr(self.default_info, attr)
+            setattr(info, attr, newval)
+        return info
+
+    def close(self):
+        self.tar.close()
+        self.gz.close()
+        self.sink.close()
+        _replace(self.tmppath, self.archivefile)
+        return format_signature(self.algorithm, self.sink.hexdigest())
+
+    def discard(self):
+        '''
+        Close the archive without keeping it.
+        '''
+        self.sink.close()
+        if os.path.exists(self.tmppath):
+            os.remove(self.tmppath)
+
+
+def create_archive(output_name, archive_directory, compress_workers=1,
+                   block_size=None, codec=None, compress_level=None,
+                   hash_cache=None, cache_dir=None, algorithm=None,
+                   seekable=False, seek_interval=DEFAULT_SEEK_INTERVAL,
+                   prefetch=False, dedupe=False):
+    '''
+    Create an archive and return it's signature. The digest of every file
+    archived is recorded in hash_cache when one is given, along with a
+    manifest of the archive in cache_dir. When seekable is True the archive
+    gets seek points and it's index is written next to it. prefetch reads
+    files on a background thread, see ConsistantArchiveWriter.add_directory.
+    With dedupe duplicate files are stored once, as hardlink members.
+    '''
+    algorithm = hash_algorithm(algorithm, hash_cache)
+    archiver = ConsistantArchiveWriter(
+        output_name, compress_workers=compress_workers, block_size=block_size,
+        codec=codec, compress_level=compress_level, hash_cache=hash_cache,
+        algorithm=algorithm, seekable=seekable, seek_interval=seek_interval,
+        dedupe=dedupe,
+    )
+    try:
+        archiver.add_directory(archive_directory, prefetch=prefetch)
+        signature = archiver.close()
+    except Exception:
+        archiver.discard()
+        raise
+    if seekable:
+        write_archive_index(archiver.index(signature), output_name)
+    elif os.path.exists(archive_index_path(output_name)):
+        # The index of an earlier version of the archive
+        os.remove(archive_index_path(output_name))
+    if hash_cache is not None:
+        write_manifest(archiver.entries, cached_manifest_path(
+            cache_dir or default_cache_dir(), signature, algorithm
+        ))
+    return signature
+
+
+def extract_archive(input_name, output_directory, codec=None,
+                    incremental=False, cache_dir=None, stats=None,
+                    hash_cache=None, algorithm=None, workers=1,
+                    links='hardlink'):
+    '''
+    Extract the archive and return it's signature. When incremental is True
+    only files which differ from those in output_directory are written, stats
+    is an optional ExtractStats to count them in. Files are written by
+    workers threads. links is how hardlink members are extracted, see
+    ConsistantArchiveReader.extract_to_directory.
+    '''
+    archiver = ConsistantArchiveReader(input_name, codec=codec)
+    algorithm = hash_algorithm(algorithm, hash_cache)
+    if hash_cache is not None:
+        signature = format_signature(algorithm, hash_cache.digest(input_name))
+    else:
+        signature = archiver.signature(algorithm)
+    if incremental:
+        cache_dir = cache_dir or default_cache_dir()
+        hash_cache = hash_cache or HashCache.in_directory(
+            cache_dir, algorithm=algorithm
+        )
+        manifest_path = cached_manifest_path(cache_dir, signature, algorithm)
+        manifest = None
+        if os.path.exists(manifest_path):
+            manifest = read_manifest(manifest_path)
+        entries = archiver.extract_to_directory(
+            output_directory, hash_cache, manifest, stats, links=links,
+        )
+        hash_cache.save()
+        if manifest is None:
+            write_manifest(entries, manifest_path)
+    else:
+        manifest = None
+        if cache_dir is not None:
+            manifest_path = cached_manifest_path(cache_dir, signature, algorithm)
+            if os.path.exists(manifest_path):
+                manifest = read_manifest(manifest_path)
+        archiver.extract_to_directory(
+            output_directory, manifest=manifest, workers=workers, links=links,
+        )
+    archiver.close()
+    return signature
+
+
+def directory_fingerprint(root, hash_cache, options=()):
+    '''
+    A digest of the paths, sizes and digests of every file below root, and
+    of options, computed from cached digests only. Returns None as soon as a
+    file is found which is not in the cache.
+    '''
+    hsh = hashlib.sha1(json.dumps(list(options)).encode('utf-8'))
+    for relpath, path, entry in scan_files(root):
+        st = entry.stat()
+        digest = hash_cache.lookup(path, st)
+        if digest is None:
+            return None
+        line = u'{} {} {}\n'.format(digest, st.st_size, relpath)
+        hsh.update(line.encode('utf-8'))
+    return hsh.hexdigest()
+
+
+def _archive_record_path(cache_dir, archive):
+    key = hashlib.sha1(os.path.abspath(archive).encode('utf-8')).hexdigest()
+    return os.path.join(cache_dir, 'archive-{}.json'.format(key))
+
+
+def archive_up_to_date(cache_dir, archive, fingerprint):
+    '''
+    The signature of archive when it was created from a directory with the
+    given fingerprint and has not been modified since, otherwise None.
+    '''
+    path = _archive_record_path(cache_dir, archive)
+    if fingerprint is None or not os.path.exists(path):
+        return None
+    try:
+        with io.open(path, 'r') as fp:
+            record = json.load(fp)
+        st = os.stat(archive)
+    except (OSError, ValueError):
+        return None
+    if record.get('fingerprint') != fingerprint:
+        return None
+    if record.get('stat') != _stat_key(st):
+        return None
+    return record.get('signature')
+
+
+def record_archive(cache_dir, archive, fingerprint, signature):
+    '''
+    Remember the fingerprint of the directory archive was created from.
+    '''
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+    record = {
+        'fingerprint': fingerprint,
+        'signature': signature,
+        'stat': _stat_key(os.stat(archive)),
+    }
+    with io.open(_archive_record_path(cache_dir, archive), 'w') as fp:
+        fp.write(u'{}'.format(json.dumps(record)))
+
+
+def directory_state(root):
+    '''
+    A digest of the paths and stat keys of every file below root. It changes
+    whenever a file is added, removed or modified, without reading any file.
+    '''
+    hsh = hashlib.sha1()
+    for relpath, path, entry in scan_files(root):
+        line = u'{} {}\n'.format(json.dumps(_stat_key(entry.stat())), relpath)
+        hsh.update(line.encode('utf-8'))
+    return hsh.hexdigest()
+
+
+def _extract_record_path(cache_dir, directory):
+    key = hashlib.sha1(os.path.abspath(directory).encode('utf-8')).hexdigest()
+    return os.path.join(cache_dir, 'extract-{}.json'.format(key))
+
+
+def extract_up_to_date(cache_dir, directory, signature):
+    '''
+    True when the archive with signature was the last one extracted to
+    directory and no file in directory has changed since.
+    '''
+    path = _extract_record_path(cache_dir, directory)
+    if not signature or not os.path.exists(path):
+        return False
+    try:
+        with io.open(path, 'r') as fp:
+            record = json.load(fp)
+    except (OSError, ValueError):
+        return False
+    if record.get('signature') != signature:
+        return False
+    return record.get('state') == directory_state(directory)
+
+
+def record_extract(cache_dir, directory, signature):
+    '''
+    Remember the archive extracted to directory and the state it left behind.
+    '''
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+    record = {
+        'signature': signature,
+        'state': directory_state(directory),
+    }
+    with io.open(_extract_record_path(cache_dir, directory), 'w') as fp:
+        fp.write(u'{}'.format(json.dumps(record)))
+
+
+def archive_manifest(archivefile, codec=None, algorithm=DEFAULT_HASH):
+    '''
+    Build a manifest of an archive by reading and hashing it's members.
+    '''
+    archiver = ConsistantArchiveReader(archivefile, codec=codec)
+    entries = []
+    found = {}
+    try:
+        for fileinfo in archiver.tar:
+            if fileinfo.islnk() and fileinfo.linkname in found:
+                entries.append(found[fileinfo.linkname]._replace(path=fileinfo.name))
+                continue
+            if not fileinfo.isreg():
+                continue
+            src = archiver.tar.extractfile(fileinfo)
+            hsh = new_hash(algorithm)
+            for chunk in iterchunks(src, 1024 * 100):
+                hsh.update(chunk)
+            entry = ManifestEntry(fileinfo.name, fileinfo.size, hsh.hexdigest())
+            found[fileinfo.name] = entry
+            entries.append(entry)
+    finally:
+        archiver.close()
+    return entries
+
+
+MemberEntry = collections.namedtuple('MemberEntry', 'path size digest offset')
+
+
+def archive_members(archivefile, codec=None, algorithm=DEFAULT_HASH):
+    '''
+    Build the member index of an archive, a list of MemberEntry holding the
+    offset of each file's data in the uncompressed tar stream. Hardlink
+    members share the offset of the member they link to.
+    '''
+    archiver = ConsistantArchiveReader(archivefile, codec=codec)
+    entries = []
+    found = {}
+    try:
+        for fileinfo in archiver.tar:
+            if fileinfo.islnk() and fileinfo.linkname in found:
+                entries.append(found[fileinfo.linkname]._replace(path=fileinfo.name))
+                continue
+            if not fileinfo.isreg():
+                continue
+            src = archiver.tar.extractfile(fileinfo)
+            hsh = new_hash(algorithm)
+            for chunk in iterchunks(src, 1024 * 100):
+                hsh.update(chunk)
+            entry = MemberEntry(
+                fileinfo.name, fileinfo.size, hsh.hexdigest(),
+                fileinfo.offset_data,
+            )
+            found[fileinfo.name] = entry
+            entries.append(entry)
+    finally:
+        archiver.close()
+    return entries
+
+
+def write_member_index(entries, filename):
+    '''
+    Write a member index to filename, each line holds the digest, size,
+    offset and path of one file.
+    '''
+    with io.open(filename, 'wb') as fp:
+        for entry in entries:
+            line = u'{} {} {} {}\n'.format(
+                entry.digest, entry.size, entry.offset, entry.path
+            )
+            fp.write(line.encode('utf-8'))
+
+
+def read_member_index(filename):
+    entries = []
+    with io.open(filename, 'rb') as fp:
+        for line in fp:
+            line = line.decode('utf-8').rstrip(u'\n')
+            if not line:
+                continue
+            digest, size, offset, path = line.split(u' ', 3)
+            entries.append(MemberEntry(path, int(size), digest, int(offset)))
+    return entries
+
+
+def cached_member_index_path(cache_dir, signature, algorithm=DEFAULT_HASH):
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+    name = 'members-{}-{}'.format(algorithm, signature.replace(':', '-'))
+    return os.path.join(cache_dir, name)
+
+
+def load_member_index(archivefile, codec, cache_dir, signature,
+                      algorithm=DEFAULT_HASH):
+    '''
+    The member index of the archive with signature, built with one pass over
+    the archive the first time and cached by signature after that.
+    '''
+    path = cached_member_index_path(cache_dir, signature, algorithm)
+    if os.path.exists(path):
+        return read_member_index(path)
+    entries = archive_members(archivefile, codec, algorithm)
+    tmppath = path + '.tmp'
+    write_member_index(entries, tmppath)
+    _replace(tmppath, path)
+    return entries
+
+
+def archive_index_path(archivefile):
+    return archivefile + '.index'
+
+
+def write_archive_index(index, archivefile):
+    '''
+    Write the index of archivefile next to it. The index's contents only
+    depend on the archive, so it is as stable as the archive's signature.
+    '''
+    with io.open(archive_index_path(archivefile), 'w') as fp:
+        fp.write(u'{}\n'.format(json.dumps(
+            index, sort_keys=True, indent=1, separators=(',', ': ')
+        )))
+
+
+def read_archive_index(archivefile, signature=None):
+    '''
+    The index written next to archivefile, or None when there is none or it
+    belongs to another version of the archive.
+    '''
+    path = archive_index_path(archivefile)
+    try:
+        with io.open(path, 'r') as fp:
+            index = json.load(fp)
+        size = os.path.getsize(archivefile)
+    except (IOError, OSError, ValueError):
+        return None
+    if index.get('size') != size:
+        return None
+    if signature and index.get('signature') != signature:
+        return None
+    return index
+
+
+def index_members(index):
+    return [MemberEntry(*member) for member in index['members']]
+
+
+class MemberReader(object):
+    '''
+    File like object reading size bytes at offset in the uncompressed tar
+    stream of an archive. Reading starts from the nearest seek point before
+    the offset, or from the start of the archive when there is none. Plain
+    tar archives are seeked directly.
+    '''
+
+    def __init__(self, archivefile, offset, size, codec=None, seek_points=()):
+        codec = get_codec(codec, archivefile)
+        self.archivefile = archivefile
+        self.remaining = size
+        self.fp = io.open(archivefile, 'rb')
+        point = None
+        for uncompressed, compressed in seek_points:
+            if uncompressed > offset:
+                break
+            point = uncompressed, compressed
+        if isinstance(codec, TarCodec):
+            self.fp.seek(offset)
+            self.fileobj = self.fp
+            skip = 0
+        elif point is not None:
+            self.fileobj = codec.open_at(self.fp, point[1])
+            skip = offset - point[0]
+        else:
+            self.fileobj = codec.reader(self.fp)
+            skip = offset
+        while skip:
+            chunk = self.fileobj.read(min(skip, COPY_BUFSIZE))
+            if not chunk:
+                break
+            skip -= len(chunk)
+
+    def read(self, size=-1):
+        if size is None or size < 0 or size > self.remaining:
+            size = self.remaining
+        if not size:
+            return b''
+        data = self.fileobj.read(size)
+        if not data:
+            raise DataPluginException(
+                "Unexpected end of archive {}".format(self.archivefile)
+            )
+        self.remaining -= len(data)
+        return data
+
+    def close(self):
+        if self.fileobj is not self.fp:
+            self.fileobj.close()
+        self.fp.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def iter_member(archivefile, offset, size, codec=None, seek_points=()):
+    '''
+    Yield the contents of the size bytes at offset in the uncompressed tar
+    stream of an archive.
+    '''
+    with MemberReader(archivefile, offset, size, codec, seek_points) as reader:
+        for chunk in iterchunks(reader, COPY_BUFSIZE):
+            yield chunk
+
+
+def _hash_path(item, algorithm=DEFAULT_HASH):
+    relpath, path = item
+    return relpath, path, shasum(path, algorithm)
+
+
+def verify_directory(root, manifest, workers=None, fail_fast=False,
+                     hash_cache=None, algorithm=None):
+    '''
+    Compare the files below root with the entries of manifest, hashing files
+    on a pool of threads. Returns a list of (problem, path) tuples where
+    problem is one of 'missing', 'changed' or 'extra'. When fail_fast is True
+    the comparison stops at the first problem found.
+    '''
+    algorithm = hash_algorithm(algorithm, hash_cache)
+    expected = dict((entry.path, entry) for entry in manifest)
+    problems = []
+    to_hash = []
+    seen = set()
+    for relpath, path, dirent in scan_files(root):
+        seen.add(relpath)
+        entry = expected.get(relpath)
+        if entry is None:
+            problems.append(('extra', relpath))
+        else:
+            st = dirent.stat()
+            if st.st_size != entry.size:
+                problems.append(('changed', relpath))
+            else:
+                digest = None
+                if hash_cache is not None:
+                    digest = hash_cache.lookup(path, st)
+                if digest is None:
+                    to_hash.append((relpath, path))
+                elif digest != entry.digest:
+                    problems.append(('changed', relpath))
+        if problems and fail_fast:
+            return problems[:1]
+    for relpath in sorted(set(expected) - seen):
+        problems.append(('missing', relpath))
+        if fail_fast:
+            return problems[:1]
+    if not to_hash:
+        return problems
+    pool = ThreadPool(workers or multiprocessing.cpu_count())
+    try:
+        hasher = partial(_hash_path, algorithm=algorithm)
+        for relpath, path, digest in pool.imap_unordered(hasher, to_hash):
+            if hash_cache is not None:
+                hash_cache.record(path, digest)
+            if digest != expected[relpath].digest:
+                problems.append(('changed', relpath))
+                if fail_fast:
+                    return problems[:1]
+    finally:
+        pool.terminate()
+        pool.join()
+    return problems
+
+
+def default_cache_dir():
+    return os.path.join(os.getcwd(), '.pytest_cache', 'dataplugin')
+
+
+def cached_manifest_path(cache_dir, signature, algorithm=DEFAULT_HASH):
+    '''
+    Path of the cached manifest, with digests using algorithm, of the archive
+    with the given signature.
+    '''
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+    name = 'manifest-{}-{}'.format(algorithm, signature.replace(':', '-'))
+    return os.path.join(cache_dir, name)
+
+
+ManifestEntry = collections.namedtuple('ManifestEntry', 'path size digest')
+
+
+class _Entry(object):
+    '''
+    The parts of os.DirEntry used by scan_files, for pythons without scandir.
+    '''
+
+    def __init__(self, dirname, name):
+        self.name = name
+        self.path = os.path.join(dirname, name)
+        self._stat = None
+
+    def is_dir(self):
+        return os.path.isdir(self.path)
+
+    def stat(self):
+        if self._stat is None:
+            self._stat = os.stat(self.path)
+        return self._stat
+
+
+def _scandir(dirname):
+    if scandir is None:
+        return [_Entry(dirname, name) for name in os.listdir(dirname)]
+    return list(scandir(dirname))
+
+
+def _entry_name(entry):
+    return entry.name
+
+
+def _split_entries(dirname):
+    '''
+    The files and the directories in dirname, sorted by name
+    '''
+    files = []
+    dirs = []
+    try:
+        entries = _scandir(dirname)
+    except OSError:
+        return files, dirs
+    for entry in entries:
+        try:
+            is_dir = entry.is_dir()
+        except OSError:
+            is_dir = False
+        if is_dir:
+            dirs.append(entry)
+        else:
+            files.append(entry)
+    files.sort(key=_entry_name)
+    dirs.sort(key=_entry_name)
+    return files, dirs
+
+
+def scan_files(root):
+    '''
+    Yield a tuple of (relative path, path, entry) for every file below root,
+    the files of a directory sorted by name followed by each of it's sub
+    directories in turn, which is the order of the members of an archive.
+    Relative paths always use forward slashes. entry is an os.DirEntry, it's
+    stat() result is cached. Symbolic links to directories are followed,
+    directories which can not be listed are skipped.
+
+    The tree is walked with a stack rather than recursion, so deep trees do
+    not hit the recursion limit, and every directory is listed once.
+    '''
+    stack = [(root, '', ())]
+    while stack:
+        dirname, prefix, parents = stack.pop()
+        PHASES.enter('walk')
+        try:
+            files, dirs = _split_entries(dirname)
+        finally:
+            PHASES.exit()
+        for entry in files:
+            yield prefix + entry.name, entry.path, entry
+        if dirs:
+            st = os.stat(dirname)
+            parents += ((st.st_dev, st.st_ino),)
+        for entry in reversed(dirs):
+            st = entry.stat()
+            if (st.st_dev, st.st_ino) in parents:
+                raise DataPluginException(
+                    "Symbolic link loop at {}".format(entry.path)
+                )
+            stack.append((entry.path, prefix + entry.name + '/', parents))
+
+
+def walk_files(root):
+    '''
+    Yield a tuple of (relative path, absolute path) for every file below root
+    in the same order ConsistantArchiveWriter adds them to an archive.
+    Relative paths always use forward slashes.
+    '''
+    for relpath, path, entry in scan_files(root):
+        yield relpath, path
+
+
+PREFETCH_BATCHES = 8
+PREFETCH_BATCH_SIZE = 1024 * 1024
+PREFETCH_BATCH_FILES = 32
+PREFETCH_FILE_LIMIT = 256 * 1024
+
+
+class FilePrefetcher(object):
+    '''
+    Open the files of scan_files on a background thread ahead of the reader.
+    Regular files up to file_limit bytes are read whole, larger ones are left
+    for the reader. Files are handed over in batches of about batch_size
+    bytes or batch_files files, at most depth batches are held ahead, which
+    bounds the number of files held open. Iterating yields a tuple of
+    relative path, open file and the file's contents, or None when they were
+    not read. Files are opened in order, so hardlinks are detected the same
+    way as without prefetching.
+    '''
+
+    def __init__(self, files, depth=PREFETCH_BATCHES,
+                 batch_size=PREFETCH_BATCH_SIZE, file_limit=PREFETCH_FILE_LIMIT,
+                 batch_files=PREFETCH_BATCH_FILES):
+        self.file_limit = file_limit
+        self.batch_size = batch_size
+        self.batch_files = batch_files
+        self.queue = queue.Queue(depth)
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, args=(files,))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _put(self, item):
+        while not self.stopped.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+            except queue.Full:
+                continue
+            return True
+        return False
+
+    def _open(self, path):
+        with PHASES.phase('read'):
+            fp = open(path, 'rb')
+            try:
+                st = os.fstat(fp.fileno())
+                if not S_ISREG(st.st_mode) or st.st_size > self.file_limit:
+                    return fp, None
+                data = fp.read()
+            except Exception:
+                fp.close()
+                raise
+        PHASES.add('read', len(data))
+        return fp, data
+
+    def _run(self, files):
+        batch = []
+        size = 0
+        try:
+            for relpath, path, entry in files:
+                fp, data = self._open(path)
+                batch.append((relpath, fp, data))
+                size += len(data) if data is not None else self.file_limit
+                if size >= self.batch_size or len(batch) >= self.batch_files:
+                    if not self._put(batch):
+                        self._close(batch)
+                        return
+                    batch = []
+                    size = 0
+        except Exception as exc:
+            self._close(batch)
+            self._put(exc)
+            return
+        if batch and not self._put(batch):
+            self._close(batch)
+            return
+        self._put(None)
+
+    def _close(self, batch):
+        for relpath, fp, data in batch:
+            fp.close()
+
+    def __iter__(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            if isinstance(item, Exception):
+                raise item
+            for entry in item:
+                yield entry
+
+    def close(self):
+        self.stopped.set()
+        self.thread.join()
+        while True:
+            try:
+                item = self.queue.get_nowait()
+            except queue.Empty:
+                break
+            if isinstance(item, list):
+                self._close(item)
+
+
+def build_manifest(root, algorithm=DEFAULT_HASH, workers=None, hash_cache=None):
+    '''
+    Return a list of ManifestEntry, one for every file below root.
+    '''
+    files = list(walk_files(root))
+    paths = [path for relpath, path in files]
+    digests = hash_files(paths, algorithm, workers, hash_cache)
+    return [
+        ManifestEntry(relpath, os.path.getsize(path), digest)
+        for (relpath, path), digest in zip(files, digests)
+    ]
+
+
+def write_manifest(entries, filename, algorithm=DEFAULT_HASH):
+    '''
+    Write a manifest to filename and return it's signature. Each line of a
+    manifest holds the digest, size and path of one file.
+    '''
+    # Replaced rather than written in place, filename may be a hardlink of
+    # the shared cache.
+    tmppath = filename + '.tmp'
+    with io.open(tmppath, 'wb') as fp:
+        for entry in entries:
+            line = u'{} {} {}\n'.format(entry.digest, entry.size, entry.path)
+            fp.write(line.encode('utf-8'))
+    _replace(tmppath, filename)
+    return file_signature(filename, algorithm)
+
+
+def read_manifest(filename):
+    '''
+    Read a manifest written by write_manifest, returns a list of ManifestEntry
+    '''
+    entries = []
+    with io.open(filename, 'rb') as fp:
+        for line in fp:
+            line = line.decode('utf-8').rstrip(u'\n')
+            if not line:
+                continue
+            digest, size, path = line.split(u' ', 2)
+            entries.append(ManifestEntry(path, int(size), digest))
+    return entries
+
+
+def _replace(src, dst):
+    if hasattr(os, 'replace'):
+        os.replace(src, dst)
+    else:
+        if os.path.exists(dst) and sys.platform.startswith('win'):
+            os.remove(dst)
+        os.rename(src, dst)
+
+
+class ChunkStore(object):
+    '''
+    A content addressed store of file blobs. Every file is stored once, named
+    by the digest of it's contents, in a directory named after the first two
+    characters of the digest.
+    '''
+
+    def __init__(self, root, algorithm=DEFAULT_HASH):
+        self.root = root
+        self.algorithm = algorithm
+
+    def path(self, digest):
+        return os.path.join(self.root, digest[:2], digest)
+
+    def has(self, digest):
+        return os.path.exists(self.path(digest))
+
+    def prepare(self, digest):
+        '''
+        Make sure the directory for digest exists and return the blob's path
+        '''
+        path = self.path(digest)
+        dirname = os.path.dirname(path)
+        if not os.path.exists(dirname):
+            os.makedirs(dirname)
+        return path
+
+    def add(self, filename, digest):
+        if self.has(digest):
+            return False
+        tmppath = self.prepare(digest) + '.tmp'
+        copy_file(filename, tmppath)
+        self.commit(tmppath, digest)
+        return True
+
+    def commit(self, tmppath, digest, verify=False):
+        '''
+        Move a temporary file into the store, when verify is True the file's
+        contents are checked against digest first.
+        '''
+        if verify and shasum(tmppath, self.algorithm) != digest:
+            os.remove(tmppath)
+            raise BlobVerificationFailed(
+                "Blob {} failed verification".format(digest)
+            )
+        _replace(tmppath, self.path(digest))
+
+    def materialize(self, digest, filename):
+        dirname = os.path.dirname(filename)
+        if dirname and not os.path.exists(dirname):
+            os.makedirs(dirname)
+        copy_file(self.path(digest), filename)
+
+
+# Linux FICLONE ioctl, share the extents of one file with another
+FICLONE = 0x40049409
+
+_LINK_FALLBACK_ERRNOS = _COPY_FALLBACK_ERRNOS + tuple(
+    getattr(errno, name) for name in ('ENOTTY', 'EPERM', 'EMLINK')
+    if hasattr(errno, name)
+)
+
+
+def _reflink(src, dst):
+    with io.open(src, 'rb') as fsrc:
+        with io.open(dst, 'wb') as fdst:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+
+
+def _copy(src, dst):
+    copy_file(src, dst)
+
+
+def _link_methods():
+    methods = []
+    if fcntl is not None and sys.platform.startswith('linux'):
+        methods.append(_reflink)
+    if hasattr(os, 'link'):
+        methods.append(os.link)
+    methods.append(_copy)
+    return methods
+
+
+def link_file(src, dst):
+    '''
+    Materialize the file at src as dst sharing it's data on disk when the file
+    system allows it. A reflink is tried first, then a hardlink, falling back
+    to a copy. Returns the name of the method which worked.
+    '''
+    dirname = os.path.dirname(dst)
+    if dirname and not os.path.exists(dirname):
+        os.makedirs(dirname)
+    tmppath = dst + '.tmp'
+    for method in _link_methods():
+        if os.path.exists(tmppath):
+            os.remove(tmppath)
+        try:
+            method(src, tmppath)
+        except (IOError, OSError) as exc:
+            if exc.errno not in _LINK_FALLBACK_ERRNOS:
+                raise
+            continue
+        _replace(tmppath, dst)
+        return method.__name__.strip('_')
+
+
+class SharedCache(object):
+    '''
+    A machine wide cache of archives named by their signature, shared by every
+    checkout configured with the same directory. Jobs fetching the same
+    archive are serialized with file locks, so it is only downloaded once.
+    Once the archives take more than max_size bytes the least recently used
+    ones are evicted.
+    '''
+
+    # Archives are named by their signature, anything else in the archives
+    # directory, such as sidecar files kept next to them, is not an archive.
+    archive_re = re.compile(r'^(?:[a-z0-9]+-)?[0-9a-f]+$')
+    sidecars = ('.used', '.etag', '.index')
+
+    def __init__(self, root, max_size=DEFAULT_SHARED_CACHE_SIZE):
+        self.root = os.path.expanduser(root)
+        self.max_size = max_size
+        self.archives = os.path.join(self.root, 'archives')
+
+    @staticmethod
+    def name(signature):
+        return signature.replace(':', '-')
+
+    def path(self, signature):
+        return os.path.join(self.archives, self.name(signature))
+
+    def has(self, signature):
+        return os.path.exists(self.path(signature))
+
+    @contextlib.contextmanager
+    def lock(self, name, blocking=True):
+        '''
+        Hold an exclusive lock named name, yields False when blocking is False
+        and another process holds the lock.
+        '''
+        dirname = os.path.join(self.root, 'locks')
+        if not os.path.exists(dirname):
+            os.makedirs(dirname)
+        with io.open(os.path.join(dirname, name + '.lock'), 'ab') as fp:
+            if fcntl is None:
+                yield True
+                return
+            flags = fcntl.LOCK_EX
+            if not blocking:
+                flags |= fcntl.LOCK_NB
+            try:
+                fcntl.flock(fp.fileno(), flags)
+            except (IOError, OSError) as exc:
+                if exc.errno not in (errno.EAGAIN, errno.EACCES):
+                    raise
+                yield False
+                return
+            try:
+                yield True
+            finally:
+                fcntl.flock(fp.fileno(), fcntl.LOCK_UN)
+
+    def touch(self, signature):
+        '''
+        Mark the archive as used now. The time is kept on a separate file, an
+        archive hardlinked into a checkout keeps it's own modified time.
+        '''
+        used = self.path(signature) + '.used'
+        with io.open(used, 'ab'):
+            pass
+        os.utime(used, None)
+
+    def fetch(self, signature, download):
+        '''
+        Return a tuple of the path of the archive with signature and whether
+        it was already cached. Archives which are not cached are stored by
+        calling download with the path to write them to.
+        '''
+        path = self.path(signature)
+        with self.lock(self.name(signature)):
+            hit = os.path.exists(path)
+            if not hit:
+                if not os.path.exists(self.archives):
+                    os.makedirs(self.archives)
+                download(path)
+            self.touch(signature)
+        if not hit:
+            self.evict(keep=signature)
+        return path, hit
+
+    def entries(self):
+        '''
+        A list of (last used, size, name) for every cached archive
+        '''
+        entries = []
+        if not os.path.exists(self.archives):
+            return entries
+        for name in os.listdir(self.archives):
+            if not self.archive_re.match(name):
+                continue
+            path = os.path.join(self.archives, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            try:
+                used = os.stat(path + '.used').st_mtime
+            except OSError:
+                used = st.st_mtime
+            entries.append((used, st.st_size, name))
+        return entries
+
+    def evict(self, keep=None):
+        '''
+        Remove the least recently used archives until the cache fits in
+        max_size. Archives in use by another job are left alone.
+        '''
+        keep = keep and self.name(keep)
+        removed = []
+        with self.lock('evict'):
+            entries = sorted(self.entries())
+            total = sum(size for used, size, name in entries)
+            for used, size, name in entries:
+                if total <= self.max_size:
+                    break
+                if name == keep:
+                    continue
+                with self.lock(name, blocking=False) as locked:
+                    if not locked:
+                        continue
+                    path = os.path.join(self.archives, name)
+                    for filename in [path] + [path + s for s in self.sidecars]:
+                        if os.path.exists(filename):
+                            os.remove(filename)
+                total -= size
+                removed.append(name)
+        return removed
+
+
+class ExtractStats(object):
+    '''
+    Counts of the files and bytes written, skipped and removed by an
+    incremental extract.
+    '''
+
+    def __init__(self):
+        self.written = 0
+        self.written_bytes = 0
+        self.skipped = 0
+        self.skipped_bytes = 0
+        self.removed = 0
+        self.removed_bytes = 0
+
+    def __str__(self):
+        return (
+            "wrote {} files ({} bytes), skipped {} files ({} bytes), "
+            "removed {} files ({} bytes)"
+        ).format(
+            self.written, self.written_bytes, self.skipped, self.skipped_bytes,
+            self.removed, self.removed_bytes,
+        )
+
+
+def _stat_key(st):
+    return [st.st_size, getattr(st, 'st_mtime_ns', st.st_mtime), st.st_ino]
+
+
+class HashCache(object):
+    '''
+    A persistent cache of file digests keyed by the file's path, size,
+    modified time and inode. A file whose stat still matches is known to be
+    unchanged without reading it. The cache keeps at most max_entries files,
+    evicting the least recently used. When rescan is True cached digests are
+    ignored, but new ones are still recorded.
+    '''
+
+    def __init__(self, path, max_entries=DEFAULT_HASH_CACHE_SIZE, rescan=False,
+                 algorithm=DEFAULT_HASH):
+        self.path = path
+        self.algorithm = algorithm
+        self.max_entries = max_entries
+        self.rescan = rescan
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict()
+        if os.path.exists(self.path):
+            try:
+                with io.open(self.path, 'r') as fp:
+                    for item in json.load(fp):
+                        self.entries[item[0]] = item[1:]
+            except (ValueError, IndexError, TypeError):
+                self.entries = collections.OrderedDict()
+
+    @classmethod
+    def in_directory(cls, cache_dir, algorithm=DEFAULT_HASH, **kwargs):
+        if algorithm == DEFAULT_HASH:
+            name = 'hashes.json'
+        else:
+            name = 'hashes-{}.json'.format(algorithm)
+        return cls(os.path.join(cache_dir, name), algorithm=algorithm, **kwargs)
+
+    def lookup(self, path, st=None):
+        '''
+        The cached digest of path, or None when the file has changed or is
+        not in the cache.
+        '''
+        if self.rescan:
+            return None
+        path = os.path.abspath(path)
+        if st is None:
+            try:
+                st = os.stat(path)
+            except OSError:
+                return None
+        with self.lock:
+            record = self.entries.get(path)
+            if record is None or record[:3] != _stat_key(st):
+                return None
+            # Move the entry to the end, it is the most recently used
+            del self.entries[path]
+            self.entries[path] = record
+        return record[3]
+
+    def record(self, path, digest, st=None):
+        path = os.path.abspath(path)
+        st = st or os.stat(path)
+        with self.lock:
+            self.entries.pop(path, None)
+            self.entries[path] = _stat_key(st) + [digest]
+
+    def forget(self, path):
+        with self.lock:
+            self.entries.pop(os.path.abspath(path), None)
+
+    def digest(self, path):
+        '''
+        Digest of the file at path, read from the cache when possible.
+        '''
+        st = os.stat(path)
+        digest = self.lookup(path, st)
+        if digest is None:
+            digest = shasum(path, self.algorithm)
+            self.record(path, digest, st)
+        return digest
+
+    def save(self):
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+        dirname = os.path.dirname(self.path)
+        if dirname and not os.path.exists(dirname):
+            os.makedirs(dirname)
+        tmppath = self.path + '.tmp'
+        with io.open(tmppath, 'w') as fp:
+            fp.write(u'{}'.format(json.dumps(
+                [[path] + record for path, record in self.entries.items()]
+            )))
+        _replace(tmppath, self.path)
+
+
+class DirectoryMaker(object):
+    '''
+    Creates the directories files are extracted to, remembering the ones
+    already made so extracting many files does not check their directory
+    every time.
+    '''
+
+    def __init__(self, root):
+        self.root = root
+        self.made = set()
+
+    def make(self, relpath):
+        '''
+        Make the directory relpath, relative to root with forward slashes,
+        and it's parents.
+        '''
+        if relpath in self.made:
+            return
+        path = member_path(self.root, relpath) if relpath else self.root
+        if not os.path.isdir(path):
+            try:
+                os.makedirs(path)
+            except OSError as exc:
+                # Another thread extracting to the same tree made it first
+                if exc.errno != errno.EEXIST:
+                    raise
+        while relpath not in self.made:
+            self.made.add(relpath)
+            relpath = posixpath.dirname(relpath)
+
+    def make_all(self, paths):
+        '''
+        Make the directories of every file in paths at once.
+        '''
+        for dirname in sorted(set(posixpath.dirname(path) for path in paths)):
+            self.make(dirname)
+
+
+def member_path(root, name):
+    '''
+    The path below root of name, an archive member name with forward slashes.
+    Names which are absolute or would resolve outside of root are rejected
+    before anything is written.
+    '''
+    root = os.path.normpath(root)
+    path = os.path.normpath(os.path.join(root, *name.split('/')))
+    if path != root and not path.startswith(os.path.join(root, '')):
+        raise DataPluginException(
+            "Archive member {} is outside of {}".format(name, root)
+        )
+    return path
+
+
+def _write_file(path, data, unshare=False):
+    if unshare:
+        _unshare(path)
+    with io.open(path, 'wb') as fp:
+        fp.write(data)
+
+
+def _unshare(path):
+    '''
+    Remove the file at path when it has other hardlinks, writing to it in
+    place would change them too.
+    '''
+    try:
+        st = os.lstat(path)
+    except OSError:
+        return
+    if st.st_nlink > 1:
+        os.remove(path)
+
+
+def link_member(root, relpath, linkname, links='hardlink'):
+    '''
+    Make the file relpath, below root, a hardlink of the file linkname or,
+    when links is 'copy' or hardlinks are not supported, a copy of it.
+    Like relpath, linkname must be below root.
+    '''
+    path = member_path(root, relpath)
+    source = member_path(root, linkname)
+    if os.path.lexists(path):
+        os.remove(path)
+    if links == 'hardlink':
+        try:
+            os.link(source, path)
+            return
+        except (AttributeError, OSError):
+            if not os.path.exists(source):
+                raise
+    copy_file(source, path)
+
+
+def _write_new(src, path, algorithm=DEFAULT_HASH):
+    hsh = new_hash(algorithm)
+    with io.open(path, 'wb') as dst:
+        for chunk in iterchunks(src, 1024 * 100):
+            hsh.update(chunk)
+            dst.write(chunk)
+    return hsh.hexdigest()
+
+
+def _patch_existing(src, path, algorithm=DEFAULT_HASH):
+    '''
+    Compare src with the file at path of the same size, rewriting the file
+    from the first chunk which differs. Returns the digest of src and whether
+    the file was changed.
+    '''
+    hsh = new_hash(algorithm)
+    changed = False
+    with io.open(path, 'r+b') as dst:
+        for chunk in iterchunks(src, 1024 * 100):
+            hsh.update(chunk)
+            if not changed:
+                pos = dst.tell()
+                if dst.read(len(chunk)) == chunk:
+                    continue
+                changed = True
+                dst.seek(pos)
+            dst.write(chunk)
+    return hsh.hexdigest(), changed
+
+
+def extract_member(root, relpath, size, expected, opener, hash_cache, stats):
+    '''
+    Incrementally extract one file to root and return it's digest. opener is
+    only called, to get a file object of the member's contents, when the file
+    on disk can not be proven identical from the hash cache.
+    '''
+    path = member_path(root, relpath)
+    try:
+        st = os.stat(path)
+    except OSError:
+        st = None
+    if st is not None and st.st_size == size:
+        current = hash_cache.lookup(path, st)
+        if expected is not None and current == expected:
+            stats.skipped += 1
+            stats.skipped_bytes += size
+            return expected
+    if st is not None and st.st_nlink > 1:
+        # Writing in place would change the file's other hardlinks too
+        os.remove(path)
+        st = None
+    if st is not None and st.st_size == size:
+        with contextlib.closing(opener()) as src:
+            digest, changed = _patch_existing(src, path, hash_cache.algorithm)
+    else:
+        dirname = os.path.dirname(path)
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        with contextlib.closing(opener()) as src:
+            digest, changed = _write_new(src, path, hash_cache.algorithm), True
+    if changed:
+        stats.written += 1
+        stats.written_bytes += size
+    else:
+        stats.skipped += 1
+        stats.skipped_bytes += size
+    hash_cache.record(path, digest)
+    return digest
+
+
+def extract_link(root, relpath, target, links, hash_cache, stats):
+    '''
+    Incrementally extract the hardlink member relpath of target, the
+    ManifestEntry of the file it links to, which is already extracted.
+    '''
+    path = member_path(root, relpath)
+    try:
+        st = os.stat(path)
+    except OSError:
+        st = None
+    if st is not None:
+        if links == 'hardlink':
+            current = os.path.samestat(
+                st, os.stat(member_path(root, target.path))
+            )
+        else:
+            current = (
+                st.st_nlink == 1 and hash_cache.lookup(path, st) == target.digest
+            )
+        if current:
+            stats.skipped += 1
+            stats.skipped_bytes += target.size
+            return
+    else:
+        dirname = os.path.dirname(path)
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+    link_member(root, relpath, target.path, links)
+    stats.written += 1
+    stats.written_bytes += target.size
+    hash_cache.record(path, target.digest)
+
+
+def remove_extra_files(root, keep, hash_cache, stats):
+    '''
+    Remove the files below root whose relative paths are not in keep, then
+    remove any directories left empty.
+    '''
+    for relpath, path in list(walk_files(root)):
+        if relpath in keep:
+            continue
+        stats.removed += 1
+        stats.removed_bytes += os.path.getsize(path)
+        os.remove(path)
+        hash_cache.forget(path)
+    for dirname, dirs, files in os.walk(root, topdown=False):
+        if dirname != root and not os.listdir(dirname):
+            os.rmdir(dirname)
+
+
+def blob_location(location, digest):
+    '''
+    Location of a blob in shared storage, blobs are kept in an objects
+    directory next to the manifest.
+    '''
+    if urlparse(location).scheme:
+        return '/'.join([location.rsplit('/', 1)[0], 'objects', digest])
+    return os.path.join(os.path.dirname(location), 'objects', digest)
+
+
+def create_chunked(output_name, archive_directory, store, hash_cache=None,
+                   workers=None):
+    '''
+    Add the files of archive_directory to the chunk store and write a
+    manifest of them to output_name. Returns the manifest's signature. Files
+    are hashed with the store's algorithm on a pool of workers threads.
+    '''
+    entries = build_manifest(
+        archive_directory, store.algorithm, workers, hash_cache
+    )
+    for entry in entries:
+        store.add(
+            os.path.join(archive_directory, *entry.path.split('/')), entry.digest
+        )
+    return write_manifest(entries, output_name, store.algorithm)
+
+
+def extract_chunked(input_name, output_directory, store, incremental=False,
+                    cache_dir=None, stats=None, hash_cache=None, workers=1):
+    '''
+    Materialize the files listed in a manifest from the chunk store into
+    output_directory, on workers threads. Returns the manifest's signature.
+    '''
+    entries = read_manifest(input_name)
+    if not incremental:
+        DirectoryMaker(output_directory).make_all(e.path for e in entries)
+        jobs = [
+            (store.path(e.digest),
+             os.path.join(output_directory, *e.path.split('/')))
+            for e in entries
+        ]
+        pool = ThreadPool(workers)
+        try:
+            pool.map(lambda job: copy_file(*job), jobs)
+        finally:
+            pool.close()
+            pool.join()
+        return file_signature(input_name, store.algorithm)
+    stats = stats if stats is not None else ExtractStats()
+    hash_cache = hash_cache or HashCache.in_directory(
+        cache_dir or default_cache_dir(), algorithm=store.algorithm
+    )
+    for entry in entries:
+        extract_member(
+            output_directory, entry.path, entry.size, entry.digest,
+            partial(io.open, store.path(entry.digest), 'rb'), hash_cache, stats,
+        )
+    remove_extra_files(
+        output_directory, set(e.path for e in entries), hash_cache, stats
+    )
+    hash_cache.save()
+    return file_signature(input_name, store.algorithm)
+
+
+def _unique_digests(manifest):
+    seen = set()
+    for entry in read_manifest(manifest):
+        if entry.digest not in seen:
+            seen.add(entry.digest)
+            yield entry.digest
+
+
+def _upload_missing(remote, filename, exists):
+    if exists(remote):
+        return False
+    UPLOADER_SCHEMAS[urlparse(remote).scheme](remote, filename)
+    return True
+
+
+def upload_chunks(location, manifest, store):
+    '''
+    Upload the blobs of a manifest which are missing from shared storage,
+    concurrently on the transfer engine. Returns a tuple of the number of
+    blobs uploaded and the total number of blobs in the manifest.
+    '''
+    exists = EXISTS_SCHEMAS.get(urlparse(location).scheme)
+    jobs = []
+    for digest in _unique_digests(manifest):
+        remote = blob_location(location, digest)
+        jobs.append((remote, partial(
+            _upload_missing, remote, store.path(digest), exists
+        )))
+    return sum(transfer_files(jobs)), len(jobs)
+
+
+def _download_blob(remote, store, digest):
+    tmppath = store.prepare(digest) + '.tmp'
+    DOWNLOADER_SCHEMAS[urlparse(remote).scheme](remote, tmppath)
+    store.commit(tmppath, digest, verify=True)
+
+
+def download_chunks(location, manifest, store):
+    '''
+    Download the blobs of a manifest which are missing from the local chunk
+    store, concurrently on the transfer engine. Returns a tuple of the number
+    of blobs downloaded and the total number of blobs in the manifest.
+    '''
+    jobs = []
+    total = 0
+    for digest in _unique_digests(manifest):
+        total += 1
+        if store.has(digest):
+            continue
+        remote = blob_location(location, digest)
+        jobs.append((remote, partial(_download_blob, remote, store, digest)))
+    transfer_files(jobs)
+    return len(jobs), total
+
+
+def shard_location(location, name):
+    '''
+    Location of a shard in shared storage, shards are kept in a shards
+    directory next to the index.
+    '''
+    if urlparse(location).scheme:
+        return '/'.join([location.rsplit('/', 1)[0], 'shards', name])
+    return os.path.join(os.path.dirname(location), 'shards', name)
+
+
+def _shard_prefix(relpath):
+    if '/' in relpath:
+        return relpath.split('/', 1)[0]
+    return '.'
+
+
+def plan_shards(root, by='directory', shard_size=DEFAULT_SHARD_SIZE):
+    '''
+    Split the files below root into shards. Returns a list of shards, lists
+    of (relative path, absolute path) tuples in archive order. Files are
+    grouped by their top level directory, files directly in root share a
+    shard, or when by is 'size' into shards of about shard_size bytes.
+    '''
+    if by not in SHARD_METHODS:
+        raise DataPluginException("Unknown shard method {}".format(by))
+    shards = []
+    current = []
+    key = None
+    size = 0
+    for relpath, path, entry in scan_files(root):
+        if by == 'size':
+            filesize = entry.stat().st_size
+            if current and size + filesize > shard_size:
+                shards.append(current)
+                current, size = [], 0
+            size += filesize
+        else:
+            prefix = _shard_prefix(relpath)
+            if current and prefix != key:
+                shards.append(current)
+                current = []
+            key = prefix
+        current.append((relpath, path))
+    if current:
+        shards.append(current)
+    return shards
+
+
+def _write_shard(shard_dir, codec, algorithm, hash_cache, number, files):
+    # Every shard is written as 'shard' plus the codec's extension, the name
+    # ends up in the gzip header so identical shards get identical bytes.
+    ext = codec.extensions[0]
+    tmpdir = os.path.join(shard_dir, '.tmp-{}'.format(number))
+    if not os.path.exists(tmpdir):
+        os.makedirs(tmpdir)
+    tmppath = os.path.join(tmpdir, 'shard' + ext)
+    archiver = ConsistantArchiveWriter(
+        tmppath, codec=codec, algorithm=algorithm, hash_cache=hash_cache,
+    )
+    for relpath, path in files:
+        with open(path, 'rb') as fp:
+            archiver._add(fp, relpath)
+    signature = archiver.close()
+    name = signature.replace(':', '-') + ext
+    _replace(tmppath, os.path.join(shard_dir, name))
+    os.rmdir(tmpdir)
+    return {
+        'name': name,
+        'signature': signature,
+        'prefixes': sorted(set(_shard_prefix(relpath) for relpath, _ in files)),
+        'files': len(files),
+        'size': sum(os.path.getsize(path) for _, path in files),
+    }
+
+
+def create_sharded(output_name, archive_directory, shard_dir, by='directory',
+                   shard_size=DEFAULT_SHARD_SIZE, codec=None,
+                   algorithm=None, workers=1, hash_cache=None):
+    '''
+    Write the files of archive_directory to shard archives in shard_dir, on
+    workers threads, and an index of the shards to output_name. Shards are
+    named by their signature and the index lists every shard's signature, so
+    the index's signature covers all of the data. Returns the signature of
+    the index. The digest of every file is recorded in hash_cache when one
+    is given.
+    '''
+    algorithm = hash_algorithm(algorithm, hash_cache)
+    codec = get_codec(codec, output_name)
+    codec.check()
+    if not os.path.exists(shard_dir):
+        os.makedirs(shard_dir)
+    shards = plan_shards(archive_directory, by, shard_size)
+    pool = ThreadPool(max(min(workers, len(shards)), 1))
+    try:
+        entries = pool.map(
+            lambda item: _write_shard(
+                shard_dir, codec, algorithm, hash_cache, *item
+            ),
+            list(enumerate(shards)),
+        )
+    finally:
+        pool.close()
+        pool.join()
+    index = {
+        'algorithm': algorithm,
+        'codec': codec.name,
+        'shards': entries,
+    }
+    tmppath = output_name + '.tmp'
+    with io.open(tmppath, 'w') as fp:
+        fp.write(u'{}\n'.format(json.dumps(
+            index, sort_keys=True, indent=1, separators=(',', ': ')
+        )))
+    _replace(tmppath, output_name)
+    return file_signature(output_name, algorithm)
+
+
+def read_shard_index(filename):
+    with io.open(filename, 'r') as fp:
+        return json.load(fp)
+
+
+def shards_present(input_name, shard_dir):
+    '''
+    Whether every shard listed in the index input_name is in shard_dir
+    '''
+    try:
+        index = read_shard_index(input_name)
+    except (IOError, OSError, ValueError):
+        return False
+    return all(
+        os.path.exists(os.path.join(shard_dir, shard['name']))
+        for shard in index['shards']
+    )
+
+
+def select_shards(index, prefixes=None):
+    '''
+    The shards of index holding any of the top level directories in
+    prefixes, all shards when no prefixes are given.
+    '''
+    if not prefixes:
+        return list(index['shards'])
+    prefixes = set(prefixes)
+    return [
+        shard for shard in index['shards'] if prefixes & set(shard['prefixes'])
+    ]
+
+
+def extract_sharded(input_name, output_directory, shard_dir, prefixes=None,
+                    workers=1, hash_cache=None):
+    '''
+    Extract the shards listed in the index input_name, or only those holding
+    prefixes, to output_directory. Every shard is verified before any of it
+    is extracted, with digests from hash_cache when it uses the index's
+    algorithm. Shards are extracted concurrently on workers threads. Returns
+    the number of shards extracted.
+    '''
+    index = read_shard_index(input_name)
+    shards = select_shards(index, prefixes)
+    if hash_cache is not None and hash_cache.algorithm != index['algorithm']:
+        hash_cache = None
+    if not os.path.isdir(output_directory):
+        os.makedirs(output_directory)
+
+    def extract(shard):
+        path = os.path.join(shard_dir, shard['name'])
+        if hash_cache is not None:
+            signature = format_signature(
+                index['algorithm'], hash_cache.digest(path)
+            )
+        else:
+            signature = file_signature(path, index['algorithm'])
+        if signature != shard['signature']:
+            raise BlobVerificationFailed(
+                "Shard {} failed verification".format(shard['name'])
+            )
+        extract_archive(
+            path, output_directory, codec=index['codec'],
+            algorithm=index['algorithm'], hash_cache=hash_cache,
+        )
+
+    pool = ThreadPool(max(min(workers, len(shards)), 1))
+    try:
+        pool.map(extract, shards)
+    finally:
+        pool.close()
+        pool.join()
+    return len(shards)
+
+
+def sharded_manifest(input_name, shard_dir, prefixes=None,
+                     algorithm=DEFAULT_HASH):
+    '''
+    The manifest of the files in the shards listed in the index input_name,
+    or only those holding prefixes. Returns None when a shard is missing
+    from shard_dir.
+    '''
+    index = read_shard_index(input_name)
+    entries = []
+    for shard in select_shards(index, prefixes):
+        path = os.path.join(shard_dir, shard['name'])
+        if not os.path.exists(path):
+            return None
+        entries.extend(
+            archive_manifest(path, codec=index['codec'], algorithm=algorithm)
+        )
+    return sorted(entries, key=lambda entry: entry.path)
+
+
+def upload_shards(location, index_file, shard_dir):
+    '''
+    Upload the shards listed in the index which are missing from shared
+    storage. Returns a tuple of the number of shards uploaded and the total
+    number of shards.
+    '''
+    exists = EXISTS_SCHEMAS.get(urlparse(location).scheme)
+    jobs = []
+    for shard in read_shard_index(index_file)['shards']:
+        remote = shard_location(location, shard['name'])
+        jobs.append((remote, partial(
+            _upload_missing, remote, os.path.join(shard_dir, shard['name']),
+            exists,
+        )))
+    return sum(transfer_files(jobs)), len(jobs)
+
+
+def _download_shard(remote, shard_dir, shard, algorithm):
+    path = os.path.join(shard_dir, shard['name'])
+    tmppath = path + '.tmp'
+    DOWNLOADER_SCHEMAS[urlparse(remote).scheme](remote, tmppath)
+    if file_signature(tmppath, algorithm) != shard['signature']:
+        os.remove(tmppath)
+        raise BlobVerificationFailed(
+            "Shard {} failed verification".format(shard['name'])
+        )
+    _replace(tmppath, path)
+
+
+def download_shards(location, index_file, shard_dir, prefixes=None):
+    '''
+    Download the shards listed in the index, or only those holding prefixes,
+    which are missing from shard_dir. Returns a tuple of the number of shards
+    downloaded and the number of shards selected.
+    '''
+    index = read_shard_index(index_file)
+    shards = select_shards(index, prefixes)
+    if not os.path.exists(shard_dir):
+        os.makedirs(shard_dir)
+    jobs = []
+    for shard in shards:
+        if os.path.exists(os.path.join(shard_dir, shard['name'])):
+            continue
+        remote = shard_location(location, shard['name'])
+        jobs.append((remote, partial(
+            _download_shard, remote, shard_dir, shard, index['algorithm'],
+        )))
+    transfer_files(jobs)
+    return len(jobs), len(shards)
+
+
+class ArchiveSource(object):
+    '''
+    The files of an archive, read at their offsets from it's member index.
+    The digests of entries are made with algorithm.
+    '''
+
+    def __init__(self, archivefile, entries, codec=None, seek_points=(),
+                 algorithm=DEFAULT_HASH):
+        self.archivefile = archivefile
+        self.algorithm = algorithm
+        self.codec = codec
+        self.seek_points = seek_points
+        self.entries = dict((entry.path, entry) for entry in entries)
+
+    def entry(self, path):
+        return self.entries.get(path)
+
+    def chunks(self, entry):
+        return iter_member(
+            self.archivefile, entry.offset, entry.size, self.codec,
+            self.seek_points,
+        )
+
+
+class ChunkSource(object):
+    '''
+    The files of a chunked manifest, read from the chunk store.
+    '''
+
+    def __init__(self, manifest, store):
+        self.store = store
+        self.algorithm = store.algorithm
+        self.entries = dict((entry.path, entry) for entry in manifest)
+
+    def entry(self, path):
+        return self.entries.get(path)
+
+    def chunks(self, entry):
+        with io.open(self.store.path(entry.digest), 'rb') as fp:
+            for chunk in iterchunks(fp, COPY_BUFSIZE):
+                yield chunk
+
+
+class ShardSource(object):
+    '''
+    The files of a sharded archive. A file is read from the shard holding
+    it's top level directory, through the shard's member index.
+    '''
+
+    def __init__(self, index_file, shard_dir, cache_dir):
+        self.index = read_shard_index(index_file)
+        self.algorithm = self.index['algorithm']
+        self.shard_dir = shard_dir
+        self.cache_dir = cache_dir
+        self.sources = {}
+
+    def _source(self, shard):
+        if shard['name'] not in self.sources:
+            path = os.path.join(self.shard_dir, shard['name'])
+            if not os.path.exists(path):
+                raise DataPluginException(
+                    "Shard {} is not downloaded".format(shard['name'])
+                )
+            entries = load_member_index(
+                path, self.index['codec'], self.cache_dir, shard['signature'],
+                self.index['algorithm'],
+            )
+            self.sources[shard['name']] = ArchiveSource(
+                path, entries, self.index['codec'], algorithm=self.algorithm,
+            )
+        return self.sources[shard['name']]
+
+    def entry(self, path):
+        for shard in select_shards(self.index, [_shard_prefix(path)]):
+            entry = self._source(shard).entry(path)
+            if entry is not None:
+                return entry
+        return None
+
+    def chunks(self, entry):
+        for shard in select_shards(self.index, [_shard_prefix(entry.path)]):
+            source = self._source(shard)
+            if source.entry(entry.path) is not None:
+                return source.chunks(entry)
+
+
+class LazyData(object):
+    '''
+    The object behind the dataplugin fixture. A file of the data archive is
+    materialized in the data directory the first time a test asks for it's
+    path, files already there with the right digest are left alone. The
+    files asked for are recorded in used.
+    '''
+
+    def __init__(self, root, source, hash_cache):
+        self.root = root
+        self.source = source
+        self.hash_cache = hash_cache
+        self.used = set()
+        self.lock = threading.Lock()
+
+    def path(self, name):
+        '''
+        The path of name, relative to the data directory with forward
+        slashes, materialized from the archive when needed.
+        '''
+        name = posixpath.normpath(name.replace(os.sep, '/')).lstrip('/')
+        if name.startswith('../'):
+            raise DataPluginException("{} is outside the data directory".format(name))
+        entry = self.source.entry(name)
+        if entry is None:
+            raise DataPluginException("{} is not in the data archive".format(name))
+        path = os.path.join(self.root, *name.split('/'))
+        with self.lock:
+            self.used.add(name)
+            if os.path.exists(path) and self.digest(path) == entry.digest:
+                return path
+            dirname = os.path.dirname(path)
+            if not os.path.isdir(dirname):
+                os.makedirs(dirname)
+            tmppath = path + '.tmp'
+            hsh = new_hash(self.source.algorithm)
+            with io.open(tmppath, 'wb') as dst:
+                for chunk in self.source.chunks(entry):
+                    hsh.update(chunk)
+                    dst.write(chunk)
+            if hsh.hexdigest() != entry.digest:
+                os.remove(tmppath)
+                raise BlobVerificationFailed(
+                    "{} failed verification".format(name)
+                )
+            _replace(tmppath, path)
+            if self.source.algorithm == self.hash_cache.algorithm:
+                self.hash_cache.record(path, entry.digest)
+        return path
+
+    def digest(self, path):
+        '''
+        The digest of the file at path with the source's algorithm, from the
+        hash cache when it uses the same one.
+        '''
+        if self.source.algorithm == self.hash_cache.algorithm:
+            return self.hash_cache.digest(path)
+        return shasum(path, self.source.algorithm)
+
+
+def find_signature(path, signature_re):
+    with io.open(path, 'r') as fp:
+        for line in fp:
+            if signature_re.search(line):
+                found = True
+                break
+        else:
+            return False
+    return True
+
+
+def update_signature(newsig, origpath, signature_re):
+    '''
+    Update the archive signature in the doc string of this file.
+    '''
+    basename = os.path.basename(origpath)
+    dirname = os.path.dirname(origpath)
+    tmppath = os.path.join(dirname, '.' + basename)
+    found = False
+    with open(origpath) as fp:
+        with open(tmppath, 'w') as nfp:
+            for line in fp:
+                if signature_re.search(line):
+                    line = 'dataplugin-signature = {}\n'.format(newsig)
+                    found = True
+                nfp.write(line)
+    if not found:
+        raise SignatureNotFound("Signature not found in config")
+    os.rename(tmppath, origpath)
+
+
+def pytest_addoption(parser):
+    parser.addoption(
+        "--dataplugin-create",
+        action='store_true',
+        default=False,
+        help='Create an archive based on the contents of the data direcory',
+    )
+    parser.addoption(
+        "--dataplugin-extract",
+        action='store_true',
+        default=False,
+        help='Extract the archive to the data directory',
+    )
+    parser.addoption(
+        "--dataplugin-upload",
+        action='store_true',
+        default=False,
+        help=(
+            'Upload the archive to shared storage, this will also update the '
+            'signature in the local config file'
+        )
+    )
+    parser.addoption(
+        "--dataplugin-download",
+        action='store_true',
+        default=False,
+        help='Download the newest archive from shared storage',
+    )
+    parser.addoption(
+        "--dataplugin-download-extract",
+        action='store_true',
+        default=False,
+        help=(
+            'Download the newest archive from shared storage and extract it '
+            'when it changed'
+        ),
+    )
+    parser.addoption(
+        "--dataplugin-fetch",
+        action='store_true',
+        default=False,
+        help=(
+            'Extract the newest archive to the data directory while it is '
+            'downloaded, without keeping a local copy of the archive'
+        ),
+    )
+    parser.addoption(
+        "--dataplugin-report",
+        action='store',
+        default=None,
+        help='Write the time spent in each phase of the action to a json file',
+    )
+    parser.addoption(
+        "--dataplugin-shards",
+        action='store',
+        default=None,
+        help=(
+            'Comma separated top level directories of the data directory, '
+            'only the shards holding them are downloaded and extracted'
+        ),
+    )
+    parser.addoption(
+        "--dataplugin-incremental",
+        action='store_true',
+        default=False,
+        help=(
+            'Only write the files which changed when extracting and remove '
+            'files which are no longer in the archive'
+        ),
+    )
+    parser.addoption(
+        "--dataplugin-verify-directory",
+        action='store_true',
+        default=False,
+        help=(
+            'Verify the contents of the data directory against the manifest '
+            'of the archive'
+        ),
+    )
+    parser.addoption(
+        "--dataplugin-fail-fast",
+        action='store_true',
+        default=False,
+        help='Stop verifying the data directory at the first difference',
+    )
+    parser.addoption(
+        "--dataplugin-rescan",
+        action='store_true',
+        default=False,
+        help=(
+            'Ignore cached file hashes and read every file in the data '
+            'directory again'
+        ),
+    )
+    parser.addoption(
+        "--dataplugin-verify",
+        action='store_true',
+        default=False,
+        help=(
+            'Verify the signature of the archive against the contents of '
+            'the data directory'
+        ),
+    )
+
+
+def pytest_cmdline_preparse(config, args):
+    # TODO: Update opts to show config and environment defaults
+    # print(config.inifile)
+    pass
+
+
+SIZE_SUFFIXES = {
+    'k': 1024,
+    'm': 1024 ** 2,
+    'g': 1024 ** 3,
+}
+
+
+def parse_size(value):
+    '''
+    Parse a size setting in bytes, with an optional K, M or G suffix.
+    '''
+    value = str(value).strip().lower().rstrip('ib').rstrip('b')
+    if value and value[-1] in SIZE_SUFFIXES:
+        return int(float(value[:-1]) * SIZE_SUFFIXES[value[-1]])
+    return int(value)
+
+
+def parse_workers(value):
+    '''
+    Parse a worker count setting, 'auto' means one worker per cpu.
+    '''
+    if str(value).strip().lower() == 'auto':
+        return multiprocessing.cpu_count()
+    return max(int(value), 1)
+
+
+def parse_limits(value):
+    '''
+    Parse per scheme limits, e.g. 's3:16, smb:2', into a dict. The scheme of
+    local paths is named 'file'.
+    '''
+    limits = {}
+    for item in value.replace(',', ' ').split():
+        scheme, limit = item.split(':', 1)
+        limits[scheme] = parse_workers(limit)
+    return limits
+
+
+def is_true(value):
+    return str(value).strip().lower() in ('1', 'true', 'yes', 'on')
+
+
+def plugin_cache_dir(config):
+    '''
+    The directory the dataplugin keeps it's cache files in, inside pytest's
+    cache directory.
+    '''
+    cache = getattr(config, 'cache', None)
+    if cache is not None:
+        return str(cache.makedir('dataplugin'))
+    return os.path.join(str(config.rootdir), '.pytest_cache', 'dataplugin')
+
+
+def get_hash_cache():
+    '''
+    The HashCache used by dataplugin actions in this session
+    '''
+    if STATE['hash_cache'] is None:
+        STATE['hash_cache'] = HashCache.in_directory(
+            STATE['cache_dir'] or default_cache_dir(),
+            max_entries=STATE['hash_cache_size'],
+            rescan=STATE['rescan'],
+            algorithm=STATE['hash'],
+        )
+    return STATE['hash_cache']
+
+
+def get_shared_cache():
+    '''
+    The machine wide SharedCache, or None when it is not configured
+    '''
+    if not STATE['shared_cache']:
+        return None
+    return SharedCache(STATE['shared_cache'], STATE['shared_cache_size'])
+
+
+def get_transfer_engine():
+    '''
+    The engine running transfers for this session. The asyncio engine is used
+    when it is available, on python 2 transfers run on a thread pool.
+    '''
+    try:
+        from dataplugin_aio import AsyncTransferEngine as engine_class
+    except (ImportError, SyntaxError):
+        engine_class = ThreadTransferEngine
+    return engine_class(
+        concurrency=STATE['transfer_concurrency'],
+        limits=STATE['transfer_limits'],
+        retries=STATE['transfer_retries'],
+        backoff=STATE['transfer_backoff'],
+    )
+
+
+def get_data_source():
+    '''
+    The source lazily materialized files are read from, for the configured
+    layout.
+    '''
+    archive = '.' + STATE['filename']
+    if not os.path.exists(archive):
+        raise DataPluginException(
+            "No local archive {}, run pytest --dataplugin-download".format(archive)
+        )
+    if STATE['layout'] == 'chunks':
+        return ChunkSource(read_manifest(archive), get_chunk_store())
+    if STATE['layout'] == 'shards':
+        return ShardSource(archive, get_shard_dir(), STATE['cache_dir'])
+    hash_cache = get_hash_cache()
+    signature = format_signature(hash_cache.algorithm, hash_cache.digest(archive))
+    index = read_archive_index(archive, signature)
+    if index is not None:
+        return ArchiveSource(
+            archive, index_members(index), index['codec'], index['seek_points'],
+            hash_cache.algorithm,
+        )
+    entries = load_member_index(
+        archive, STATE['codec'], STATE['cache_dir'], signature,
+        hash_cache.algorithm,
+    )
+    return ArchiveSource(
+        archive, entries, STATE['codec'], algorithm=hash_cache.algorithm,
+    )
+
+
+def get_shard_dir():
+    return os.path.join(STATE['store'], 'shards')
+
+
+def get_chunk_store():
+    return ChunkStore(STATE['store'], algorithm=STATE['hash'])
+
+
+def archive_options():
+    '''
+    The settings which change the bytes of a created archive
+    '''
+    return [
+        STATE['codec'], STATE['compress_workers'] > 1, STATE['block_size'],
+        STATE['compress_level'], STATE['hash'],
+        STATE['seekable'] and STATE['seek_interval'], STATE['dedupe'],
+    ]
+
+
+def load_manifest():
+    '''
+    The manifest of the data matching the configured signature. For archives
+    it is read from the cache, or built from the local archive when it's
+    signature matches. Returns None when no manifest can be found.
+    '''
+    archive = '.' + STATE['filename']
+    if not STATE['signature']:
+        return None
+    if STATE['layout'] == 'chunks':
+        if not os.path.exists(archive):
+            return None
+        if not verify_data_archive(archive, STATE['signature'], get_hash_cache()):
+            return None
+        return read_manifest(archive)
+    if STATE['layout'] == 'shards':
+        if not os.path.exists(archive):
+            return None
+        if not verify_data_archive(archive, STATE['signature'], get_hash_cache()):
+            return None
+        return sharded_manifest(
+            archive, get_shard_dir(), STATE['shards'], STATE['hash']
+        )
+    path = cached_manifest_path(
+        STATE['cache_dir'], STATE['signature'], STATE['hash']
+    )
+    if os.path.exists(path):
+        return read_manifest(path)
+    if not os.path.exists(archive):
+        return None
+    if not verify_data_archive(archive, STATE['signature'], get_hash_cache()):
+        return None
+    entries = archive_manifest(
+        archive, codec=STATE['codec'], algorithm=STATE['hash']
+    )
+    write_manifest(entries, path)
+    return entries
+
+
+def pytest_configure(config):
+    STATE['directory'] = config.inicfg.get(
+        'dataplugin-directory', os.path.join(str(config.rootdir), 'data')
+    )
+    STATE['signature'] = config.inicfg.get('dataplugin-signature')
+    STATE['location'] = config.inicfg.get('dataplugin-location', STATE['location'])
+    STATE['filename'] = os.path.basename(STATE['location'])
+    STATE['inifile'] = config.inifile
+    STATE['signature_re'] = re.compile(SIGNATURE_RE)
+    STATE['compress_workers'] = parse_workers(
+        config.inicfg.get('dataplugin-compress-workers', STATE['compress_workers'])
+    )
+    block_size = config.inicfg.get('dataplugin-compress-block-size')
+    if block_size:
+        STATE['block_size'] = int(block_size)
+    compress_level = config.inicfg.get('dataplugin-compress-level')
+    if compress_level:
+        STATE['compress_level'] = int(compress_level)
+    STATE['cache_dir'] = plugin_cache_dir(config)
+    STATE['incremental'] = (
+        getattr(config.option, 'dataplugin_incremental', False) or
+        is_true(config.inicfg.get('dataplugin-incremental', False))
+    )
+    STATE['rescan'] = getattr(config.option, 'dataplugin_rescan', False)
+    STATE['hash_cache_size'] = int(config.inicfg.get(
+        'dataplugin-hash-cache-size', STATE['hash_cache_size']
+    ))
+    STATE['hash_cache'] = None
+    STATE['hash_workers'] = parse_workers(
+        config.inicfg.get('dataplugin-hash-workers', 'auto')
+    )
+    STATE['fail_fast'] = getattr(config.option, 'dataplugin_fail_fast', False)
+    STATE['hash'] = config.inicfg.get('dataplugin-hash', DEFAULT_HASH)
+    STATE['s3_endpoint_url'] = config.inicfg.get('dataplugin-s3-endpoint-url')
+    STATE['s3_part_size'] = parse_size(config.inicfg.get(
+        'dataplugin-s3-part-size', STATE['s3_part_size']
+    ))
+    STATE['s3_multipart_threshold'] = parse_size(config.inicfg.get(
+        'dataplugin-s3-multipart-threshold', STATE['s3_multipart_threshold']
+    ))
+    STATE['s3_max_concurrency'] = parse_workers(config.inicfg.get(
+        'dataplugin-s3-max-concurrency', STATE['s3_max_concurrency']
+    ))
+    STATE['extract_workers'] = parse_workers(
+        config.inicfg.get('dataplugin-extract-workers', STATE['extract_workers'])
+    )
+    STATE['transfer_concurrency'] = parse_workers(config.inicfg.get(
+        'dataplugin-transfer-concurrency', STATE['transfer_concurrency']
+    ))
+    STATE['transfer_limits'] = parse_limits(
+        config.inicfg.get('dataplugin-transfer-limits', '')
+    )
+    STATE['transfer_retries'] = int(config.inicfg.get(
+        'dataplugin-transfer-retries', STATE['transfer_retries']
+    ))
+    STATE['transfer_backoff'] = float(config.inicfg.get(
+        'dataplugin-transfer-backoff', STATE['transfer_backoff']
+    ))
+    STATE['http_max_connections'] = parse_workers(config.inicfg.get(
+        'dataplugin-http-max-connections', STATE['http_max_connections']
+    ))
+    STATE['shared_cache'] = os.environ.get(
+        SHARED_CACHE_ENV, config.inicfg.get('dataplugin-shared-cache')
+    )
+    STATE['shared_cache_size'] = parse_size(config.inicfg.get(
+        'dataplugin-shared-cache-size', STATE['shared_cache_size']
+    ))
+    STATE['seekable'] = is_true(
+        config.inicfg.get('dataplugin-seekable', STATE['seekable'])
+    )
+    STATE['seek_interval'] = parse_size(config.inicfg.get(
+        'dataplugin-seek-interval', STATE['seek_interval']
+    ))
+    STATE['layout'] = config.inicfg.get('dataplugin-layout', STATE['layout'])
+    STATE['store'] = config.inicfg.get('dataplugin-store', STATE['store'])
+    STATE['shard_by'] = config.inicfg.get('dataplugin-shard-by', STATE['shard_by'])
+    STATE['shard_size'] = parse_size(config.inicfg.get(
+        'dataplugin-shard-size', STATE['shard_size']
+    ))
+    shards = (
+        getattr(config.option, 'dataplugin_shards', None) or
+        config.inicfg.get('dataplugin-shards')
+    )
+    STATE['shards'] = shards.replace(',', ' ').split() if shards else None
+    STATE['report'] = getattr(config.option, 'dataplugin_report', None)
+    STATE['prefetch'] = is_true(
+        config.inicfg.get('dataplugin-prefetch', STATE['prefetch'])
+    )
+    STATE['dedupe'] = is_true(
+        config.inicfg.get('dataplugin-dedupe', STATE['dedupe'])
+    )
+    STATE['extract_links'] = config.inicfg.get(
+        'dataplugin-extract-links', STATE['extract_links']
+    )
+    progress = config.inicfg.get('dataplugin-progress', 'auto')
+    if progress == 'auto':
+        STATE['progress'] = sys.stderr.isatty()
+    else:
+        STATE['progress'] = is_true(progress)
+    PHASES.reset()
+    try:
+        STATE['codec'] = get_codec(
+            config.inicfg.get('dataplugin-codec'), STATE['location']
+        ).name
+    except CodecNotAvailable as exc:
+        raise pytest.UsageError(str(exc))
+    for option, value, choices in (
+            ('layout', STATE['layout'], LAYOUTS),
+            ('shard-by', STATE['shard_by'], SHARD_METHODS),
+            ('extract-links', STATE['extract_links'], EXTRACT_LINKS)):
+        if value not in choices:
+            raise pytest.UsageError(
+                "Unknown dataplugin-{} {}, expected one of {}".format(
+                    option, value, ', '.join(choices)
+                )
+            )
+    for action in ACTIONS:
+        if getattr(config.option, 'dataplugin_{}'.format(action.replace('-', '_')), False):
+            break
+    else:
+        action = NOOP
+    STATE['action'] = action
+    if STATE['action'] == NOOP:
+        return
+    # Fail early when the configured hash algorithm is not available
+    try:
+        new_hash(STATE['hash'])
+        parse_signature(STATE['signature'] or '')
+    except HashNotAvailable as exc:
+        raise pytest.UsageError(str(exc))
+    urlprs = urlparse(STATE['location'])
+
+
+def pytest_sessionstart(session):
+    if STATE['action'] == NOOP:
+        return
+
+
+def pytest_collectstart(collector):
+    if STATE['action'] == NOOP:
+        return
+    tw.line("dataplugin {} invoked, skipping collection.".format(STATE['action']), bold=True)
+
+
+@pytest.hookimpl(tryfirst=True)
+def pytest_collectreport(report):
+    if STATE['action'] == NOOP:
+        return
+    return True
+
+
+def pytest_ignore_collect(path, config):
+    if STATE['action'] == NOOP:
+        return
+    config.option.verbose = -1
+    return True
+
+
+@pytest.hookimpl(tryfirst=True)
+def pytest_collection_modifyitems(session, config, items):
+    if STATE['action'] == NOOP:
+        return
+    return True
+
+
+@pytest.fixture(scope='session')
+def dataplugin(request):
+    '''
+    Materialize files of the data archive on demand, dataplugin.path(name)
+    returns the path of name in the data directory. The files used during
+    the session are written to used-files.json in the dataplugin's cache
+    directory.
+    '''
+    hash_cache = get_hash_cache()
+    data = LazyData(STATE['directory'], get_data_source(), hash_cache)
+    yield data
+    hash_cache.save()
+    if not os.path.exists(STATE['cache_dir']):
+        os.makedirs(STATE['cache_dir'])
+    with io.open(os.path.join(STATE['cache_dir'], 'used-files.json'), 'w') as fp:
+        fp.write(u'{}'.format(json.dumps(sorted(data.used))))
+
+
+def iterchunks(fp, size, progress=NULL_PROGRESS):
+    for chunk in iter(partial(fp.read, size), b''):
+        progress.update(len(chunk))
+        yield chunk
+
+
+def download_data():
+    '''
+    Download the data for the configured signature. The download is skipped
+    when the local archive already matches the signature, returns True when
+    the archive was downloaded. With a shared cache configured the archive is
+    downloaded into the cache once and linked into the checkout.
+    '''
+    archive = '.' + STATE['filename']
+    hash_cache = get_hash_cache()
+    shared = get_shared_cache()
+    if os.path.exists(archive) and verify_data_archive(
+            archive, STATE['signature'], hash_cache):
+        tw.line("Local archive matches signature, skipping download", green=True)
+        downloaded = False
+    elif shared is not None and STATE['signature']:
+        path, hit = shared.fetch(STATE['signature'], partial(
+            download_file, STATE['location'], signature=STATE['signature'],
+        ))
+        if hit:
+            tw.line("Using archive from shared cache {}".format(shared.root))
+        link_file(path, archive)
+        algorithm, hexdigest = parse_signature(STATE['signature'])
+        if hash_cache.algorithm == algorithm:
+            hash_cache.record(archive, hexdigest)
+        downloaded = True
+    else:
+        download_file(STATE['location'], archive, STATE['signature'], hash_cache)
+        downloaded = True
+    hash_cache.save()
+    if (STATE['seekable'] and STATE['layout'] == 'archive' and
+            read_archive_index(archive, STATE['signature']) is None):
+        # Archives uploaded without an index still work, members are then
+        # found by reading the archive once.
+        location = archive_index_path(STATE['location'])
+        exists = EXISTS_SCHEMAS.get(urlparse(location).scheme)
+        if exists is None or exists(location):
+            download_file(location, archive_index_path(archive))
+        else:
+            tw.line("No index found for {}".format(STATE['location']))
+    if STATE['layout'] == 'chunks':
+        fetched, total = download_chunks(
+            STATE['location'], archive, get_chunk_store(),
+        )
+        tw.line("Downloaded {} of {} blobs".format(fetched, total))
+    elif STATE['layout'] == 'shards':
+        fetched, total = download_shards(
+            STATE['location'], archive, get_shard_dir(), STATE['shards'],
+        )
+        tw.line("Downloaded {} of {} shards".format(fetched, total))
+    if downloaded:
+        tw.line("file downloaded", green=True)
+    return downloaded
+
+
+def fetch_data():
+    '''
+    Extract the archive at the configured location straight to the data
+    directory and record the extract, returns the archive's signature.
+    '''
+    tw.line("Fetching archive: {}".format(STATE['location']), bold=True)
+    signature = fetch_archive(
+        STATE['location'], STATE['directory'], STATE['signature'],
+        codec=STATE['codec'], algorithm=STATE['hash'],
+        workers=STATE['extract_workers'], links=STATE['extract_links'],
+    )
+    record_extract(STATE['cache_dir'], STATE['directory'], signature)
+    tw.line("Archive extracted, hash is {}".format(signature), green=True)
+    return signature
+
+
+def extract_data():
+    '''
+    Extract the local archive to the data directory and return it's
+    signature. The state of the directory is recorded, so download-extract
+    can tell when it is up to date.
+    '''
+    stats = ExtractStats()
+    archive = '.' + STATE['filename']
+    shared = get_shared_cache()
+    if (shared is not None and STATE['signature'] and
+            not os.path.exists(archive) and shared.has(STATE['signature'])):
+        archive = shared.path(STATE['signature'])
+        shared.touch(STATE['signature'])
+    if STATE['layout'] == 'chunks':
+        sha1 = extract_chunked(
+            archive, STATE['directory'],
+            get_chunk_store(), incremental=STATE['incremental'],
+            cache_dir=STATE['cache_dir'], stats=stats,
+            hash_cache=get_hash_cache(), workers=STATE['extract_workers'],
+        )
+    elif STATE['layout'] == 'shards':
+        extracted = extract_sharded(
+            archive, STATE['directory'], get_shard_dir(), STATE['shards'],
+            workers=STATE['extract_workers'], hash_cache=get_hash_cache(),
+        )
+        sha1 = format_signature(STATE['hash'], get_hash_cache().digest(archive))
+        tw.line("Extracted {} shards".format(extracted))
+    else:
+        sha1 = extract_archive(
+            archive, STATE['directory'], codec=STATE['codec'],
+            incremental=STATE['incremental'], cache_dir=STATE['cache_dir'],
+            stats=stats, hash_cache=get_hash_cache(),
+            workers=STATE['extract_workers'], links=STATE['extract_links'],
+        )
+    get_hash_cache().save()
+    recorded = sha1
+    if STATE['signature']:
+        algorithm = parse_signature(STATE['signature'])[0]
+        if algorithm != parse_signature(sha1)[0]:
+            # A legacy signature of another algorithm, the extract is
+            # recorded under it so the next run finds it up to date.
+            recorded = file_signature(archive, algorithm)
+    record_extract(STATE['cache_dir'], STATE['directory'], recorded)
+    if STATE['incremental']:
+        tw.line("Incremental extract {}".format(stats))
+    tw.line(
+        "Extracted archive {} with hash {}".format(
+            STATE['filename'], sha1
+        ),
+        green=True
+    )
+    return sha1
+
+
+def pytest_runtestloop(session):
+    if STATE['action'] == NOOP:
+        return
+    STATE['return_code'] = 1
+    if (STATE['action'] in ('extract', 'download-extract') and
+            STATE['incremental'] and STATE['layout'] == 'shards'):
+        tw.line(
+            "Incremental extract is not supported by the shards layout",
+            red=True,
+        )
+        return True
+    if STATE['action'] == 'create':
+        abspath = os.path.abspath(STATE['directory'])
+        if os.path.exists(abspath):
+            tw.line(
+                "Creating archive {} from directory {}".format(
+                    STATE['filename'], abspath
+                ), bold=True
+            )
+            hash_cache = get_hash_cache()
+            archive = '.' + STATE['filename']
+            if STATE['layout'] == 'chunks':
+                sha1 = create_chunked(
+                    archive, abspath, get_chunk_store(),
+                    hash_cache=hash_cache, workers=STATE['hash_workers'],
+                )
+            else:
+                options = archive_options()
+                if STATE['layout'] == 'shards':
+                    options += [
+                        STATE['layout'], STATE['shard_by'], STATE['shard_size'],
+                    ]
+                sha1 = archive_up_to_date(
+                    STATE['cache_dir'], archive,
+                    directory_fingerprint(abspath, hash_cache, options),
+                )
+                if (sha1 and STATE['layout'] == 'shards' and
+                        not shards_present(archive, get_shard_dir())):
+                    sha1 = None
+                if sha1:
+                    hash_cache.save()
+                    tw.line(
+                        "Archive is up to date, name is {} and hash is {}".format(
+                            STATE['filename'], sha1
+                        ),
+                        green=True
+                    )
+                    STATE['return_code'] = 0
+                    return True
+                if STATE['layout'] == 'shards':
+                    sha1 = create_sharded(
+                        archive, abspath, get_shard_dir(),
+                        by=STATE['shard_by'], shard_size=STATE['shard_size'],
+                        codec=STATE['codec'], algorithm=STATE['hash'],
+                        workers=STATE['compress_workers'],
+                        hash_cache=hash_cache,
+                    )
+                else:
+                    sha1 = create_archive(
+                        archive, abspath,
+                        compress_workers=STATE['compress_workers'],
+                        block_size=STATE['block_size'],
+                        codec=STATE['codec'],
+                        compress_level=STATE['compress_level'],
+                        hash_cache=hash_cache, cache_dir=STATE['cache_dir'],
+                        seekable=STATE['seekable'],
+                        seek_interval=STATE['seek_interval'],
+                        prefetch=STATE['prefetch'], dedupe=STATE['dedupe'],
+                    )
+                record_archive(
+                    STATE['cache_dir'], archive,
+                    directory_fingerprint(abspath, hash_cache, options), sha1,
+                )
+            hash_cache.save()
             tw.line(
                 "Archive createded, name is {} and hash is {}".format(
                     STATE['filename'], sha1
@@ -406,13 +4225,7 @@ def pytest_runtestloop(session):
             tw.line("Directory does not exist {}".format(abspath), red=True)
             return True
     elif STATE['action'] == 'extract':
-        sha1 = extract_archive('.' + STATE['filename'], STATE['directory'])
-        tw.line(
-            "Extracted archive {} with hash {}".format(
-                STATE['filename'], sha1
-            ),
-            green=True
-        )
+        extract_data()
         STATE['return_code'] = 0
     elif STATE['action'] == 'upload':
         if STATE['inifile'] is None:
@@ -422,10 +4235,25 @@ def pytest_runtestloop(session):
             tw.line("Signature not found in ini file {}".format(STATE['inifile']), red=True)
             return True
         cache_filename = '.' + STATE['filename']
+        if STATE['layout'] == 'chunks':
+            uploaded, total = upload_chunks(
+                STATE['location'], cache_filename, get_chunk_store()
+            )
+            tw.line("Uploaded {} of {} blobs".format(uploaded, total))
+        elif STATE['layout'] == 'shards':
+            uploaded, total = upload_shards(
+                STATE['location'], cache_filename, get_shard_dir()
+            )
+            tw.line("Uploaded {} of {} shards".format(uploaded, total))
         transfer_file(
             STATE['location'], cache_filename, UPLOADER_SCHEMAS
         )
-        STATE['signature'] = shasum(cache_filename)
+        if STATE['seekable'] and os.path.exists(archive_index_path(cache_filename)):
+            transfer_file(
+                archive_index_path(STATE['location']),
+                archive_index_path(cache_filename), UPLOADER_SCHEMAS,
+            )
+        STATE['signature'] = file_signature(cache_filename, STATE['hash'])
         STATE['return_code'] = 0
         tw.line(
             "Uploaded archive {} with hash {}".format(
@@ -444,20 +4272,84 @@ def pytest_runtestloop(session):
             ),
             green=True
         )
-    elif STATE['action'] == 'download':
+    elif STATE['action'] in ('download', 'download-extract'):
+        if STATE['inifile'] is None:
+            tw.line("No ini file configured.", red=True)
+            return True
+        elif not find_signature(str(STATE['inifile']), STATE['signature_re']):
+            tw.line("Signature not found in ini file {}".format(STATE['inifile']), red=True)
+            return True
+        try:
+            downloaded = download_data()
+        except DownloadVerificationFailed as exc:
+            tw.line(str(exc), red=True)
+            return True
+        if STATE['action'] == 'download-extract':
+            if not downloaded and extract_up_to_date(
+                    STATE['cache_dir'], STATE['directory'], STATE['signature']):
+                tw.line(
+                    "Directory {} is up to date with hash {}".format(
+                        STATE['directory'], STATE['signature']
+                    ),
+                    green=True
+                )
+            else:
+                extract_data()
+        STATE['return_code'] = 0
+    elif STATE['action'] == 'fetch':
         if STATE['inifile'] is None:
             tw.line("No ini file configured.", red=True)
             return True
         elif not find_signature(str(STATE['inifile']), STATE['signature_re']):
             tw.line("Signature not found in ini file {}".format(STATE['inifile']), red=True)
             return True
-        transfer_file(
-            STATE['location'], '.' + STATE['filename'], DOWNLOADER_SCHEMAS
-        )
-        tw.line("file downloaded", green=True)
+        elif STATE['layout'] != 'archive':
+            tw.line(
+                "Fetch is not supported by the {} layout".format(STATE['layout']),
+                red=True,
+            )
+            return True
+        if extract_up_to_date(
+                STATE['cache_dir'], STATE['directory'], STATE['signature']):
+            tw.line(
+                "Directory {} is up to date with hash {}".format(
+                    STATE['directory'], STATE['signature']
+                ),
+                green=True
+            )
+        else:
+            try:
+                fetch_data()
+            except DownloadVerificationFailed as exc:
+                tw.line(str(exc), red=True)
+                return True
         STATE['return_code'] = 0
+    elif STATE['action'] == 'verify-directory':
+        manifest = load_manifest()
+        if manifest is None:
+            tw.line(
+                "No manifest found for signature {}".format(STATE['signature']),
+                red=True,
+            )
+            return True
+        problems = verify_directory(
+            STATE['directory'], manifest, workers=STATE['hash_workers'],
+            fail_fast=STATE['fail_fast'], hash_cache=get_hash_cache(),
+        )
+        get_hash_cache().save()
+        for problem, path in problems:
+            tw.line("{}: {}".format(problem, path), red=True)
+        if problems:
+            tw.line("Directory failed verification!", red=True)
+        else:
+            tw.line("Directory passed verification :)", green=True)
+            STATE['return_code'] = 0
     else:
-        if verify_data_archive('.' + STATE['filename'], STATE['signature']):
+        verified = verify_data_archive(
+            '.' + STATE['filename'], STATE['signature'], get_hash_cache()
+        )
+        get_hash_cache().save()
+        if verified:
             tw.line("Archive passed verification :)", green=True)
             STATE['return_code'] = 0
         else:
@@ -470,9 +4362,27 @@ def pytest_sessionfinish(session, exitstatus):
     """ whole test run finishes. """
     if STATE['action'] == NOOP:
         return
+    if STATE['report']:
+        write_report(STATE['report'])
     return True
 
 
+def write_report(path):
+    '''
+    Write the time spent in each phase of the action to a json file at path.
+    '''
+    dirname = os.path.dirname(path)
+    if dirname and not os.path.exists(dirname):
+        os.makedirs(dirname)
+    with io.open(path, 'w') as fp:
+        fp.write(u'{}\n'.format(json.dumps({
+            'action': STATE['action'],
+            'signature': STATE['signature'],
+            'return_code': STATE['return_code'],
+            'phases': PHASES.report(),
+        }, sort_keys=True, indent=1, separators=(',', ': '))))
+
+
 @pytest.hookimpl(tryfirst=True)
 def pytest_terminal_summary(terminalreporter, exitstatus):
     '''
@@ -483,6 +4393,10 @@ def pytest_terminal_summary(terminalreporter, exitstatus):
     if STATE['action'] == NOOP:
         return
     terminalreporter.verbosity = -2
+    if PHASES.phases:
+        terminalreporter.write_sep('-', 'dataplugin {}'.format(STATE['action']))
+        for line in PHASES.lines():
+            terminalreporter.write_line(line)
 
 
 def local_downloader(location, filename):
@@ -490,10 +4404,7 @@ def local_downloader(location, filename):
     retrieve the file to a location on the localhost
     '''
     tw.line("Storing local archive: {}".format(location), bold=True)
-    with io.open(filename, 'rb') as src:
-        with io.open(filename, 'wb') as dst:
-            for chunk in iterchunks(src, 1024 * 100):
-                dst.write(chunk)
+    copy_file(location, filename)
 
 
 def smb_downloader(location, filename):
@@ -506,39 +4417,194 @@ def smb_downloader(location, filename):
     src = director.open(location)
     try:
         with io.open(filename, 'wb') as dst:
-            while True:
-                chunk = src.read(1024 * 100)
-                if not chunk:
-                    break
-                dst.write(chunk)
+            with start_progress('Downloading {}'.format(location)) as progress:
+                while True:
+                    chunk = src.read(1024 * 100)
+                    if not chunk:
+                        break
+                    dst.write(chunk)
+                    progress.update(len(chunk))
     finally:
         src.close()
 
 
 def boto3_downloader(location, filename):
-    import boto3
-    's3://bucket/path'
+    '''
+    retrieve the file from an s3 location, s3://bucket/path. Objects larger
+    than the multipart threshold are fetched with parallel ranged GETs.
+    '''
+    bucket, key, client = boto3_client(location)
+    total = boto3_size(location) if STATE['progress'] else None
+    with start_progress('Downloading {}'.format(location), total) as progress:
+        client.download_file(
+            bucket, key, filename, Config=s3_transfer_config(),
+            Callback=progress.update,
+        )
+
+
+class HTTPConnectionPool(object):
+    '''
+    Idle keep-alive connections to one server, handed out to one request at
+    a time so they can be shared by threads.
+    '''
+
+    def __init__(self, scheme, host, port):
+        self.scheme = scheme
+        self.host = host
+        self.port = port
+        self.idle = []
+        self.lock = threading.Lock()
+
+    def get(self):
+        '''
+        Return a tuple of a connection and whether it was reused
+        '''
+        with self.lock:
+            if self.idle:
+                return self.idle.pop(), True
+        if self.scheme == 'https':
+            conn = httplib.HTTPSConnection(self.host, self.port, timeout=HTTP_TIMEOUT)
+        else:
+            conn = httplib.HTTPConnection(self.host, self.port, timeout=HTTP_TIMEOUT)
+        return conn, False
+
+    def put(self, conn):
+        with self.lock:
+            self.idle.append(conn)
+
+
+_HTTP_POOLS = {}
+_HTTP_POOLS_LOCK = threading.Lock()
+
+
+def http_pool(location):
+    prs = urlparse(location)
+    cache_key = (prs.scheme, prs.hostname, prs.port)
+    with _HTTP_POOLS_LOCK:
+        pool = _HTTP_POOLS.get(cache_key)
+        if pool is None:
+            pool = HTTPConnectionPool(prs.scheme, prs.hostname, prs.port)
+            _HTTP_POOLS[cache_key] = pool
+    return pool
+
+
+def _http_send(location, method, headers=None, body=None):
+    '''
+    Send a request for location on a pooled connection, return a tuple of
+    the connection, it's pool and the response. A request on a reused
+    connection the server already closed is sent again on a new one.
+    '''
     prs = urlparse(location)
-    key = prs.path
+    path = prs.path or '/'
+    if prs.query:
+        path = '{}?{}'.format(path, prs.query)
+    headers = dict(headers or {})
     creds = parse_netloc_creds(prs.netloc)
     if creds:
-        bucket = prs.netloc.split('@', 1)[-1]
-        session = boto3.Session(
-            aws_access_key_id=creds[0],
-            aws_secret_access_key=creds[1],
+        token = u'{}:{}'.format(creds[0], creds[1] or '').encode('utf-8')
+        headers['Authorization'] = 'Basic {}'.format(
+            base64.b64encode(token).decode('ascii')
         )
+    pool = http_pool(location)
+    while True:
+        conn, reused = pool.get()
+        try:
+            conn.request(method, path, body=body, headers=headers)
+            return conn, pool, conn.getresponse()
+        except (httplib.HTTPException, socket.error):
+            conn.close()
+            if not reused:
+                raise
+            if body is not None:
+                body.seek(0)
+
+
+def _http_release(conn, pool, response):
+    if response.will_close:
+        conn.close()
     else:
-        bucket = prs.netloc
-        session = boto3.Session()
-    s3 = session.client('s3')
-    with open(filename, "wb") as f:
-        s3.download_fileobj(f, bucket, key)
+        pool.put(conn)
+
+
+@contextlib.contextmanager
+def http_request(location, method, headers=None, body=None):
+    '''
+    Send a request for location on a pooled connection and yield the
+    response. The connection goes back to the pool once the response is
+    consumed. Redirects are followed, those of uploads only when they keep
+    the method, 307 and 308. Credentials are only sent to the host named
+    in location.
+    '''
+    for _ in range(HTTP_MAX_REDIRECTS + 1):
+        conn, pool, response = _http_send(location, method, headers, body)
+        target = response.getheader('Location')
+        if (response.status not in HTTP_REDIRECTS or not target or
+                method not in ('GET', 'HEAD') and response.status < 307):
+            break
+        response.read()
+        _http_release(conn, pool, response)
+        location = urljoin(location, target)
+        if body is not None:
+            body.seek(0)
+    try:
+        yield response
+        response.read()
+    except Exception:
+        conn.close()
+        raise
+    _http_release(conn, pool, response)
+
+
+def _http_check(response, location):
+    if not 200 <= response.status < 300:
+        if response.status >= 500 or response.status == 429:
+            exc_class = TransferError
+        else:
+            exc_class = DataPluginException
+        raise exc_class("HTTP error {} {} for {}".format(
+            response.status, response.reason, location
+        ))
+
+
+def http_downloader(location, filename):
+    '''
+    retrieve the file from an http(s) location in a single request
+    '''
+    tw.line("Storing local archive: {}".format(location), bold=True)
+    with http_request(location, 'GET') as response:
+        _http_check(response, location)
+        length = response.getheader('Content-Length')
+        label = 'Downloading {}'.format(location)
+        with start_progress(label, length and int(length)) as progress:
+            with io.open(filename, 'wb') as dst:
+                for chunk in iterchunks(response, COPY_BUFSIZE, progress):
+                    dst.write(chunk)
+
+
+def http_not_modified(location, filename):
+    '''
+    Ask the server whether location changed since it was downloaded to
+    filename, sending the ETag saved next to filename in If-None-Match.
+    Returns a tuple of whether it is unchanged and it's current ETag.
+    '''
+    headers = {}
+    etag_path = filename + '.etag'
+    if os.path.exists(filename) and os.path.exists(etag_path):
+        with io.open(etag_path, 'r') as fp:
+            headers['If-None-Match'] = fp.read().strip()
+    with http_request(location, 'HEAD', headers) as response:
+        if response.status == 304:
+            return True, headers['If-None-Match']
+        _http_check(response, location)
+        return False, response.getheader('ETag')
 
 
 DOWNLOADER_SCHEMAS = {
     '': local_downloader,
     'smb': smb_downloader,
     's3': boto3_downloader,
+    'http': http_downloader,
+    'https': http_downloader,
 }
 
 
@@ -547,58 +4613,667 @@ def local_uploader(location, filename):
     persist the file to a location on the localhost
     '''
     tw.line("Storing local archive: {}".format(location), bold=True)
-    with io.open(filename, 'rb') as src:
-        with io.open(location, 'wb') as dst:
-            for chunk in iterchunks(src, 1024 * 100):
-                dst.write(chunk)
+    dirname = os.path.dirname(location)
+    if dirname and not os.path.exists(dirname):
+        os.makedirs(dirname)
+    copy_file(filename, location)
 
 
 def smb_uploader(location, filename):
+    '''
+    persist the file to an smb location, the username and password should be
+    a part of the location url if authentication is required.
+    '''
     tw.line("Storing local archive: {}".format(location), bold=True)
-    director = urllib2.build_opener(smb.SMBHandler.SMBHandler)
+    director = build_opener(smb.SMBHandler.SMBHandler)
     with io.open(filename, 'rb') as src:
-        try:
-            dst = director.open(location, src)
-        finally:
-            dst.close()
+        director.open(location, src).close()
+
 
 def boto3_uploader(location, filename):
+    '''
+    persist the file to an s3 location, s3://bucket/path. Files larger than
+    the multipart threshold are uploaded in parallel parts.
+    '''
+    bucket, key, client = boto3_client(location)
+    total = os.path.getsize(filename)
+    with start_progress('Uploading {}'.format(location), total) as progress:
+        client.upload_file(
+            filename, bucket, key, Config=s3_transfer_config(),
+            Callback=progress.update,
+        )
+
+
+def http_uploader(location, filename):
+    '''
+    persist the file to an http(s) location with a PUT request
+    '''
+    tw.line("Storing local archive: {}".format(location), bold=True)
+    headers = {'Content-Length': str(os.path.getsize(filename))}
+    with io.open(filename, 'rb') as src:
+        with http_request(location, 'PUT', headers, src) as response:
+            _http_check(response, location)
+
+
+_BOTO3_CLIENTS = {}
+
+
+def boto3_client(location):
+    '''
+    Return a tuple of bucket, key and an s3 client for location. Clients are
+    cached per credentials and endpoint so connections are reused across
+    transfers.
+    '''
     import boto3
-    's3://bucket/path'
     prs = urlparse(location)
-    key = prs.path
+    key = prs.path.lstrip('/')
     creds = parse_netloc_creds(prs.netloc)
-    if creds:
-        bucket = prs.netloc.split('@', 1)[-1]
-        session = boto3.Session(
-            aws_access_key_id=creds[0],
-            aws_secret_access_key=creds[1],
-        )
+    bucket = prs.netloc.split('@', 1)[-1]
+    cache_key = (tuple(creds or ()), STATE['s3_endpoint_url'])
+    client = _BOTO3_CLIENTS.get(cache_key)
+    if client is None:
+        if creds:
+            session = boto3.Session(
+                aws_access_key_id=creds[0],
+                aws_secret_access_key=creds[1],
+            )
+        else:
+            session = boto3.Session()
+        client = session.client('s3', endpoint_url=STATE['s3_endpoint_url'])
+        _BOTO3_CLIENTS[cache_key] = client
+    return bucket, key, client
+
+
+def s3_transfer_config():
+    from boto3.s3.transfer import TransferConfig
+    return TransferConfig(
+        multipart_threshold=STATE['s3_multipart_threshold'],
+        multipart_chunksize=STATE['s3_part_size'],
+        max_concurrency=STATE['s3_max_concurrency'],
+        use_threads=STATE['s3_max_concurrency'] > 1,
+    )
+
+
+def local_exists(location):
+    return os.path.exists(location)
+
+
+def smb_exists(location):
+    director = build_opener(smb.SMBHandler.SMBHandler)
+    try:
+        director.open(location).close()
+    except Exception:
+        return False
+    return True
+
+
+def boto3_exists(location):
+    import botocore.exceptions
+    bucket, key, client = boto3_client(location)
+    try:
+        client.head_object(Bucket=bucket, Key=key)
+    except botocore.exceptions.ClientError:
+        return False
+    return True
+
+
+def http_exists(location):
+    with http_request(location, 'HEAD') as response:
+        return 200 <= response.status < 300
+
+
+EXISTS_SCHEMAS = {
+    '': local_exists,
+    'smb': smb_exists,
+    's3': boto3_exists,
+    'http': http_exists,
+    'https': http_exists,
+}
+
+
+_SMB_CONNECTIONS = threading.local()
+
+
+def smb_connection(location):
+    '''
+    Return a tuple of service, path and a connected pysmb SMBConnection for
+    location, connecting the same way smb.SMBHandler does. Connections are
+    kept per thread, so a download reuses one for all of it's ranges without
+    sharing it between workers.
+    '''
+    from smb.SMBConnection import SMBConnection
+    prs = urlparse(location)
+    dirs = [unquote(part) for part in prs.path.lstrip('/').split('/')]
+    service, path = dirs[0], '/'.join(dirs[1:])
+    connections = getattr(_SMB_CONNECTIONS, 'connections', None)
+    if connections is None:
+        connections = _SMB_CONNECTIONS.connections = {}
+    conn = connections.get(prs.netloc)
+    if conn is not None:
+        return service, path, conn
+    user, passwd = parse_netloc_creds(prs.netloc) or ('', '')
+    domain = ''
+    if ';' in user:
+        domain, user = user.split(';', 1)
+    host = prs.netloc.rpartition('@')[2]
+    if prs.port:
+        host = host.rpartition(':')[0]
+    host = unquote(host)
+    if ',' in host:
+        server_name, host = host.split(',', 1)
     else:
-        bucket = prs.netloc
-        session = boto3.Session()
-    s3 = session.client('s3')
-    with open(filename, "rb") as f:
-        s3.upload_fileobj(f, bucket, key)
+        from nmb.NetBIOS import NetBIOS
+        names = NetBIOS().queryIPForName(host)
+        if not names:
+            raise DataPluginException(
+                "SMB host {} does not reply with it's machine name".format(host)
+            )
+        server_name = names[0]
+    handler = smb.SMBHandler
+    conn = SMBConnection(
+        user, passwd or '',
+        handler.MACHINE_NAME or handler.SMBHandler().generateClientMachineName(),
+        server_name, domain=domain, use_ntlm_v2=handler.USE_NTLM,
+    )
+    conn.connect(host, prs.port or 139)
+    connections[prs.netloc] = conn
+    return service, path, conn
+
+
+def smb_disconnect(location):
+    '''
+    Close this thread's connection to the host of location, after an error
+    it may be in any state.
+    '''
+    connections = getattr(_SMB_CONNECTIONS, 'connections', {})
+    conn = connections.pop(urlparse(location).netloc, None)
+    if conn is not None:
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+
+def smb_size(location):
+    service, path, conn = smb_connection(location)
+    try:
+        return conn.getAttributes(service, path).file_size
+    except Exception:
+        smb_disconnect(location)
+        raise
+
+
+def boto3_size(location):
+    bucket, key, client = boto3_client(location)
+    return client.head_object(Bucket=bucket, Key=key)['ContentLength']
+
+
+def http_size(location):
+    '''
+    The size of location, or None when the server does not support range
+    requests.
+    '''
+    with http_request(location, 'HEAD') as response:
+        _http_check(response, location)
+        length = response.getheader('Content-Length')
+        if response.getheader('Accept-Ranges', '').lower() != 'bytes' or not length:
+            return None
+        return int(length)
+
+
+SIZE_SCHEMAS = {
+    'smb': smb_size,
+    's3': boto3_size,
+    'http': http_size,
+    'https': http_size,
+}
+
+
+def smb_range_reader(location, start, end, fileobj):
+    '''
+    Write bytes start to end of the smb location into fileobj
+    '''
+    service, path, conn = smb_connection(location)
+    try:
+        conn.retrieveFileFromOffset(
+            service, path, fileobj, offset=start, max_length=end - start,
+        )
+    except Exception:
+        smb_disconnect(location)
+        raise
+
+
+def boto3_range_reader(location, start, end, fileobj):
+    '''
+    Write bytes start to end of the s3 location into fileobj
+    '''
+    bucket, key, client = boto3_client(location)
+    response = client.get_object(
+        Bucket=bucket, Key=key, Range='bytes={}-{}'.format(start, end - 1),
+    )
+    body = response['Body']
+    try:
+        for chunk in iter(partial(body.read, COPY_BUFSIZE), b''):
+            fileobj.write(chunk)
+    finally:
+        body.close()
+
+
+def http_range_reader(location, start, end, fileobj):
+    '''
+    Write bytes start to end of the http(s) location into fileobj
+    '''
+    headers = {'Range': 'bytes={}-{}'.format(start, end - 1)}
+    with http_request(location, 'GET', headers) as response:
+        _http_check(response, location)
+        if response.status != 206:
+            raise DataPluginException(
+                "Server ignored range request for {}".format(location)
+            )
+        for chunk in iter(partial(response.read, COPY_BUFSIZE), b''):
+            fileobj.write(chunk)
+
+
+RANGE_SCHEMAS = {
+    'smb': smb_range_reader,
+    's3': boto3_range_reader,
+    'http': http_range_reader,
+    'https': http_range_reader,
+}
+
+
+def local_stream(location):
+    return io.open(location, 'rb')
+
+
+def smb_stream(location):
+    director = build_opener(smb.SMBHandler.SMBHandler)
+    return contextlib.closing(director.open(location))
+
+
+def boto3_stream(location):
+    bucket, key, client = boto3_client(location)
+    response = client.get_object(Bucket=bucket, Key=key)
+    return contextlib.closing(response['Body'])
+
+
+@contextlib.contextmanager
+def http_stream(location):
+    with http_request(location, 'GET') as response:
+        _http_check(response, location)
+        yield response
+
+
+STREAM_SCHEMAS = {
+    '': local_stream,
+    'smb': smb_stream,
+    's3': boto3_stream,
+    'http': http_stream,
+    'https': http_stream,
+}
+
+
+CONDITIONAL_SCHEMAS = {
+    'http': http_not_modified,
+    'https': http_not_modified,
+}
 
 
 def parse_netloc_creds(netloc):
     if netloc.find('@') == -1:
-        raise Exception("No Creds")
+        return None
     credpart, locpart = netloc.split('@', 1)
     if credpart.find(':') == -1:
         return credpart, None
     else:
-        return credpart.split(':', 1)
+        return tuple(unquote(part) for part in credpart.split(':', 1))
 
 
 UPLOADER_SCHEMAS = {
     '': local_uploader,
     'smb': smb_uploader,
     's3': boto3_uploader,
+    'http': http_uploader,
+    'https': http_uploader,
 }
 
 
+_NOT_RETRYABLE_ERRNOS = tuple(
+    getattr(errno, name) for name in ('ENOENT', 'EACCES', 'EISDIR', 'ENOTDIR')
+    if hasattr(errno, name)
+)
+
+
+def is_retryable(exc):
+    '''
+    True when a transfer which failed with exc may succeed when retried
+    '''
+    if isinstance(exc, (TransferError, httplib.HTTPException)):
+        return True
+    if isinstance(exc, (IOError, OSError, socket.error)):
+        return exc.errno not in _NOT_RETRYABLE_ERRNOS
+    return False
+
+
+def retry_delay(backoff, attempt):
+    '''
+    Seconds to wait before retry number attempt, doubling every attempt with
+    random jitter so failed jobs do not retry in lock step.
+    '''
+    return backoff * (2 ** attempt) * random.uniform(0.5, 1.0)
+
+
+def transfer_scheme(location):
+    return urlparse(location).scheme or 'file'
+
+
+class TransferEngine(object):
+    '''
+    Runs transfer jobs concurrently. A job is a tuple of a location and a
+    callable doing the transfer. At most concurrency jobs run at once, and at
+    most limits[scheme] for the scheme of their location. Jobs failing with
+    a retryable error are retried up to retries times with exponential
+    backoff.
+    '''
+
+    def __init__(self, concurrency=8, limits=None, retries=3, backoff=0.5):
+        self.concurrency = concurrency
+        self.limits = limits or {}
+        self.retries = retries
+        self.backoff = backoff
+
+    def run(self, jobs):
+        '''
+        Run jobs and return their results in order. When jobs fail the other
+        jobs are still completed before the first error is raised.
+        '''
+        raise NotImplementedError
+
+
+class ThreadTransferEngine(TransferEngine):
+    '''
+    A TransferEngine running jobs on a pool of threads
+    '''
+
+    def _call(self, semaphores, job):
+        location, func = job
+        with semaphores[transfer_scheme(location)]:
+            attempt = 0
+            while True:
+                try:
+                    return func()
+                except Exception as exc:
+                    if attempt >= self.retries or not is_retryable(exc):
+                        raise
+                time.sleep(retry_delay(self.backoff, attempt))
+                attempt += 1
+
+    def _call_safe(self, semaphores, job):
+        try:
+            return True, self._call(semaphores, job)
+        except Exception:
+            return False, sys.exc_info()
+
+    def run(self, jobs):
+        jobs = list(jobs)
+        if not jobs:
+            return []
+        semaphores = {}
+        for location, func in jobs:
+            scheme = transfer_scheme(location)
+            if scheme not in semaphores:
+                semaphores[scheme] = threading.BoundedSemaphore(
+                    self.limits.get(scheme, self.concurrency)
+                )
+        pool = ThreadPool(min(self.concurrency, len(jobs)))
+        try:
+            outcomes = pool.map(partial(self._call_safe, semaphores), jobs)
+        finally:
+            pool.close()
+            pool.join()
+        results = []
+        for ok, value in outcomes:
+            if not ok:
+                exc_type, exc, tb = value
+                raise exc
+            results.append(value)
+        return results
+
+
+def transfer_files(jobs):
+    '''
+    Run transfer jobs, tuples of a location and a callable, on the session's
+    transfer engine and return their results in order.
+    '''
+    with PHASES.phase('transfer'):
+        results = get_transfer_engine().run(jobs)
+    PHASES.add('transfer', files=len(jobs))
+    return results
+
+
 def transfer_file(location, filename, schemas):
-    method = schemas.get(urlparse(STATE['location']).scheme)
-    method(location, filename)
+    method = schemas.get(urlparse(location).scheme)
+    transfer_files([(location, partial(method, location, filename))])
+    if os.path.exists(filename):
+        PHASES.add('transfer', os.path.getsize(filename))
+
+
+class TransferCheckpoint(object):
+    '''
+    The byte ranges of a partial download that are complete, kept in a json
+    sidecar next to the .part file. The checkpoint only applies to the same
+    location and size it was written for.
+    '''
+
+    def __init__(self, path, location, size):
+        self.path = path
+        self.location = location
+        self.size = size
+        self.done = set()
+        self.lock = threading.Lock()
+
+    @classmethod
+    def load(cls, path, location, size):
+        checkpoint = cls(path, location, size)
+        try:
+            with io.open(path, 'r') as fp:
+                record = json.load(fp)
+        except (IOError, OSError, ValueError):
+            return checkpoint
+        if record.get('location') == location and record.get('size') == size:
+            checkpoint.done = set(tuple(span) for span in record['done'])
+        return checkpoint
+
+    def completed(self):
+        return sum(end - start for start, end in self.done)
+
+    def complete(self, start, end):
+        with self.lock:
+            self.done.add((start, end))
+            self.save()
+
+    def save(self):
+        record = {
+            'location': self.location,
+            'size': self.size,
+            'done': sorted(self.done),
+        }
+        tmppath = self.path + '.tmp'
+        with io.open(tmppath, 'w') as fp:
+            fp.write(u'{}'.format(json.dumps(record)))
+        _replace(tmppath, self.path)
+
+    def remove(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def download_resumable(location, filename, workers=1, part_size=RESUME_PART_SIZE,
+                       size=None):
+    '''
+    Download location into filename in ranges of part_size bytes. Completed
+    ranges are recorded in a checkpoint so an interrupted download resumes
+    from where it stopped instead of starting over. Ranges run as jobs of the
+    transfer engine, at most workers at once, and are retried on their own.
+    '''
+    scheme = urlparse(location).scheme
+    if size is None:
+        size = SIZE_SCHEMAS[scheme](location)
+    reader = RANGE_SCHEMAS[scheme]
+    checkpoint = TransferCheckpoint.load(filename + '.json', location, size)
+    if not os.path.exists(filename):
+        checkpoint.done = set()
+    if checkpoint.done:
+        tw.line("Resuming download at {} of {} bytes".format(
+            checkpoint.completed(), size
+        ))
+    with io.open(filename, 'r+b' if checkpoint.done else 'wb') as fp:
+        fp.truncate(size)
+    spans = [
+        (start, min(start + part_size, size))
+        for start in range(0, size, part_size)
+        if (start, min(start + part_size, size)) not in checkpoint.done
+    ]
+
+    def fetch(span):
+        start, end = span
+        with io.open(filename, 'r+b') as fp:
+            fp.seek(start)
+            reader(location, start, end, fp)
+            if fp.tell() != end:
+                raise TransferError(
+                    "Short read of {} at offset {}".format(location, start)
+                )
+        checkpoint.complete(start, end)
+        progress.update(end - start)
+
+    progress = start_progress('Downloading {}'.format(location), size)
+    progress.set(checkpoint.completed())
+    engine = get_transfer_engine()
+    engine.concurrency = min(engine.concurrency, workers)
+    with PHASES.phase('transfer'), progress:
+        engine.run([(location, partial(fetch, span)) for span in spans])
+    PHASES.add('transfer', sum(end - start for start, end in spans), 1)
+    checkpoint.remove()
+
+
+def range_options(scheme):
+    '''
+    A tuple of the number of concurrent range requests and the size of each
+    range for downloads from scheme.
+    '''
+    if scheme == 's3':
+        return STATE['s3_max_concurrency'], STATE['s3_part_size']
+    if scheme in ('http', 'https'):
+        return STATE['http_max_connections'], RESUME_PART_SIZE
+    return 1, RESUME_PART_SIZE
+
+
+def download_file(location, filename, signature=None, hash_cache=None):
+    '''
+    Download location to filename through a .part file, which is only renamed
+    into place once it matches signature. Locations that support ranged reads
+    resume an interrupted download. The verified digest is recorded in
+    hash_cache, so the next run knows the file without reading it.
+    '''
+    scheme = urlparse(location).scheme
+    partname = filename + '.part'
+    etag = None
+    if scheme in CONDITIONAL_SCHEMAS:
+        not_modified, etag = CONDITIONAL_SCHEMAS[scheme](location, filename)
+        if not_modified and (
+                not signature or verify_data_archive(filename, signature)):
+            tw.line("Archive not modified: {}".format(location))
+            return
+    size = None
+    if scheme in SIZE_SCHEMAS:
+        size = SIZE_SCHEMAS[scheme](location)
+    if size is not None:
+        tw.line("Storing local archive: {}".format(location), bold=True)
+        workers, part_size = range_options(scheme)
+        download_resumable(location, partname, workers, part_size, size)
+    else:
+        transfer_file(location, partname, DOWNLOADER_SCHEMAS)
+    if signature:
+        algorithm, hexdigest = parse_signature(signature)
+        if shasum(partname, algorithm) != hexdigest:
+            os.remove(partname)
+            raise DownloadVerificationFailed(
+                "Downloaded file {} does not match signature {}".format(
+                    location, signature
+                )
+            )
+        _replace(partname, filename)
+        if hash_cache is not None and hash_cache.algorithm == algorithm:
+            hash_cache.record(filename, hexdigest)
+    else:
+        _replace(partname, filename)
+    etag_path = filename + '.etag'
+    if etag:
+        with io.open(etag_path, 'w') as fp:
+            fp.write(u'{}'.format(etag))
+    elif os.path.exists(etag_path):
+        os.remove(etag_path)
+
+
+def _stream_extract(location, staging, signature, codec, algorithm, workers,
+                    links='hardlink'):
+    if os.path.exists(staging):
+        shutil.rmtree(staging)
+    os.makedirs(staging)
+    try:
+        with STREAM_SCHEMAS[urlparse(location).scheme](location) as src:
+            reader = HashingReader(src, new_hash(algorithm))
+            archiver = ConsistantArchiveReader(
+                location, codec=codec, fileobj=reader
+            )
+            try:
+                archiver.extract_to_directory(
+                    staging, workers=workers, links=links
+                )
+                # The tar stream ends before the compressed stream does, the
+                # rest still counts towards the signature.
+                for chunk in iterchunks(reader, COPY_BUFSIZE):
+                    pass
+            finally:
+                archiver.close()
+        result = format_signature(algorithm, reader.hexdigest())
+        if signature and result != signature:
+            raise DownloadVerificationFailed(
+                "Downloaded file {} does not match signature {}".format(
+                    location, signature
+                )
+            )
+    except Exception:
+        shutil.rmtree(staging, ignore_errors=True)
+        raise
+    return result
+
+
+def fetch_archive(location, output_directory, signature=None, codec=None,
+                  algorithm=DEFAULT_HASH, workers=1, links='hardlink'):
+    '''
+    Extract the archive at location to output_directory while it is
+    downloaded, without writing the archive to disk, and return it's
+    signature. The archive is hashed as it streams through and extracted to
+    a staging directory next to output_directory, which only replaces
+    output_directory once the archive matches signature.
+    '''
+    if signature:
+        algorithm = parse_signature(signature)[0]
+    output_directory = os.path.abspath(output_directory)
+    parent, name = os.path.split(output_directory)
+    staging = os.path.join(parent, '.{}.fetch'.format(name))
+    old = os.path.join(parent, '.{}.old'.format(name))
+    result, = transfer_files([(location, partial(
+        _stream_extract, location, staging, signature, codec, algorithm,
+        workers, links,
+    ))])
+    if os.path.exists(old):
+        shutil.rmtree(old)
+    if os.path.exists(output_directory):
+        os.rename(output_directory, old)
+    os.rename(staging, output_directory)
+    if os.path.exists(old):
+        shutil.rmtree(old)
+    return result
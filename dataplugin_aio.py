@@ -0,0 +1,66 @@
+'''
+The asyncio transfer engine of the dataplugin. This module needs python 3,
+dataplugin falls back to it's ThreadTransferEngine when it can not be
+imported.
+'''
+import asyncio
+import concurrent.futures
+
+from dataplugin import (
+    TransferEngine, is_retryable, retry_delay, transfer_scheme,
+)
+
+
+class AsyncTransferEngine(TransferEngine):
+    '''
+    A TransferEngine scheduling jobs on an asyncio event loop. The blocking
+    transfer functions run in a thread pool executor, the loop only bounds
+    concurrency and waits out retry backoff without holding a thread.
+    '''
+
+    async def _call(self, loop, slots, semaphores, job):
+        location, func = job
+        async with semaphores[transfer_scheme(location)]:
+            attempt = 0
+            while True:
+                try:
+                    async with slots:
+                        return await loop.run_in_executor(None, func)
+                except Exception as exc:
+                    if attempt >= self.retries or not is_retryable(exc):
+                        raise
+                await asyncio.sleep(retry_delay(self.backoff, attempt))
+                attempt += 1
+
+    async def _run(self, loop, jobs):
+        slots = asyncio.Semaphore(self.concurrency)
+        semaphores = {}
+        for location, func in jobs:
+            scheme = transfer_scheme(location)
+            if scheme not in semaphores:
+                semaphores[scheme] = asyncio.Semaphore(
+                    self.limits.get(scheme, self.concurrency)
+                )
+        return await asyncio.gather(
+            *[self._call(loop, slots, semaphores, job) for job in jobs],
+            return_exceptions=True
+        )
+
+    def run(self, jobs):
+        jobs = list(jobs)
+        if not jobs:
+            return []
+        loop = asyncio.new_event_loop()
+        executor = concurrent.futures.ThreadPoolExecutor(
+            min(self.concurrency, len(jobs))
+        )
+        loop.set_default_executor(executor)
+        try:
+            results = loop.run_until_complete(self._run(loop, jobs))
+        finally:
+            loop.close()
+            executor.shutdown(wait=True)
+        for result in results:
+            if isinstance(result, BaseException):
+                raise result
+        return results
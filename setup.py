@@ -6,11 +6,12 @@ test_requires = [
     'py',
     'pysmb',
     'boto3',
+    'moto',
 ]
 
 setup(
     name = 'pytest-dataplugin',
-    py_modules = ['dataplugin'],
+    py_modules = ['dataplugin', 'dataplugin_aio'],
     version = '0.0.2',
     description = (
         'A pytest plugin for managing an archive of test data.'
@@ -41,5 +42,8 @@ setup(
     extras_require = {
         'smb':  ["pysmb"],
         's3': ["boto3"],
+        'zstd': ["zstandard"],
+        'lz4': ["lz4"],
+        'blake3': ["blake3"],
     }
 )
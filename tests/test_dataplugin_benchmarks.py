@@ -0,0 +1,51 @@
+import os
+import sys
+import json
+import subprocess
+
+
+BENCH = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    'benchmarks', 'bench_dataplugin.py',
+)
+
+
+def test_benchmark_baseline(tmpdir):
+    baseline = str(tmpdir.join('baseline.json'))
+    args = [
+        sys.executable, BENCH, '--scale', '0.001', '--repeat', '1',
+        '--dataset', 'tiny', '--codec', 'tar',
+    ]
+    subprocess.check_call(args + ['--save', baseline])
+    with open(baseline) as fp:
+        results = json.load(fp)['results']
+    assert sorted(results) == [
+        'create/tar/tiny', 'download/-/tiny', 'extract/tar/tiny',
+        'upload/-/tiny', 'verify/-/tiny',
+    ]
+    assert results['create/tar/tiny']['files'] == 50
+    # Nothing is slow enough to compare, the comparison passes
+    subprocess.check_call(args + ['--compare', baseline])
+
+
+def test_benchmark_without_peak_rss(tmpdir, monkeypatch):
+    sys.path.insert(0, os.path.dirname(BENCH))
+    try:
+        import bench_dataplugin
+    finally:
+        sys.path.remove(os.path.dirname(BENCH))
+    runs = iter([(1.0, None), (0.5, None), (2.0, None)])
+    monkeypatch.setattr(
+        bench_dataplugin, 'spawn',
+        lambda *args: dict(zip(('seconds', 'rss'), next(runs)), cpu=0.1),
+    )
+    out = str(tmpdir.join('out'))
+    best = bench_dataplugin.measure('create', 'tar', '', '', out, 3)
+    assert best == {'seconds': 0.5, 'cpu': 0.1, 'rss': None}
+    runs = iter([(1.0, 12.0), (0.5, None), (2.0, 20.0)])
+    best = bench_dataplugin.measure('create', 'tar', '', '', out, 3)
+    assert best == {'seconds': 0.5, 'cpu': 0.1, 'rss': 20.0}
+    bench_dataplugin.print_results({'create/tar/tiny': {
+        'seconds': 0.5, 'mb_per_second': 1.0, 'files_per_second': 1.0,
+        'peak_rss_mb': None,
+    }})
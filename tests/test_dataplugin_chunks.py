@@ -0,0 +1,53 @@
+import pytest
+import dataplugin
+from helpers import PYTESTFILE
+
+
+def make_chunked_project(testdir):
+    testdir.makepyfile(PYTESTFILE)
+    testdir.mkdir('remote')
+    data = testdir.mkdir('data')
+    data.join('a.txt').write('same')
+    data.mkdir('sub').join('b.txt').write('same')
+    data.join('c.txt').write('different')
+    testdir.makefile('ini', **{
+        'pytest': [
+            '[pytest]',
+            'dataplugin-layout = chunks',
+            'dataplugin-location = remote/test-data.manifest',
+            'dataplugin-signature =\n',
+        ]
+    })
+    return data
+
+
+def test_chunked_roundtrip(testdir):
+    data = make_chunked_project(testdir)
+    result = testdir.runpytest_subprocess('--dataplugin-create')
+    assert result.errlines[-1].startswith('Archive createded')
+    entries = dataplugin.read_manifest(str(testdir.tmpdir.join('.test-data.manifest')))
+    assert [e.path for e in entries] == ['a.txt', 'c.txt', 'sub/b.txt']
+    result = testdir.runpytest_subprocess('--dataplugin-upload')
+    assert 'Uploaded 2 of 2 blobs' in result.errlines
+    result = testdir.runpytest_subprocess('--dataplugin-upload')
+    assert 'Uploaded 0 of 2 blobs' in result.errlines
+    testdir.tmpdir.join('.dataplugin-store').remove()
+    testdir.tmpdir.join('.test-data.manifest').remove()
+    data.remove()
+    result = testdir.runpytest_subprocess('--dataplugin-download')
+    assert 'Downloaded 2 of 2 blobs' in result.errlines
+    result = testdir.runpytest_subprocess('--dataplugin-extract')
+    assert result.errlines[-1].startswith('Extracted archive')
+    assert data.join('sub', 'b.txt').read() == 'same'
+    assert data.join('c.txt').read() == 'different'
+
+
+def test_chunk_store_rejects_corrupt_blob(tmpdir):
+    store = dataplugin.ChunkStore(str(tmpdir.join('store')))
+    digest = '0' * 40
+    tmppath = store.prepare(digest) + '.tmp'
+    with open(tmppath, 'w') as fp:
+        fp.write('corrupt')
+    with pytest.raises(dataplugin.BlobVerificationFailed):
+        store.commit(tmppath, digest, verify=True)
+    assert not store.has(digest)
@@ -1,3 +1,4 @@
+import os
 import pytest
 import platform
 from contextlib import contextmanager
@@ -37,3 +38,234 @@ def test_create_with_dir(testdir):
     result = testdir.runpytest_subprocess('--dataplugin-create')
     ERRLINES = 'Archive createded, name is test-data.tar.gz and hash is 39e2bc4a67e0336eb6bdf17bdd7bf8a1671dd9a7'
     assert result.errlines[-1] == ERRLINES
+
+
+def test_create_leaves_no_temporary_files(testdir):
+    testdir.makepyfile(PYTESTFILE)
+    testdir.mkdir('data')
+    result = testdir.runpytest_subprocess('--dataplugin-create')
+    assert result.errlines[-1].startswith('Archive createded')
+    assert testdir.tmpdir.join('.test-data.tar.gz').check()
+    assert not testdir.tmpdir.join('..test-data.tar.gz').check()
+    assert not testdir.tmpdir.join('.test-data.tar.gz.tmp').check()
+
+
+def test_create_parallel_compression(testdir):
+    import gzip
+    import dataplugin
+    data = testdir.mkdir('data')
+    data.join('a.bin').write_binary(os.urandom(300 * 1024))
+    data.join('b.txt').write('b' * 200 * 1024)
+    sigs = []
+    for workers in (2, 4):
+        sigs.append(dataplugin.create_archive(
+            'parallel.tar.gz', str(data), compress_workers=workers,
+            block_size=64 * 1024,
+        ))
+    assert sigs[0] == sigs[1]
+    dataplugin.create_archive('serial.tar.gz', str(data))
+    with gzip.open('serial.tar.gz') as fp:
+        serial = fp.read()
+    with gzip.open('parallel.tar.gz') as fp:
+        parallel = fp.read()
+    assert serial == parallel
+
+
+def test_create_skipped_when_unchanged(testdir):
+    testdir.makepyfile(PYTESTFILE)
+    data = testdir.mkdir('data')
+    data.join('a.txt').write('a')
+    result = testdir.runpytest_subprocess('--dataplugin-create')
+    created = result.errlines[-1]
+    assert created.startswith('Archive createded')
+    result = testdir.runpytest_subprocess('--dataplugin-create')
+    assert result.errlines[-1] == created.replace('createded', 'is up to date')
+    result = testdir.runpytest_subprocess('--dataplugin-create', '--dataplugin-rescan')
+    assert result.errlines[-1] == created
+    data.join('a.txt').write('b')
+    result = testdir.runpytest_subprocess('--dataplugin-create')
+    assert result.errlines[-1].startswith('Archive createded')
+    assert result.errlines[-1] != created
+
+
+def test_hash_cache_evicts_least_recently_used(tmpdir):
+    import dataplugin
+    files = []
+    for name in 'abc':
+        tmpdir.join(name).write(name)
+        files.append(str(tmpdir.join(name)))
+    cache = dataplugin.HashCache(str(tmpdir.join('hashes.json')), max_entries=2)
+    for path in files:
+        cache.digest(path)
+    cache.lookup(files[0])
+    cache.save()
+    cache = dataplugin.HashCache(str(tmpdir.join('hashes.json')))
+    assert cache.lookup(files[0]) == dataplugin.shasum(files[0])
+    assert cache.lookup(files[1]) is None
+    assert cache.lookup(files[2]) == dataplugin.shasum(files[2])
+
+
+def test_create_report(testdir):
+    import json
+    testdir.makepyfile(PYTESTFILE)
+    data = testdir.mkdir('data')
+    data.join('a.txt').write('a' * 1000)
+    data.mkdir('sub').join('b.txt').write('b' * 2000)
+    result = testdir.runpytest_subprocess(
+        '--dataplugin-create', '--dataplugin-report', 'report.json'
+    )
+    assert result.errlines[-1].startswith('Archive createded')
+    assert any(line.startswith('phase ') for line in result.outlines)
+    with open(str(testdir.tmpdir.join('report.json'))) as fp:
+        report = json.load(fp)
+    assert report['action'] == 'create'
+    phases = report['phases']
+    assert phases['read']['files'] == 2
+    assert phases['read']['bytes'] == 3000
+    assert phases['compress']['bytes'] >= 3000
+    assert 'walk' in phases
+    assert phases['hash']['files'] >= 1
+
+
+def test_scan_files_order(tmpdir):
+    import dataplugin
+    data = tmpdir.mkdir('data')
+    data.join('b.txt').write('b')
+    data.join('a.txt').write('a')
+    data.mkdir('z').join('1.txt').write('1')
+    data.mkdir('m').mkdir('n').join('2.txt').write('2')
+    data.join('m', '3.txt').write('3')
+    assert [relpath for relpath, path in dataplugin.walk_files(str(data))] == [
+        'a.txt', 'b.txt', 'm/3.txt', 'm/n/2.txt', 'z/1.txt',
+    ]
+
+
+def test_create_deep_tree(tmpdir):
+    import sys
+    import dataplugin
+    data = tmpdir.mkdir('data')
+    path = str(data)
+    for _ in range(sys.getrecursionlimit() // 2 + 10):
+        path = os.path.join(path, 'd')
+    os.makedirs(path)
+    with open(os.path.join(path, 'leaf.txt'), 'w') as fp:
+        fp.write('leaf')
+    name = str(tmpdir.join('deep.tar.gz'))
+    prefetched = str(tmpdir.mkdir('other').join('deep.tar.gz'))
+    sig = dataplugin.create_archive(name, str(data))
+    # The archive does not depend on prefetching
+    archiver = dataplugin.ConsistantArchiveWriter(prefetched)
+    archiver.add_directory(str(data), prefetch=True)
+    assert archiver.close() == sig
+    members = dataplugin.archive_members(name)
+    assert [m.path.split('/')[-1] for m in members] == ['leaf.txt']
+
+
+@pytest.mark.skipif(not hasattr(os, 'symlink'), reason='needs symlinks')
+def test_scan_files_symlink_loop(tmpdir):
+    import dataplugin
+    data = tmpdir.mkdir('data')
+    data.mkdir('sub').join('a.txt').write('a')
+    os.symlink(str(data), str(data.join('sub', 'loop')))
+    with pytest.raises(dataplugin.DataPluginException):
+        list(dataplugin.walk_files(str(data)))
+
+
+def test_create_prefetch(tmpdir):
+    import dataplugin
+    data = tmpdir.mkdir('data')
+    data.join('empty.txt').write('')
+    data.join('small.txt').write('s' * 1000)
+    data.mkdir('sub').join('large.bin').write_binary(os.urandom(300 * 1024))
+    data.join('sub', 'huge.bin').write_binary(os.urandom(2 * 1024 * 1024))
+    os.link(str(data.join('small.txt')), str(data.join('sub', 'linked.txt')))
+    signatures = []
+    for prefetch in (False, True):
+        out = tmpdir.mkdir(str(prefetch)).join('test-data.tar.gz')
+        cache = dataplugin.HashCache(str(tmpdir.join('{}.json'.format(prefetch))))
+        signatures.append(dataplugin.create_archive(
+            str(out), str(data), hash_cache=cache, prefetch=prefetch,
+        ))
+    assert signatures[0] == signatures[1]
+
+
+def test_create_dedupe(tmpdir):
+    import dataplugin
+    data = tmpdir.mkdir('data')
+    content = os.urandom(100 * 1024)
+    data.join('a.bin').write_binary(content)
+    data.mkdir('sub').join('b.bin').write_binary(content)
+    data.join('sub', 'c.bin').write_binary(os.urandom(100 * 1024))
+    data.join('empty.txt').write('')
+    data.join('sub', 'empty.txt').write('')
+    plain = str(tmpdir.mkdir('plain').join('test-data.tar.gz'))
+    dataplugin.create_archive(plain, str(data))
+    signatures = []
+    for name, kwargs in (
+            ('first', {}),
+            ('prefetch', {'prefetch': True}),
+            ('cached', {'hash_cache': dataplugin.HashCache(str(tmpdir.join('h')))}),
+            ):
+        out = str(tmpdir.mkdir(name).join('test-data.tar.gz'))
+        signatures.append(dataplugin.create_archive(
+            out, str(data), dedupe=True, **kwargs
+        ))
+    assert len(set(signatures)) == 1
+    assert os.path.getsize(out) < os.path.getsize(plain) - 90 * 1024
+    members = dict(
+        (m.path, m) for m in dataplugin.archive_members(out)
+    )
+    assert members['sub/b.bin'] == members['a.bin']._replace(path='sub/b.bin')
+    assert members['sub/c.bin'].digest != members['a.bin'].digest
+
+
+def test_create_does_not_write_through_hardlinks(tmpdir):
+    import dataplugin
+    data = tmpdir.mkdir('data')
+    data.join('a.txt').write('a')
+    cached = str(tmpdir.mkdir('cache').join('archive'))
+    signature = dataplugin.create_archive(cached, str(data))
+    archive = str(tmpdir.join('test-data.tar.gz'))
+    os.link(cached, archive)
+    data.join('a.txt').write('changed')
+    assert dataplugin.create_archive(archive, str(data)) != signature
+    assert dataplugin.file_signature(cached) == signature
+    assert not tmpdir.join('test-data.tar.gz.tmp').check()
+
+
+def test_create_prefetch_many_small_files(tmpdir):
+    import dataplugin
+    resource = pytest.importorskip('resource')
+    data = tmpdir.mkdir('data')
+    for n in range(3000):
+        data.join('{:04d}.txt'.format(n)).write('x' * 100)
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (min(512, hard), hard))
+    try:
+        archive = str(tmpdir.join('test-data.tar.gz'))
+        dataplugin.create_archive(archive, str(data), prefetch=True)
+    finally:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (soft, hard))
+    assert len(dataplugin.archive_members(archive)) == 3000
+
+
+@pytest.mark.parametrize('option, value', [
+    ('layout', 'shard'),
+    ('shard-by', 'dir'),
+    ('extract-links', 'symlink'),
+    ('codec', 'rar'),
+])
+def test_unknown_option_values(testdir, option, value):
+    testdir.makepyfile(PYTESTFILE)
+    testdir.mkdir('data')
+    testdir.makefile('ini', **{
+        'pytest': [
+            '[pytest]',
+            'dataplugin-{} = {}\n'.format(option, value),
+        ]
+    })
+    result = testdir.runpytest_subprocess('--dataplugin-create')
+    assert result.ret != 0
+    assert 'INTERNALERROR' not in result.stderr.str()
+    assert value in result.stderr.str()
+    assert not testdir.tmpdir.join('.test-data.tar.gz').check()
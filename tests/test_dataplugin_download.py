@@ -1,5 +1,6 @@
 import pytest
 import platform
+import dataplugin
 from contextlib import contextmanager
 from _pytest.capture import MultiCapture, SysCapture
 from helpers import PYTESTFILE, create_test_archive, print_result
@@ -12,6 +13,28 @@ def test_dataplugin_download(testdir):
     create_test_archive(testdir, archive='test-data.tar.gz', files=remote_archive_files)
     create_test_archive(testdir, archive='.test-data.tar.gz', files=local_archive_files)
     #create_test_archive(testdir)
+    testdir.makefile('ini', **{
+            'pytest': [
+                '[pytest]',
+                'dataplugin-signature = 4d1896c391ff2309d49250e0b0ded541a5ed2273\n'
+            ]
+        }
+    )
+    result = testdir.runpytest_subprocess('--dataplugin-download')
+    assert result.errlines == [
+        'dataplugin download invoked, skipping collection.',
+        'Storing local archive: test-data.tar.gz',
+        'file downloaded',
+    ]
+    assert testdir.tmpdir.join('.test-data.tar.gz').read_binary() == \
+        testdir.tmpdir.join('test-data.tar.gz').read_binary()
+    assert not testdir.tmpdir.join('.test-data.tar.gz.part').exists()
+
+
+def test_dataplugin_download_signature_mismatch(testdir):
+    testdir.makepyfile(PYTESTFILE)
+    remote_archive_files = {('txt', 'test-data-file'): 'test data content remote'}
+    create_test_archive(testdir, archive='test-data.tar.gz', files=remote_archive_files)
     testdir.makefile('ini', **{
             'pytest': [
                 '[pytest]',
@@ -23,5 +46,167 @@ def test_dataplugin_download(testdir):
     assert result.errlines == [
         'dataplugin download invoked, skipping collection.',
         'Storing local archive: test-data.tar.gz',
+        'Downloaded file test-data.tar.gz does not match signature '
+        '2479d9203e1f4a326fd2cb49c66ab0904ebbd54c',
+    ]
+    assert not testdir.tmpdir.join('.test-data.tar.gz').exists()
+    assert not testdir.tmpdir.join('.test-data.tar.gz.part').exists()
+
+
+def test_dataplugin_download_skips_matching_archive(testdir):
+    testdir.makepyfile(PYTESTFILE)
+    create_test_archive(testdir, archive='.test-data.tar.gz')
+    signature = dataplugin.file_signature('.test-data.tar.gz')
+    testdir.makefile('ini', **{
+            'pytest': ['[pytest]', 'dataplugin-signature = {}\n'.format(signature)]
+        }
+    )
+    result = testdir.runpytest_subprocess('--dataplugin-download')
+    assert result.errlines == [
+        'dataplugin download invoked, skipping collection.',
+        'Local archive matches signature, skipping download',
+    ]
+
+
+def test_dataplugin_download_extract(testdir):
+    testdir.makepyfile(PYTESTFILE)
+    create_test_archive(testdir, archive='test-data.tar.gz')
+    testdir.tmpdir.join('data').remove()
+    signature = dataplugin.file_signature('test-data.tar.gz')
+    testdir.makefile('ini', **{
+            'pytest': ['[pytest]', 'dataplugin-signature = {}\n'.format(signature)]
+        }
+    )
+    result = testdir.runpytest_subprocess('--dataplugin-download-extract')
+    assert result.errlines == [
+        'dataplugin download-extract invoked, skipping collection.',
+        'Storing local archive: test-data.tar.gz',
         'file downloaded',
+        'Extracted archive test-data.tar.gz with hash {}'.format(signature),
     ]
+    assert testdir.tmpdir.join('data', 'test-data-file.txt').read() == 'test data content'
+    result = testdir.runpytest_subprocess('--dataplugin-download-extract')
+    assert result.errlines == [
+        'dataplugin download-extract invoked, skipping collection.',
+        'Local archive matches signature, skipping download',
+        'Directory {} is up to date with hash {}'.format(
+            testdir.tmpdir.join('data'), signature
+        ),
+    ]
+    testdir.tmpdir.join('data', 'test-data-file.txt').write('changed')
+    result = testdir.runpytest_subprocess('--dataplugin-download-extract')
+    assert result.errlines[-1] == \
+        'Extracted archive test-data.tar.gz with hash {}'.format(signature)
+    assert testdir.tmpdir.join('data', 'test-data-file.txt').read() == 'test data content'
+
+
+def test_dataplugin_download_extract_legacy_signature(testdir):
+    testdir.makepyfile(PYTESTFILE)
+    create_test_archive(testdir, archive='test-data.tar.gz')
+    testdir.tmpdir.join('data').remove()
+    signature = dataplugin.file_signature('test-data.tar.gz')
+    testdir.makefile('ini', **{
+            'pytest': [
+                '[pytest]',
+                'dataplugin-hash = blake2b',
+                'dataplugin-signature = {}\n'.format(signature),
+            ]
+        }
+    )
+    result = testdir.runpytest_subprocess('--dataplugin-download-extract')
+    assert result.errlines[-1].startswith('Extracted archive test-data.tar.gz')
+    result = testdir.runpytest_subprocess('--dataplugin-download-extract')
+    assert result.errlines[-1] == 'Directory {} is up to date with hash {}'.format(
+        testdir.tmpdir.join('data'), signature
+    )
+
+
+def test_dataplugin_download_shared_cache(testdir, monkeypatch):
+    testdir.makepyfile(PYTESTFILE)
+    create_test_archive(testdir, archive='test-data.tar.gz')
+    signature = dataplugin.file_signature('test-data.tar.gz')
+    cache = testdir.tmpdir.join('shared')
+    monkeypatch.setenv('PYTEST_DATAPLUGIN_CACHE', str(cache))
+    testdir.makefile('ini', **{
+            'pytest': ['[pytest]', 'dataplugin-signature = {}\n'.format(signature)]
+        }
+    )
+    result = testdir.runpytest_subprocess('--dataplugin-download')
+    assert result.errlines[-1] == 'file downloaded'
+    assert cache.join('archives', signature).exists()
+    # Another checkout finds the archive in the cache, the remote is not read.
+    testdir.tmpdir.join('.test-data.tar.gz').remove()
+    testdir.tmpdir.join('test-data.tar.gz').remove()
+    result = testdir.runpytest_subprocess('--dataplugin-download')
+    assert result.errlines == [
+        'dataplugin download invoked, skipping collection.',
+        'Using archive from shared cache {}'.format(cache),
+        'file downloaded',
+    ]
+    assert dataplugin.file_signature('.test-data.tar.gz') == signature
+
+
+def test_dataplugin_download_seekable_without_index(testdir):
+    testdir.makepyfile(PYTESTFILE)
+    create_test_archive(testdir, archive='test-data.tar.gz')
+    signature = dataplugin.file_signature('test-data.tar.gz')
+    testdir.makefile('ini', **{
+            'pytest': [
+                '[pytest]',
+                'dataplugin-seekable = true',
+                'dataplugin-signature = {}\n'.format(signature),
+            ]
+        }
+    )
+    result = testdir.runpytest_subprocess('--dataplugin-download')
+    assert result.errlines == [
+        'dataplugin download invoked, skipping collection.',
+        'Storing local archive: test-data.tar.gz',
+        'No index found for test-data.tar.gz',
+        'file downloaded',
+    ]
+    assert dataplugin.file_signature('.test-data.tar.gz') == signature
+
+
+def test_dataplugin_fetch(testdir):
+    testdir.makepyfile(PYTESTFILE)
+    create_test_archive(testdir, archive='test-data.tar.gz')
+    testdir.tmpdir.join('data', 'stale.txt').write('stale')
+    signature = dataplugin.file_signature('test-data.tar.gz')
+    testdir.makefile('ini', **{
+            'pytest': ['[pytest]', 'dataplugin-signature = {}\n'.format(signature)]
+        }
+    )
+    result = testdir.runpytest_subprocess('--dataplugin-fetch')
+    assert result.errlines == [
+        'dataplugin fetch invoked, skipping collection.',
+        'Fetching archive: test-data.tar.gz',
+        'Archive extracted, hash is {}'.format(signature),
+    ]
+    assert testdir.tmpdir.join('data', 'test-data-file.txt').read() == 'test data content'
+    assert not testdir.tmpdir.join('data', 'stale.txt').exists()
+    assert not testdir.tmpdir.join('.test-data.tar.gz').exists()
+    result = testdir.runpytest_subprocess('--dataplugin-fetch')
+    assert result.errlines[-1] == 'Directory {} is up to date with hash {}'.format(
+        testdir.tmpdir.join('data'), signature
+    )
+
+
+def test_dataplugin_fetch_signature_mismatch(testdir):
+    testdir.makepyfile(PYTESTFILE)
+    create_test_archive(testdir, archive='test-data.tar.gz')
+    testdir.tmpdir.join('data', 'test-data-file.txt').write('previous')
+    testdir.makefile('ini', **{
+            'pytest': [
+                '[pytest]',
+                'dataplugin-signature = 2479d9203e1f4a326fd2cb49c66ab0904ebbd54c\n'
+            ]
+        }
+    )
+    result = testdir.runpytest_subprocess('--dataplugin-fetch')
+    assert result.errlines[-1] == (
+        'Downloaded file test-data.tar.gz does not match signature '
+        '2479d9203e1f4a326fd2cb49c66ab0904ebbd54c'
+    )
+    assert testdir.tmpdir.join('data', 'test-data-file.txt').read() == 'previous'
+    assert not testdir.tmpdir.join('.data.fetch').exists()
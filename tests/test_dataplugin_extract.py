@@ -0,0 +1,237 @@
+import os
+import pytest
+import dataplugin
+from helpers import PYTESTFILE
+
+
+@pytest.mark.parametrize('extension', [
+    '.tar', '.tar.gz', '.tar.xz', '.tar.zst', '.tar.lz4',
+])
+def test_codec_roundtrip(testdir, extension):
+    codec = dataplugin.codec_for_location(extension)
+    if not codec.available:
+        pytest.skip('{} codec not available'.format(codec.name))
+    data = testdir.mkdir('data')
+    data.join('a.txt').write('a' * 1024)
+    data.mkdir('sub').join('b.bin').write_binary(os.urandom(64 * 1024))
+    name = 'test-data' + extension
+    sig = dataplugin.create_archive(name, str(data))
+    assert dataplugin.create_archive(name, str(data)) == sig
+    dataplugin.extract_archive(name, str(testdir.tmpdir.join('out')))
+    out = testdir.tmpdir.join('out')
+    assert out.join('a.txt').read() == 'a' * 1024
+    assert out.join('sub', 'b.bin').read_binary() == data.join('sub', 'b.bin').read_binary()
+
+
+@pytest.mark.parametrize('extension', ['.tar.gz', '.tar.xz'])
+def test_compress_level_zero(tmpdir, extension):
+    codec = dataplugin.codec_for_location(extension)
+    if not codec.available:
+        pytest.skip('{} codec not available'.format(codec.name))
+    data = tmpdir.mkdir('data')
+    data.join('a.txt').write('a' * 100000)
+    stored = str(tmpdir.join('stored' + extension))
+    dataplugin.create_archive(stored, str(data), compress_level=0)
+    packed = str(tmpdir.join('packed' + extension))
+    dataplugin.create_archive(packed, str(data))
+    assert os.path.getsize(stored) > os.path.getsize(packed)
+    dataplugin.extract_archive(stored, str(tmpdir.join('out')))
+    assert tmpdir.join('out', 'a.txt').read() == 'a' * 100000
+
+
+def test_zstd_signature_independent_of_workers(tmpdir):
+    codec = dataplugin.codec_for_location('.tar.zst')
+    if not codec.available:
+        pytest.skip('{} codec not available'.format(codec.name))
+    data = tmpdir.mkdir('data')
+    data.join('a.bin').write_binary(os.urandom(300 * 1024) + b'a' * 300 * 1024)
+    sigs = set()
+    for workers in (1, 2, 4):
+        out = tmpdir.mkdir('w{}'.format(workers)).join('test-data.tar.zst')
+        sigs.add(dataplugin.create_archive(
+            str(out), str(data), compress_workers=workers,
+        ))
+    assert len(sigs) == 1
+
+
+def test_extract_with_codec_from_ini(testdir):
+    testdir.makepyfile(PYTESTFILE)
+    data = testdir.mkdir('data')
+    data.join('a.txt').write('a')
+    dataplugin.create_archive('.test-data.tar.gz', str(data), codec='tar')
+    testdir.makefile('ini', **{'pytest': ['[pytest]', 'dataplugin-codec = tar\n']})
+    data.remove()
+    result = testdir.runpytest_subprocess('--dataplugin-extract')
+    assert result.errlines[-1].startswith('Extracted archive test-data.tar.gz')
+    assert testdir.tmpdir.join('data', 'a.txt').read() == 'a'
+
+
+def test_incremental_extract(testdir):
+    data = testdir.mkdir('data')
+    data.join('a.txt').write('aaaa')
+    data.mkdir('sub').join('b.txt').write('bbbb')
+    dataplugin.create_archive('test-data.tar.gz', str(data))
+    out = testdir.tmpdir.join('out')
+    cache_dir = str(testdir.tmpdir.join('cache'))
+
+    def extract():
+        stats = dataplugin.ExtractStats()
+        dataplugin.extract_archive(
+            'test-data.tar.gz', str(out), incremental=True,
+            cache_dir=cache_dir, stats=stats,
+        )
+        return stats
+
+    stats = extract()
+    assert (stats.written, stats.skipped, stats.removed) == (2, 0, 0)
+    stats = extract()
+    assert (stats.written, stats.skipped, stats.removed) == (0, 2, 0)
+    out.join('a.txt').write('xxxx')
+    out.mkdir('extra').join('c.txt').write('c')
+    stats = extract()
+    assert (stats.written, stats.skipped, stats.removed) == (1, 1, 1)
+    assert stats.written_bytes == 4
+    assert out.join('a.txt').read() == 'aaaa'
+    assert not out.join('extra').check()
+
+
+def test_parallel_extract(testdir):
+    data = testdir.mkdir('data')
+    for i in range(50):
+        path = data.join('dir{}'.format(i % 5), 'file{}.txt'.format(i))
+        path.write(str(i) * 100, ensure=True)
+    large = os.urandom(dataplugin.EXTRACT_BUFFER_LIMIT + 1)
+    data.join('large.bin').write_binary(large)
+    dataplugin.create_archive('test-data.tar.gz', str(data))
+    out = testdir.tmpdir.join('out')
+    dataplugin.extract_archive('test-data.tar.gz', str(out), workers=4)
+    for i in range(50):
+        path = out.join('dir{}'.format(i % 5), 'file{}.txt'.format(i))
+        assert path.read() == str(i) * 100
+    assert out.join('large.bin').read_binary() == large
+
+
+def test_phase_stats(tmpdir):
+    stats = dataplugin.PhaseStats()
+    with stats.phase('transfer'):
+        with stats.phase('extract'):
+            stats.add('extract', 2048, 2)
+    report = stats.report()
+    assert report['extract']['files'] == 2
+    assert report['transfer']['wall'] >= 0
+    assert list(stats.timed('walk', [1, 2])) == [1, 2]
+    assert [line.split()[0] for line in stats.lines()] == [
+        'phase', 'walk', 'transfer', 'extract',
+    ]
+
+
+@pytest.mark.parametrize('links, workers', [
+    ('hardlink', 1), ('hardlink', 4), ('copy', 1), ('copy', 4),
+])
+def test_extract_dedupe(tmpdir, links, workers):
+    data = tmpdir.mkdir('data')
+    data.join('a.txt').write('same')
+    data.mkdir('sub').join('b.txt').write('same')
+    data.join('sub', 'c.txt').write('diff')
+    name = str(tmpdir.join('test-data.tar.gz'))
+    dataplugin.create_archive(name, str(data), dedupe=True)
+    out = tmpdir.join('out')
+    dataplugin.extract_archive(name, str(out), workers=workers, links=links)
+    assert out.join('sub', 'b.txt').read() == 'same'
+    linked = out.join('a.txt').samefile(out.join('sub', 'b.txt'))
+    assert linked == (links == 'hardlink')
+    # Files extracted as hardlinks are replaced, not written through
+    data.join('sub', 'b.txt').write('other')
+    plain = str(tmpdir.mkdir('plain').join('test-data.tar.gz'))
+    dataplugin.create_archive(plain, str(data))
+    dataplugin.extract_archive(plain, str(out), workers=workers)
+    assert out.join('a.txt').read() == 'same'
+    assert out.join('sub', 'b.txt').read() == 'other'
+
+
+def test_incremental_extract_dedupe(tmpdir):
+    data = tmpdir.mkdir('data')
+    data.join('a.txt').write('same')
+    data.join('b.txt').write('same')
+    name = str(tmpdir.join('test-data.tar.gz'))
+    dataplugin.create_archive(name, str(data), dedupe=True)
+    out = tmpdir.join('out')
+    cache_dir = str(tmpdir.join('cache'))
+
+    def extract(name):
+        stats = dataplugin.ExtractStats()
+        dataplugin.extract_archive(
+            name, str(out), incremental=True, cache_dir=cache_dir, stats=stats,
+        )
+        return stats
+
+    stats = extract(name)
+    assert (stats.written, stats.skipped) == (2, 0)
+    assert out.join('a.txt').samefile(out.join('b.txt'))
+    stats = extract(name)
+    assert (stats.written, stats.skipped) == (0, 2)
+    data.join('b.txt').write('diff')
+    plain = str(tmpdir.mkdir('plain').join('test-data.tar.gz'))
+    dataplugin.create_archive(plain, str(data))
+    stats = extract(plain)
+    # Both files are written, a.txt to break it's link with b.txt
+    assert (stats.written, stats.skipped) == (2, 0)
+    assert not out.join('a.txt').samefile(out.join('b.txt'))
+    assert out.join('a.txt').read() == 'same'
+    assert out.join('b.txt').read() == 'diff'
+
+
+def traversal_archive(path, name, linkname=None):
+    import io
+    import tarfile
+    with tarfile.open(path, 'w:gz') as tar:
+        info = tarfile.TarInfo('a.txt')
+        info.size = 1
+        tar.addfile(info, io.BytesIO(b'a'))
+        info = tarfile.TarInfo(name)
+        if linkname is None:
+            info.size = 7
+            tar.addfile(info, io.BytesIO(b'escaped'))
+        else:
+            info.type = tarfile.LNKTYPE
+            info.linkname = linkname
+            tar.addfile(info)
+
+
+@pytest.mark.parametrize('name', ['../../escaped.txt', '/tmp/escaped.txt'])
+def test_fetch_rejects_members_outside_output(tmpdir, name):
+    archive = str(tmpdir.join('evil.tar.gz'))
+    traversal_archive(archive, name)
+    out = tmpdir.mkdir('a').mkdir('b').join('out')
+    with pytest.raises(dataplugin.DataPluginException):
+        dataplugin.fetch_archive(archive, str(out), signature='0' * 40)
+    assert not tmpdir.join('a', 'escaped.txt').check()
+    assert not os.path.exists('/tmp/escaped.txt')
+    assert not tmpdir.join('a', 'b', '.out.fetch').check()
+    assert not out.check()
+
+
+@pytest.mark.parametrize('workers,incremental', [
+    (1, False), (2, False), (1, True),
+])
+def test_extract_rejects_members_outside_output(tmpdir, workers, incremental):
+    archive = str(tmpdir.join('evil.tar.gz'))
+    traversal_archive(archive, 'sub/../../../escaped.txt')
+    out = tmpdir.mkdir('a').join('out')
+    with pytest.raises(dataplugin.DataPluginException):
+        dataplugin.extract_archive(
+            archive, str(out), workers=workers, incremental=incremental,
+            cache_dir=str(tmpdir.join('cache')),
+        )
+    assert not tmpdir.join('escaped.txt').check()
+
+
+@pytest.mark.parametrize('links', ['hardlink', 'copy'])
+def test_extract_rejects_links_outside_output(tmpdir, links):
+    tmpdir.join('secret.txt').write('secret')
+    archive = str(tmpdir.join('evil.tar.gz'))
+    traversal_archive(archive, 'stolen.txt', linkname='../secret.txt')
+    out = tmpdir.join('out')
+    with pytest.raises(dataplugin.DataPluginException):
+        dataplugin.extract_archive(archive, str(out), links=links)
+    assert not out.join('stolen.txt').check()
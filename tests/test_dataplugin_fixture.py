@@ -0,0 +1,59 @@
+import os
+import json
+import pytest
+import dataplugin
+
+
+LAZY_TESTFILE = """
+import io
+
+def test_lazy(dataplugin):
+    path = dataplugin.path('sub/b.txt')
+    with io.open(path) as fp:
+        assert fp.read() == 'bbbb'
+"""
+
+
+@pytest.mark.parametrize('extension', ['.tar', '.tar.gz'])
+def test_iter_member(tmpdir, extension):
+    data = tmpdir.mkdir('data')
+    data.join('a.txt').write('a' * 5000)
+    data.mkdir('sub').join('b.bin').write_binary(os.urandom(70000))
+    name = str(tmpdir.join('test-data' + extension))
+    dataplugin.create_archive(name, str(data))
+    entries = dataplugin.archive_members(name)
+    assert [e.path for e in entries] == ['a.txt', 'sub/b.bin']
+    for entry in entries:
+        content = b''.join(dataplugin.iter_member(name, entry.offset, entry.size))
+        assert content == data.join(*entry.path.split('/')).read_binary()
+
+
+def test_lazy_fixture(testdir):
+    data = testdir.mkdir('data')
+    data.join('a.txt').write('aaaa')
+    data.mkdir('sub').join('b.txt').write('bbbb')
+    dataplugin.create_archive('.test-data.tar.gz', str(data))
+    data.remove()
+    testdir.makepyfile(LAZY_TESTFILE)
+    result = testdir.runpytest_subprocess('-p', 'no:cacheprovider')
+    result.assert_outcomes(passed=1)
+    assert data.join('sub', 'b.txt').read() == 'bbbb'
+    assert not data.join('a.txt').exists()
+    cache_dir = testdir.tmpdir.join('.pytest_cache', 'dataplugin')
+    assert json.loads(cache_dir.join('used-files.json').read()) == ['sub/b.txt']
+    assert [p.basename for p in cache_dir.listdir('members-*')]
+    # A modified file is materialized again
+    data.join('sub', 'b.txt').write('xxxx')
+    result = testdir.runpytest_subprocess('-p', 'no:cacheprovider')
+    result.assert_outcomes(passed=1)
+    assert data.join('sub', 'b.txt').read() == 'bbbb'
+
+
+def test_lazy_data_unknown_file(tmpdir):
+    source = dataplugin.ArchiveSource('missing.tar', [])
+    cache = dataplugin.HashCache(str(tmpdir.join('hashes.json')))
+    data = dataplugin.LazyData(str(tmpdir.join('data')), source, cache)
+    with pytest.raises(dataplugin.DataPluginException):
+        data.path('nothing.txt')
+    with pytest.raises(dataplugin.DataPluginException):
+        data.path('../outside.txt')
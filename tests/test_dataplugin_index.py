@@ -0,0 +1,104 @@
+import io
+import os
+import pytest
+import dataplugin
+
+
+def make_data(tmpdir):
+    data = tmpdir.mkdir('data')
+    for n in range(8):
+        data.join('{}.bin'.format(n)).write_binary(os.urandom(40000 + n))
+    data.mkdir('sub').join('a.txt').write('a' * 5000)
+    return data
+
+
+@pytest.mark.parametrize('extension, workers', [
+    ('.tar', 1), ('.tar.gz', 1), ('.tar.gz', 2), ('.tar.zst', 1),
+])
+def test_open_member(tmpdir, extension, workers):
+    codec = dataplugin.codec_for_location(extension)
+    if not codec.available:
+        pytest.skip('{} codec not available'.format(codec.name))
+    data = make_data(tmpdir)
+    name = str(tmpdir.join('test-data' + extension))
+    sig = dataplugin.create_archive(
+        name, str(data), compress_workers=workers, block_size=32 * 1024,
+        seekable=True, seek_interval=64 * 1024,
+    )
+    index = dataplugin.read_archive_index(name, sig)
+    assert index['signature'] == sig
+    if extension != '.tar':
+        assert len(index['seek_points']) > 1
+    # The index matches the members found by reading the whole archive
+    assert dataplugin.index_members(index) == dataplugin.archive_members(name)
+    reader = dataplugin.ConsistantArchiveReader(name)
+    try:
+        for entry in dataplugin.index_members(index):
+            with reader.open_member(entry.path) as fp:
+                assert fp.read() == data.join(*entry.path.split('/')).read_binary()
+        with pytest.raises(dataplugin.DataPluginException):
+            reader.open_member('missing.bin')
+    finally:
+        reader.close()
+    dataplugin.extract_archive(name, str(tmpdir.join('out')))
+    assert tmpdir.join('out', 'sub', 'a.txt').read() == 'a' * 5000
+
+
+def test_index_deterministic(tmpdir):
+    data = make_data(tmpdir)
+    first = str(tmpdir.join('first.tar.gz'))
+    second = str(tmpdir.join('second', 'first.tar.gz'))
+    tmpdir.mkdir('second')
+    sig = dataplugin.create_archive(first, str(data), seekable=True)
+    assert dataplugin.create_archive(second, str(data), seekable=True) == sig
+    with io.open(first + '.index', 'rb') as fp:
+        with io.open(second + '.index', 'rb') as other:
+            assert fp.read() == other.read()
+    assert dataplugin.read_archive_index(first, 'sha1:' + '0' * 40) is None
+
+
+def test_open_member_without_index(tmpdir):
+    data = make_data(tmpdir)
+    name = str(tmpdir.join('test-data.tar.gz'))
+    dataplugin.create_archive(name, str(data))
+    assert dataplugin.read_archive_index(name) is None
+    reader = dataplugin.ConsistantArchiveReader(name)
+    try:
+        with reader.open_member('sub/a.txt') as fp:
+            assert fp.read(10) == b'a' * 10
+            assert fp.read() == b'a' * 4990
+    finally:
+        reader.close()
+
+
+def test_open_member_ignores_stale_index(tmpdir):
+    import json
+    data = make_data(tmpdir)
+    name = str(tmpdir.join('test-data.tar.gz'))
+    sig = dataplugin.create_archive(name, str(data), seekable=True)
+    # An index of another archive of the same size
+    with io.open(name + '.index') as fp:
+        index = json.load(fp)
+    index['signature'] = 'sha1:' + '0' * 40
+    index['members'] = [
+        [path, size, digest, offset + 512]
+        for path, size, digest, offset in index['members']
+    ]
+    with io.open(name + '.index', 'w') as fp:
+        fp.write(u'{}'.format(json.dumps(index)))
+    for signature in (None, sig):
+        reader = dataplugin.ConsistantArchiveReader(name, signature=signature)
+        try:
+            with reader.open_member('sub/a.txt') as fp:
+                assert fp.read() == b'a' * 5000
+        finally:
+            reader.close()
+
+
+def test_create_removes_stale_index(tmpdir):
+    data = make_data(tmpdir)
+    name = str(tmpdir.join('test-data.tar.gz'))
+    dataplugin.create_archive(name, str(data), seekable=True)
+    assert tmpdir.join('test-data.tar.gz.index').check()
+    dataplugin.create_archive(name, str(data))
+    assert not tmpdir.join('test-data.tar.gz.index').check()
@@ -0,0 +1,156 @@
+import os
+import pytest
+import dataplugin
+from helpers import PYTESTFILE
+
+
+def make_data(path):
+    data = path.mkdir('data')
+    data.join('top.txt').write('top')
+    data.mkdir('images').join('a.png').write_binary(b'a' * 1000)
+    data.join('images').join('b.png').write_binary(b'b' * 1000)
+    data.mkdir('audio').join('c.wav').write_binary(b'c' * 3000)
+    return data
+
+
+def make_sharded_project(testdir):
+    testdir.makepyfile(PYTESTFILE)
+    testdir.mkdir('remote')
+    data = make_data(testdir.tmpdir)
+    testdir.makefile('ini', **{
+        'pytest': [
+            '[pytest]',
+            'dataplugin-layout = shards',
+            'dataplugin-location = remote/test-data.tar.gz',
+            'dataplugin-signature =\n',
+        ]
+    })
+    return data
+
+
+def test_plan_shards(tmpdir):
+    data = make_data(tmpdir)
+    shards = dataplugin.plan_shards(str(data))
+    assert [[relpath for relpath, _ in shard] for shard in shards] == [
+        ['top.txt'], ['audio/c.wav'], ['images/a.png', 'images/b.png'],
+    ]
+    shards = dataplugin.plan_shards(str(data), by='size', shard_size=2000)
+    assert [[relpath for relpath, _ in shard] for shard in shards] == [
+        ['top.txt'], ['audio/c.wav'], ['images/a.png', 'images/b.png'],
+    ]
+    shards = dataplugin.plan_shards(str(data), by='size', shard_size=10000)
+    assert len(shards) == 1
+
+
+def test_create_sharded_is_deterministic(tmpdir):
+    data = make_data(tmpdir)
+    shard_dir = str(tmpdir.join('shards'))
+    sig = dataplugin.create_sharded(str(tmpdir.join('index')), str(data), shard_dir, workers=3)
+    assert dataplugin.create_sharded(str(tmpdir.join('index')), str(data), shard_dir) == sig
+    index = dataplugin.read_shard_index(str(tmpdir.join('index')))
+    assert [shard['prefixes'] for shard in index['shards']] == [['.'], ['audio'], ['images']]
+    assert sorted(os.listdir(shard_dir)) == sorted(s['name'] for s in index['shards'])
+    # Changing one directory only changes it's shard
+    data.join('audio', 'c.wav').write_binary(b'd' * 3000)
+    dataplugin.create_sharded(str(tmpdir.join('index')), str(data), shard_dir)
+    changed = dataplugin.read_shard_index(str(tmpdir.join('index')))
+    assert changed['shards'][0] == index['shards'][0]
+    assert changed['shards'][1] != index['shards'][1]
+    assert changed['shards'][2] == index['shards'][2]
+
+
+def test_sharded_roundtrip(testdir):
+    data = make_sharded_project(testdir)
+    result = testdir.runpytest_subprocess('--dataplugin-create')
+    assert result.errlines[-1].startswith('Archive createded')
+    result = testdir.runpytest_subprocess('--dataplugin-upload')
+    assert 'Uploaded 3 of 3 shards' in result.errlines
+    result = testdir.runpytest_subprocess('--dataplugin-upload')
+    assert 'Uploaded 0 of 3 shards' in result.errlines
+    testdir.tmpdir.join('.dataplugin-store').remove()
+    testdir.tmpdir.join('.test-data.tar.gz').remove()
+    data.remove()
+    result = testdir.runpytest_subprocess(
+        '--dataplugin-download', '--dataplugin-shards=images'
+    )
+    assert 'Downloaded 1 of 1 shards' in result.errlines
+    result = testdir.runpytest_subprocess(
+        '--dataplugin-extract', '--dataplugin-shards=images'
+    )
+    assert 'Extracted 1 shards' in result.errlines
+    assert data.join('images', 'b.png').read_binary() == b'b' * 1000
+    assert not data.join('audio').exists()
+    result = testdir.runpytest_subprocess('--dataplugin-download')
+    assert 'Downloaded 2 of 3 shards' in result.errlines
+    result = testdir.runpytest_subprocess('--dataplugin-extract')
+    assert 'Extracted 3 shards' in result.errlines
+    assert data.join('audio', 'c.wav').read_binary() == b'c' * 3000
+    assert data.join('top.txt').read() == 'top'
+
+
+def test_sharded_verify_directory(testdir):
+    data = make_sharded_project(testdir)
+    testdir.runpytest_subprocess('--dataplugin-create')
+    signature = dataplugin.file_signature('.test-data.tar.gz')
+    testdir.makefile('ini', **{
+        'pytest': [
+            '[pytest]',
+            'dataplugin-layout = shards',
+            'dataplugin-signature = {}\n'.format(signature),
+        ]
+    })
+    result = testdir.runpytest_subprocess('--dataplugin-verify-directory')
+    assert result.errlines[-1] == 'Directory passed verification :)'
+    data.join('images', 'a.png').write_binary(b'x' * 1000)
+    result = testdir.runpytest_subprocess('--dataplugin-verify-directory')
+    assert result.errlines[-1] == 'Directory failed verification!'
+
+
+def test_sharded_create_skipped_when_unchanged(testdir):
+    make_sharded_project(testdir)
+    result = testdir.runpytest_subprocess('--dataplugin-create')
+    assert result.errlines[-1].startswith('Archive createded')
+    result = testdir.runpytest_subprocess('--dataplugin-create')
+    assert result.errlines[-1].startswith('Archive is up to date')
+    # A shard removed from the store is written again
+    shard_dir = testdir.tmpdir.join('.dataplugin-store', 'shards')
+    shard_dir.listdir()[0].remove()
+    result = testdir.runpytest_subprocess('--dataplugin-create')
+    assert result.errlines[-1].startswith('Archive createded')
+    result = testdir.runpytest_subprocess(
+        '--dataplugin-extract', '--dataplugin-incremental'
+    )
+    assert result.errlines[-1] == \
+        'Incremental extract is not supported by the shards layout'
+
+
+def test_extract_sharded_verifies_before_extracting(tmpdir):
+    data = make_data(tmpdir)
+    shard_dir = tmpdir.join('shards')
+    index = str(tmpdir.join('index'))
+    dataplugin.create_sharded(index, str(data), str(shard_dir))
+    other = tmpdir.mkdir('other')
+    other.mkdir('images').join('a.png').write_binary(b'z' * 1000)
+    name = [s['name'] for s in dataplugin.read_shard_index(index)['shards']
+            if s['prefixes'] == ['images']][0]
+    dataplugin.create_archive(str(shard_dir.join(name)), str(other))
+    out = tmpdir.join('out')
+    with pytest.raises(dataplugin.BlobVerificationFailed):
+        dataplugin.extract_sharded(index, str(out), str(shard_dir), ['images'])
+    assert not out.join('images').exists()
+
+
+def test_lazy_data_from_shards_of_another_algorithm(tmpdir):
+    data = make_data(tmpdir)
+    shard_dir = tmpdir.join('shards')
+    index = str(tmpdir.join('index'))
+    dataplugin.create_sharded(index, str(data), str(shard_dir), algorithm='sha256')
+    source = dataplugin.ShardSource(index, str(shard_dir), str(tmpdir.join('cache')))
+    cache = dataplugin.HashCache(str(tmpdir.join('hashes.json')), algorithm='sha1')
+    lazy = dataplugin.LazyData(str(tmpdir.join('lazy')), source, cache)
+    for name in ('images/a.png', 'top.txt'):
+        path = lazy.path(name)
+        with open(path, 'rb') as fp:
+            assert fp.read() == data.join(*name.split('/')).read_binary()
+        # Files already materialized are left alone
+        assert lazy.path(name) == path
@@ -0,0 +1,574 @@
+import os
+import pytest
+import dataplugin
+
+
+@pytest.mark.parametrize('methods', ['native', 'buffered'])
+def test_copy_file(tmpdir, monkeypatch, methods):
+    if methods == 'buffered':
+        monkeypatch.setattr(dataplugin, '_copy_methods', lambda: [dataplugin._copy_buffered])
+    src = tmpdir.join('src')
+    data = os.urandom(3 * 1024 * 1024 + 17)
+    src.write_binary(data)
+    dataplugin.copy_file(str(src), str(tmpdir.join('dst')))
+    assert tmpdir.join('dst').read_binary() == data
+
+
+def test_copy_file_falls_back(tmpdir, monkeypatch):
+    def unsupported(src, dst, offset):
+        import errno
+        raise OSError(errno.EXDEV, 'cross device')
+    monkeypatch.setattr(
+        dataplugin, '_copy_methods',
+        lambda: [unsupported, dataplugin._copy_buffered],
+    )
+    tmpdir.join('src').write_binary(b'abc' * 1000)
+    dataplugin.copy_file(str(tmpdir.join('src')), str(tmpdir.join('dst')))
+    assert tmpdir.join('dst').read_binary() == b'abc' * 1000
+
+
+def test_shasum_large_file(tmpdir):
+    import hashlib
+    data = os.urandom(dataplugin.MMAP_THRESHOLD * 3 + 5)
+    tmpdir.join('big').write_binary(data)
+    assert dataplugin.shasum(str(tmpdir.join('big'))) == hashlib.sha1(data).hexdigest()
+    tmpdir.join('empty').write_binary(b'')
+    assert dataplugin.shasum(str(tmpdir.join('empty'))) == hashlib.sha1(b'').hexdigest()
+
+
+@pytest.fixture
+def s3(monkeypatch):
+    moto = pytest.importorskip('moto')
+    boto3 = pytest.importorskip('boto3')
+    mock = getattr(moto, 'mock_aws', None) or moto.mock_s3
+    monkeypatch.setenv('AWS_ACCESS_KEY_ID', 'testing')
+    monkeypatch.setenv('AWS_SECRET_ACCESS_KEY', 'testing')
+    monkeypatch.setenv('AWS_DEFAULT_REGION', 'us-east-1')
+    monkeypatch.setattr(dataplugin, '_BOTO3_CLIENTS', {})
+    monkeypatch.setitem(dataplugin.STATE, 's3_part_size', 5 * 1024 * 1024)
+    monkeypatch.setitem(dataplugin.STATE, 's3_multipart_threshold', 5 * 1024 * 1024)
+    monkeypatch.setitem(dataplugin.STATE, 's3_max_concurrency', 4)
+    with mock():
+        boto3.client('s3').create_bucket(Bucket='bucket')
+        yield
+
+
+def test_s3_roundtrip(tmpdir, s3):
+    data = os.urandom(11 * 1024 * 1024)
+    tmpdir.join('upload').write_binary(data)
+    location = 's3://bucket/path/test-data.tar.gz'
+    assert not dataplugin.boto3_exists(location)
+    dataplugin.transfer_file(location, str(tmpdir.join('upload')), dataplugin.UPLOADER_SCHEMAS)
+    assert dataplugin.boto3_exists(location)
+    dataplugin.transfer_file(location, str(tmpdir.join('download')), dataplugin.DOWNLOADER_SCHEMAS)
+    assert tmpdir.join('download').read_binary() == data
+    assert len(dataplugin._BOTO3_CLIENTS) == 1
+
+
+def test_s3_download_resumes(tmpdir, s3):
+    import hashlib
+    part_size = dataplugin.STATE['s3_part_size']
+    data = os.urandom(part_size * 2 + 100)
+    tmpdir.join('upload').write_binary(data)
+    location = 's3://bucket/test-data.tar.gz'
+    dataplugin.transfer_file(location, str(tmpdir.join('upload')), dataplugin.UPLOADER_SCHEMAS)
+    # An interrupted download with the first range complete.
+    partname = str(tmpdir.join('download.part'))
+    with open(partname, 'wb') as fp:
+        fp.write(data[:part_size])
+    checkpoint = dataplugin.TransferCheckpoint(partname + '.json', location, len(data))
+    checkpoint.complete(0, part_size)
+    dataplugin.download_file(
+        location, str(tmpdir.join('download')), hashlib.sha1(data).hexdigest()
+    )
+    assert tmpdir.join('download').read_binary() == data
+    assert not tmpdir.join('download.part').exists()
+    assert not tmpdir.join('download.part.json').exists()
+
+
+def test_s3_download_resume_verifies(tmpdir, s3):
+    import hashlib
+    part_size = dataplugin.STATE['s3_part_size']
+    data = os.urandom(part_size + 100)
+    tmpdir.join('upload').write_binary(data)
+    location = 's3://bucket/test-data.tar.gz'
+    dataplugin.transfer_file(location, str(tmpdir.join('upload')), dataplugin.UPLOADER_SCHEMAS)
+    # The completed range is not fetched again, so a corrupt part is caught
+    # by the signature check.
+    partname = str(tmpdir.join('download.part'))
+    with open(partname, 'wb') as fp:
+        fp.write(b'x' * part_size)
+    checkpoint = dataplugin.TransferCheckpoint(partname + '.json', location, len(data))
+    checkpoint.complete(0, part_size)
+    with pytest.raises(dataplugin.DownloadVerificationFailed):
+        dataplugin.download_file(
+            location, str(tmpdir.join('download')), hashlib.sha1(data).hexdigest()
+        )
+    assert not tmpdir.join('download').exists()
+    assert not tmpdir.join('download.part').exists()
+
+
+def test_transfer_checkpoint_ignores_other_location(tmpdir):
+    path = str(tmpdir.join('download.part.json'))
+    dataplugin.TransferCheckpoint(path, 's3://bucket/a', 10).complete(0, 5)
+    assert dataplugin.TransferCheckpoint.load(path, 's3://bucket/a', 10).done == {(0, 5)}
+    assert dataplugin.TransferCheckpoint.load(path, 's3://bucket/b', 10).done == set()
+    assert dataplugin.TransferCheckpoint.load(path, 's3://bucket/a', 11).done == set()
+
+
+def test_parse_size():
+    assert dataplugin.parse_size('1024') == 1024
+    assert dataplugin.parse_size('8M') == 8 * 1024 * 1024
+    assert dataplugin.parse_size('16KiB') == 16 * 1024
+    assert dataplugin.parse_size('1gb') == 1024 ** 3
+
+
+@pytest.mark.parametrize('methods', ['native', 'copy'])
+def test_link_file(tmpdir, monkeypatch, methods):
+    if methods == 'copy':
+        monkeypatch.setattr(dataplugin, '_link_methods', lambda: [dataplugin._copy])
+    tmpdir.join('src').write_binary(b'data')
+    method = dataplugin.link_file(str(tmpdir.join('src')), str(tmpdir.join('sub', 'dst')))
+    assert tmpdir.join('sub', 'dst').read_binary() == b'data'
+    assert not tmpdir.join('sub', 'dst.tmp').exists()
+    if methods == 'copy':
+        assert method == 'copy'
+
+
+def test_shared_cache_evicts_least_recently_used(tmpdir):
+    cache = dataplugin.SharedCache(str(tmpdir.join('cache')), max_size=25)
+
+    def store(data):
+        def download(path):
+            with open(path, 'wb') as fp:
+                fp.write(data)
+            # Sidecars are not archives and go with their archive
+            with open(path + '.etag', 'w') as fp:
+                fp.write('"etag"')
+        return download
+
+    for i, name in enumerate(['a', 'b', 'c']):
+        path, hit = cache.fetch(name, store(b'x' * 10))
+        assert not hit
+        os.utime(path + '.used', (i, i))
+    assert not cache.has('a')
+    assert not os.path.exists(cache.path('a') + '.etag')
+    assert sorted(name for used, size, name in cache.entries()) == ['b', 'c']
+    assert cache.has('b') and cache.has('c')
+    path, hit = cache.fetch('b', store(b'y' * 10))
+    assert hit
+    with open(path, 'rb') as fp:
+        assert fp.read() == b'x' * 10
+
+
+@pytest.fixture
+def http(monkeypatch):
+    '''
+    A local http server storing PUT files in memory, serving them with range
+    and ETag support. Yields the base url and the server.
+    '''
+    import hashlib
+    import threading
+    try:
+        from http.server import HTTPServer, BaseHTTPRequestHandler
+        from socketserver import ThreadingMixIn
+    except ImportError:
+        from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+        from SocketServer import ThreadingMixIn
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, *args):
+            pass
+
+        def send_file_headers(self, status, data, length=None):
+            self.send_response(status)
+            self.send_header('ETag', '"{}"'.format(hashlib.sha1(data).hexdigest()))
+            if self.server.ranges:
+                self.send_header('Accept-Ranges', 'bytes')
+            self.send_header('Content-Length', str(len(data) if length is None else length))
+            self.end_headers()
+
+        def redirect(self):
+            if self.path not in self.server.redirects:
+                return False
+            status, target = self.server.redirects[self.path]
+            self.send_response(status)
+            self.send_header('Location', target)
+            self.send_header('Content-Length', '4')
+            self.end_headers()
+            if self.command != 'HEAD':
+                self.wfile.write(b'move')
+            return True
+
+        def lookup(self):
+            self.server.requests.append((self.command, self.headers.get('Range')))
+            if self.redirect():
+                return None
+            data = self.server.files.get(self.path)
+            if data is None:
+                self.send_response(404)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return None
+            etag = '"{}"'.format(hashlib.sha1(data).hexdigest())
+            if self.headers.get('If-None-Match') == etag:
+                self.send_response(304)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return None
+            return data
+
+        def do_HEAD(self):
+            data = self.lookup()
+            if data is not None:
+                self.send_file_headers(200, data)
+
+        def do_GET(self):
+            data = self.lookup()
+            if data is None:
+                return
+            byte_range = self.headers.get('Range')
+            if self.server.failures.get(byte_range):
+                self.server.failures[byte_range] -= 1
+                self.send_response(503)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            if byte_range and self.server.ranges:
+                start, end = byte_range.split('=', 1)[1].split('-')
+                data = data[int(start):int(end) + 1]
+                self.send_file_headers(206, data)
+            else:
+                self.send_file_headers(200, data)
+            self.wfile.write(data)
+
+        def do_PUT(self):
+            self.server.requests.append((self.command, None))
+            length = int(self.headers.get('Content-Length'))
+            data = self.rfile.read(length)
+            if self.redirect():
+                return
+            self.server.files[self.path] = data
+            self.send_response(201)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+
+    class Server(ThreadingMixIn, HTTPServer):
+        daemon_threads = True
+
+    server = Server(('127.0.0.1', 0), Handler)
+    server.files = {}
+    server.requests = []
+    server.ranges = True
+    server.redirects = {}
+    server.failures = {}
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    monkeypatch.setattr(dataplugin, '_HTTP_POOLS', {})
+    monkeypatch.setattr(dataplugin, 'RESUME_PART_SIZE', 1024 * 1024)
+    try:
+        yield 'http://127.0.0.1:{}'.format(server.server_address[1]), server
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_http_roundtrip(tmpdir, http):
+    import hashlib
+    url, server = http
+    data = os.urandom(3 * 1024 * 1024 + 11)
+    tmpdir.join('upload').write_binary(data)
+    location = url + '/path/test-data.tar.gz'
+    assert not dataplugin.http_exists(location)
+    dataplugin.transfer_file(location, str(tmpdir.join('upload')), dataplugin.UPLOADER_SCHEMAS)
+    assert dataplugin.http_exists(location)
+    dataplugin.download_file(
+        location, str(tmpdir.join('download')), hashlib.sha1(data).hexdigest()
+    )
+    assert tmpdir.join('download').read_binary() == data
+    ranges = [r for method, r in server.requests if method == 'GET']
+    assert len(ranges) == 4 and all(ranges)
+    # Connections are kept alive and reused
+    pool = dataplugin.http_pool(location)
+    assert 0 < len(pool.idle) <= dataplugin.STATE['http_max_connections']
+
+
+def test_http_download_retries_range(tmpdir, http, monkeypatch):
+    import hashlib
+    url, server = http
+    monkeypatch.setitem(dataplugin.STATE, 'transfer_backoff', 0.01)
+    data = os.urandom(3 * 1024 * 1024 + 11)
+    server.files['/test-data.tar.gz'] = data
+    failing = 'bytes=1048576-2097151'
+    server.failures[failing] = 1
+    dataplugin.download_file(
+        url + '/test-data.tar.gz', str(tmpdir.join('download')),
+        hashlib.sha1(data).hexdigest(),
+    )
+    assert tmpdir.join('download').read_binary() == data
+    ranges = [r for method, r in server.requests if method == 'GET']
+    assert len(ranges) == 5 and ranges.count(failing) == 2
+
+
+def test_http_download_not_modified(tmpdir, http):
+    url, server = http
+    server.files['/test-data.tar.gz'] = b'data'
+    location = url + '/test-data.tar.gz'
+    filename = str(tmpdir.join('download'))
+    dataplugin.download_file(location, filename)
+    assert tmpdir.join('download.etag').exists()
+    del server.requests[:]
+    dataplugin.download_file(location, filename)
+    assert [method for method, r in server.requests] == ['HEAD']
+    server.files['/test-data.tar.gz'] = b'changed'
+    dataplugin.download_file(location, filename)
+    assert tmpdir.join('download').read_binary() == b'changed'
+
+
+def test_http_download_without_ranges(tmpdir, http):
+    url, server = http
+    server.ranges = False
+    data = os.urandom(2 * 1024 * 1024)
+    server.files['/test-data.tar.gz'] = data
+    dataplugin.download_file(url + '/test-data.tar.gz', str(tmpdir.join('download')))
+    assert tmpdir.join('download').read_binary() == data
+    assert [r for method, r in server.requests if method == 'GET'] == [None]
+
+
+def test_http_redirects(tmpdir, http):
+    url, server = http
+    data = os.urandom(1024)
+    tmpdir.join('upload').write_binary(data)
+    server.redirects['/old.tar.gz'] = (307, url + '/new.tar.gz')
+    dataplugin.http_uploader(url + '/old.tar.gz', str(tmpdir.join('upload')))
+    assert server.files['/new.tar.gz'] == data
+    server.redirects['/moved.tar.gz'] = (302, '/new.tar.gz')
+    assert dataplugin.http_exists(url + '/moved.tar.gz')
+    dataplugin.download_file(url + '/moved.tar.gz', str(tmpdir.join('download')))
+    assert tmpdir.join('download').read_binary() == data
+    # Uploads are not redirected to a GET, that is an error
+    server.redirects['/see-other.tar.gz'] = (303, url + '/new.tar.gz')
+    with pytest.raises(dataplugin.DataPluginException):
+        dataplugin.http_uploader(
+            url + '/see-other.tar.gz', str(tmpdir.join('upload'))
+        )
+    server.redirects['/loop.tar.gz'] = (302, '/loop.tar.gz')
+    assert not dataplugin.http_exists(url + '/loop.tar.gz')
+    with pytest.raises(dataplugin.DataPluginException):
+        dataplugin.http_downloader(url + '/loop.tar.gz', str(tmpdir.join('loop')))
+
+
+@pytest.mark.parametrize('extension', ['.tar.gz', '.tar.zst'])
+def test_http_fetch(tmpdir, http, extension):
+    url, server = http
+    codec = dataplugin.codec_for_location(extension)
+    if not codec.available:
+        pytest.skip('{} codec not available'.format(codec.name))
+    data = tmpdir.mkdir('data')
+    data.join('a.bin').write_binary(os.urandom(300 * 1024))
+    data.mkdir('sub').join('b.txt').write('b' * 5000)
+    archive = str(tmpdir.join('test-data' + extension))
+    signature = dataplugin.create_archive(archive, str(data))
+    with open(archive, 'rb') as fp:
+        server.files['/test-data' + extension] = fp.read()
+    out = tmpdir.join('out')
+    result = dataplugin.fetch_archive(
+        url + '/test-data' + extension, str(out), signature
+    )
+    assert result == signature
+    assert out.join('a.bin').read_binary() == data.join('a.bin').read_binary()
+    assert out.join('sub', 'b.txt').read() == 'b' * 5000
+
+
+@pytest.fixture
+def smb_share(monkeypatch):
+    pytest.importorskip('smb')
+    import threading
+    import smb.SMBConnection
+    import smb.SMBHandler
+
+    class FakeSMBConnection(object):
+        files = {}
+        connected = []
+        reads = []
+
+        def __init__(self, user, passwd, my_name, remote_name, domain='',
+                     use_ntlm_v2=True):
+            self.login = (domain, user, passwd, remote_name)
+
+        def connect(self, host, port):
+            self.connected.append((self.login, host, port))
+
+        def storeFile(self, service, path, fileobj):
+            self.files[service, path] = fileobj.read()
+            return len(self.files[service, path])
+
+        def retrieveFile(self, service, path, fileobj):
+            return self.retrieveFileFromOffset(service, path, fileobj)
+
+        def getAttributes(self, service, path):
+            return type('SharedFile', (), {
+                'file_size': len(self.files[service, path])
+            })
+
+        def retrieveFileFromOffset(self, service, path, fileobj, offset=0,
+                                   max_length=-1):
+            self.reads.append(offset)
+            data = self.files[service, path][offset:]
+            if max_length >= 0:
+                data = data[:max_length]
+            fileobj.write(data)
+            return 0, len(data)
+
+        def close(self):
+            pass
+
+    monkeypatch.setattr(smb.SMBConnection, 'SMBConnection', FakeSMBConnection)
+    monkeypatch.setattr(smb.SMBHandler, 'SMBConnection', FakeSMBConnection)
+    monkeypatch.setattr(dataplugin, '_SMB_CONNECTIONS', threading.local())
+    monkeypatch.setattr(dataplugin, 'RESUME_PART_SIZE', 1000)
+    return FakeSMBConnection
+
+
+def test_smb_roundtrip(tmpdir, smb_share):
+    data = os.urandom(2500)
+    tmpdir.join('upload').write_binary(data)
+    location = 'smb://user:pw@SERVER,127.0.0.1/share/test-data.tar.gz'
+    dataplugin.transfer_file(
+        location, str(tmpdir.join('upload')), dataplugin.UPLOADER_SCHEMAS
+    )
+    assert smb_share.files['share', 'test-data.tar.gz'] == data
+    dataplugin.transfer_file(
+        location, str(tmpdir.join('download')), dataplugin.DOWNLOADER_SCHEMAS
+    )
+    assert tmpdir.join('download').read_binary() == data
+
+
+def test_smb_download_resumes(tmpdir, smb_share):
+    import hashlib
+    data = os.urandom(2500)
+    smb_share.files['share', 'dir/test-data.tar.gz'] = data
+    location = 'smb://dom;user:pw@SERVER,127.0.0.1/share/dir/test-data.tar.gz'
+    # An interrupted download with the first range complete.
+    partname = str(tmpdir.join('download.part'))
+    with open(partname, 'wb') as fp:
+        fp.write(data[:1000])
+    checkpoint = dataplugin.TransferCheckpoint(partname + '.json', location, len(data))
+    checkpoint.complete(0, 1000)
+    dataplugin.download_file(
+        location, str(tmpdir.join('download')), hashlib.sha1(data).hexdigest()
+    )
+    assert tmpdir.join('download').read_binary() == data
+    assert not tmpdir.join('download.part.json').exists()
+    assert smb_share.reads == [1000, 2000]
+    # One connection for the size, one for the worker fetching both ranges
+    assert smb_share.connected == [
+        (('dom', 'user', 'pw', 'SERVER'), '127.0.0.1', 139)
+    ] * 2
+
+
+def transfer_engines():
+    engines = [dataplugin.ThreadTransferEngine]
+    try:
+        from dataplugin_aio import AsyncTransferEngine
+    except (ImportError, SyntaxError):
+        pass
+    else:
+        engines.append(AsyncTransferEngine)
+    return engines
+
+
+@pytest.mark.parametrize('engine_class', transfer_engines())
+def test_transfer_engine_limits(engine_class):
+    import threading
+    import time
+    lock = threading.Lock()
+    running = {'file': 0, 's3': 0}
+    peak = {'file': 0, 's3': 0}
+
+    def job(scheme, i):
+        with lock:
+            running[scheme] += 1
+            peak[scheme] = max(peak[scheme], running[scheme])
+        time.sleep(0.01)
+        with lock:
+            running[scheme] -= 1
+        return i
+
+    jobs = []
+    for i in range(20):
+        location = 's3://bucket/{}'.format(i) if i % 2 else '/tmp/{}'.format(i)
+        scheme = 's3' if i % 2 else 'file'
+        jobs.append((location, lambda scheme=scheme, i=i: job(scheme, i)))
+    engine = engine_class(concurrency=6, limits={'s3': 2})
+    assert engine.run(jobs) == list(range(20))
+    assert peak['s3'] <= 2
+    assert 1 < peak['file'] <= 6
+
+
+@pytest.mark.parametrize('engine_class', transfer_engines())
+def test_transfer_engine_retries(engine_class):
+    calls = []
+
+    def flaky():
+        calls.append(1)
+        if len(calls) < 3:
+            raise dataplugin.TransferError('try again')
+        return 'done'
+
+    def broken():
+        raise dataplugin.DataPluginException('not retried')
+
+    engine = engine_class(retries=3, backoff=0.001)
+    assert engine.run([('http://host/a', flaky)]) == ['done']
+    assert len(calls) == 3
+    del calls[:]
+    with pytest.raises(dataplugin.TransferError):
+        engine_class(retries=1, backoff=0.001).run([('http://host/a', flaky)])
+    assert len(calls) == 2
+    with pytest.raises(dataplugin.DataPluginException):
+        engine.run([('http://host/a', broken), ('http://host/a', lambda: None)])
+
+
+def test_parse_limits():
+    assert dataplugin.parse_limits('s3:16, smb:2') == {'s3': 16, 'smb': 2}
+    assert dataplugin.parse_limits('') == {}
+
+
+class FakeWriter(object):
+
+    def __init__(self):
+        self.lines = []
+
+    def reline(self, line):
+        self.lines.append(line)
+
+    def line(self, s=''):
+        self.lines.append('\n')
+
+
+def test_progress():
+    writer = FakeWriter()
+    progress = dataplugin.Progress('Downloading x', 4 * 1024 * 1024, writer=writer)
+    progress.update(1024 * 1024)
+    # Nothing is shown within the first interval
+    assert writer.lines == []
+    progress.interval = 0
+    other = dataplugin.Progress('Hashing y', interval=0, writer=writer)
+    progress.update(1024 * 1024)
+    other.update(10)
+    assert len(writer.lines) == 1
+    assert writer.lines[0].startswith('Downloading x: 2.0 MB of 4.0 MB, ')
+    assert '/s, ETA 0:00:' in writer.lines[0]
+    progress.close()
+    assert writer.lines[-1] == '\n'
+    other.update(10)
+    assert writer.lines[-1].startswith('Hashing y: 20.0 B, ')
+    other.close()
+
+
+def test_progress_not_shown_without_terminal():
+    assert dataplugin.start_progress('x', 10) is dataplugin.NULL_PROGRESS
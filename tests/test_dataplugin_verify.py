@@ -39,3 +39,119 @@ def test_dataplugin_fail_verify(testdir):
         'Archive failed verification!'
     ]
     print_result(result)
+
+
+def test_dataplugin_verify_directory(testdir):
+    testdir.makepyfile(PYTESTFILE)
+    create_test_archive(testdir)
+    testdir.tmpdir.join('data', 'extra.txt').write('extra')
+    testdir.makefile('ini', **{
+            'pytest': [
+                '[pytest]',
+                'dataplugin-signature = 2479d9203e1f4a326fd2cb49c66ab0904ebbd54c\n'
+            ]
+        }
+    )
+    result = testdir.runpytest_subprocess('--dataplugin-verify-directory')
+    assert result.errlines == [
+        'dataplugin verify-directory invoked, skipping collection.',
+        'extra: extra.txt',
+        'Directory failed verification!',
+    ]
+    testdir.tmpdir.join('data', 'extra.txt').remove()
+    result = testdir.runpytest_subprocess('--dataplugin-verify-directory')
+    assert result.errlines[-1] == 'Directory passed verification :)'
+    testdir.tmpdir.join('data', 'test-data-file.txt').write('test data contenX')
+    testdir.tmpdir.join('data', 'test-data-file2.txt').write('more')
+    result = testdir.runpytest_subprocess(
+        '--dataplugin-verify-directory', '--dataplugin-fail-fast'
+    )
+    assert result.errlines == [
+        'dataplugin verify-directory invoked, skipping collection.',
+        'extra: test-data-file2.txt',
+        'Directory failed verification!',
+    ]
+    testdir.tmpdir.join('data', 'test-data-file2.txt').remove()
+    result = testdir.runpytest_subprocess('--dataplugin-verify-directory')
+    assert result.errlines[1:] == [
+        'changed: test-data-file.txt',
+        'Directory failed verification!',
+    ]
+
+
+def test_dataplugin_verify_sha256(testdir):
+    testdir.makepyfile(PYTESTFILE)
+    testdir.mkdir('data').join('a.txt').write('a')
+    testdir.makefile('ini', **{
+            'pytest': [
+                '[pytest]',
+                'dataplugin-hash = sha256',
+                'dataplugin-location = test-data.tar.gz',
+                'dataplugin-signature =\n',
+            ]
+        }
+    )
+    result = testdir.runpytest_subprocess('--dataplugin-create')
+    assert ' and hash is sha256:' in result.errlines[-1]
+    result = testdir.runpytest_subprocess('--dataplugin-upload')
+    assert 'dataplugin-signature = sha256:' in testdir.tmpdir.join('pytest.ini').read()
+    result = testdir.runpytest_subprocess('--dataplugin-verify')
+    assert result.errlines[-1] == 'Archive passed verification :)'
+    result = testdir.runpytest_subprocess('--dataplugin-verify-directory')
+    assert result.errlines[-1] == 'Directory passed verification :)'
+
+
+def test_dataplugin_verify_legacy_sha1_signature(testdir):
+    testdir.makepyfile(PYTESTFILE)
+    create_test_archive(testdir)
+    testdir.makefile('ini', **{
+            'pytest': [
+                '[pytest]',
+                'dataplugin-hash = blake2b',
+                'dataplugin-signature = 2479d9203e1f4a326fd2cb49c66ab0904ebbd54c\n'
+            ]
+        }
+    )
+    result = testdir.runpytest_subprocess('--dataplugin-verify')
+    assert result.errlines[-1] == 'Archive passed verification :)'
+
+
+def test_dataplugin_verify_unknown_signature_algorithm(testdir):
+    testdir.makepyfile(PYTESTFILE)
+    create_test_archive(testdir)
+    testdir.makefile('ini', **{
+            'pytest': [
+                '[pytest]',
+                'dataplugin-signature = md5:0cc175b9c0f1b6a831c399e269772661\n'
+            ]
+        }
+    )
+    result = testdir.runpytest_subprocess('--dataplugin-verify')
+    assert result.ret != 0
+    assert 'INTERNALERROR' not in result.stderr.str()
+    assert 'Unknown hash algorithm md5 in signature' in result.stderr.str()
+
+
+def test_hash_algorithm_conflicts_with_hash_cache(tmpdir):
+    import dataplugin
+    data = tmpdir.mkdir('data')
+    data.join('a.txt').write('a')
+    cache = dataplugin.HashCache(str(tmpdir.join('hashes.json')), algorithm='sha256')
+    archive = str(tmpdir.join('test-data.tar.gz'))
+    with pytest.raises(dataplugin.DataPluginException):
+        dataplugin.create_archive(
+            archive, str(data), hash_cache=cache, algorithm='sha1'
+        )
+    assert dataplugin.create_archive(
+        archive, str(data), hash_cache=cache, algorithm='sha256'
+    ).startswith('sha256:')
+
+
+def test_hash_files_keeps_order(tmpdir):
+    import dataplugin
+    paths = []
+    for i in range(20):
+        tmpdir.join(str(i)).write(str(i) * i)
+        paths.append(str(tmpdir.join(str(i))))
+    digests = dataplugin.hash_files(paths, 'sha256', workers=4)
+    assert digests == [dataplugin.shasum(p, 'sha256') for p in paths]